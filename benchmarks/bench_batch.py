@@ -0,0 +1,44 @@
+import argparse
+import time
+from pathlib import Path
+
+from src.trainer import Trainer
+
+parser = argparse.ArgumentParser(
+    description="Compare Trainer.continue_many against a loop of Trainer.continue_."
+)
+parser.add_argument("--model", type=Path, default="model.pkl", help="Model file.")
+parser.add_argument("--prefix-file", type=Path, required=True, help="Prompts file.")
+parser.add_argument("--length", type=int, default=50, help="Words per prompt.")
+parser.add_argument("--repeat", type=int, default=3, help="Timing repetitions.")
+
+
+def main():
+    args = parser.parse_args()
+    trainer = Trainer.load(args.model)
+    prefixes = [
+        line.split() or None for line in args.prefix_file.read_text().splitlines()
+    ]
+    seeds = list(range(len(prefixes)))
+
+    loop_time = batch_time = float("inf")
+    for _ in range(args.repeat):
+        started = time.perf_counter()
+        expected = [
+            trainer.continue_(prefix, word_count=args.length, seed=seed)
+            for prefix, seed in zip(prefixes, seeds)
+        ]
+        loop_time = min(loop_time, time.perf_counter() - started)
+
+        started = time.perf_counter()
+        results = trainer.continue_many(prefixes, word_count=args.length, seeds=seeds)
+        batch_time = min(batch_time, time.perf_counter() - started)
+
+    assert results == expected, "continue_many differs from continue_"
+    print(f"prompts:        {len(prefixes)}")
+    print(f"continue_ loop: {loop_time:.3f} s")
+    print(f"continue_many:  {batch_time:.3f} s ({loop_time / batch_time:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
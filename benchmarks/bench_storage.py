@@ -0,0 +1,76 @@
+import argparse
+import pickle
+import time
+from pathlib import Path
+
+import numpy as np
+
+from src.counter import NGramCounter
+from src.dictionary import Dictionary
+from src.model import NGramModel
+from src.storage import ArrayStorage, DictStorage, TrieStorage
+
+parser = argparse.ArgumentParser(
+    description="Compare size and backoff lookup latency of ngram storages."
+)
+parser.add_argument("--input", type=Path, required=True, help="Training text file.")
+parser.add_argument(
+    "--ngram", type=int, nargs="+", default=[4, 5, 6], help="Orders to measure."
+)
+parser.add_argument("--queries", type=int, default=20000, help="Lookups per storage.")
+parser.add_argument("--seed", type=int, default=0, help="Query sampling seed.")
+
+
+def make_queries(tokens, width, count, vocabulary_size, random_state):
+    starts = random_state.integers(len(tokens) - width, size=count)
+    queries = tokens[starts[:, None] + np.arange(width)]
+    # a half of the queries start with a random token, so lookups back off
+    misses = random_state.random(count) < 0.5
+    queries[misses, 0] = random_state.integers(vocabulary_size, size=misses.sum())
+    return [tuple(query) for query in queries.tolist()]
+
+
+def measure(storage, queries):
+    started = time.perf_counter()
+    for query in queries:
+        storage.longest_suffix(query)
+    return (time.perf_counter() - started) / len(queries)
+
+
+def main():
+    args = parser.parse_args()
+    text = args.input.read_text()
+    print(
+        f"{'ngram':>5} {'storage':>7} {'contexts':>9} {'memory MB':>10} "
+        f"{'pickle MB':>10} {'lookup us':>10}"
+    )
+    for ngram in args.ngram:
+        dictionary = Dictionary()
+        model = NGramModel(storage=DictStorage())
+        counter = NGramCounter(dictionary=dictionary, ngram=ngram)
+        counter.fit(model, raw_text=text)
+        tokens, _ = counter.encode(text)
+        queries = make_queries(
+            tokens,
+            ngram,
+            args.queries,
+            len(dictionary) + 1,
+            np.random.default_rng(args.seed),
+        )
+
+        storages = {"dict": model._storage}
+        for name, storage in (("array", ArrayStorage()), ("trie", TrieStorage())):
+            storage.update(model._storage.counts())
+            storages[name] = storage
+        for name, storage in storages.items():
+            storage.longest_suffix(queries[0])
+            print(
+                f"{ngram:>5} {name:>7} {len(storage):>9} "
+                f"{storage.memory_usage() / 2**20:>10.2f} "
+                f"{len(pickle.dumps(storage)) / 2**20:>10.2f} "
+                f"{measure(storage, queries) * 1e6:>10.2f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
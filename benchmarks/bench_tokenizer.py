@@ -0,0 +1,48 @@
+import argparse
+import time
+from pathlib import Path
+
+from src.dataset import SentenceSplitter
+from src.dictionary import Dictionary
+from src.tokenizer import Tokenizer
+
+parser = argparse.ArgumentParser(
+    description="Compare Tokenizer throughput against the SentenceSplitter passes."
+)
+parser.add_argument("--input", type=Path, nargs="+", required=True, help="Texts.")
+parser.add_argument("--repeat", type=int, default=3, help="Timing repetitions.")
+
+
+def split_tokens(text):
+    dictionary = Dictionary()
+    splitter = SentenceSplitter()
+    sentences = splitter.split(splitter.preprocess(text))
+    return [[dictionary.observe(word) for word in words] for words in sentences]
+
+
+def tokenize_tokens(text):
+    return list(Tokenizer(Dictionary()).tokenize(text))
+
+
+def main():
+    args = parser.parse_args()
+    text = "\n".join(path.read_text() for path in args.input)
+    megabytes = len(text.encode()) / 2**20
+
+    timings = {}
+    for name, tokenize in (("splitter", split_tokens), ("tokenizer", tokenize_tokens)):
+        best = float("inf")
+        for _ in range(args.repeat):
+            started = time.perf_counter()
+            result = tokenize(text)
+            best = min(best, time.perf_counter() - started)
+        timings[name] = (best, result)
+
+    assert timings["splitter"][1] == timings["tokenizer"][1], "tokens differ"
+    print(f"input:     {megabytes:.2f} MB")
+    for name, (seconds, _) in timings.items():
+        print(f"{name + ':':<10} {megabytes / seconds:.2f} MB/s")
+
+
+if __name__ == "__main__":
+    main()
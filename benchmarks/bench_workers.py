@@ -0,0 +1,66 @@
+import argparse
+import os
+import time
+from pathlib import Path
+
+from src.dictionary import Dictionary
+from src.model import NGramModel
+from src.profiling import PROFILER
+from src.stream import ChunkReader, iter_files
+from src.trainer import Trainer
+
+parser = argparse.ArgumentParser(
+    description="Compare bulk training with --workers processes against a serial run."
+)
+parser.add_argument("--input-dir", type=Path, required=True, help="Training texts.")
+parser.add_argument("--ngram", type=int, default=3, help="Order to train.")
+parser.add_argument(
+    "--workers", type=int, nargs="+", default=[1, 2, 4], help="Worker counts."
+)
+parser.add_argument("--chunk-size", type=int, default=1, help="Chunk size in MB.")
+
+# the work left in the parent process, workers tokenize and count the rest
+PARENT_PHASES = ("tokenize", "count", "merge", "ngram_update")
+
+
+def train(args, workers: int):
+    trainer = Trainer(
+        ngram_model=NGramModel(),
+        dictionary=Dictionary(),
+        embedder=None,
+        ngram=args.ngram,
+        bulk=True,
+        chunk_size=args.chunk_size << 20,
+        workers=workers,
+    )
+    texts = ChunkReader(chunk_size=args.chunk_size << 20).read_files(
+        list(iter_files(args.input_dir))
+    )
+    PROFILER.start()
+    started = time.perf_counter()
+    # Trainer.fit without the embeddings, they take the same time either way
+    trainer._run_iterative(trainer._fit_texts(texts))
+    trainer._ngram_model.flush()
+    seconds = time.perf_counter() - started
+    PROFILER.stop()
+    phases = PROFILER.report()["phases"]
+    parent = sum(phases[name]["seconds"] for name in PARENT_PHASES if name in phases)
+    return trainer, seconds, parent
+
+
+def main():
+    args = parser.parse_args()
+    print(f"CPUs: {os.cpu_count()}")
+    print(f"{'workers':>7} {'seconds':>8} {'parent s':>9} {'speedup':>8}")
+    expected = serial = None
+    for workers in args.workers:
+        trainer, seconds, parent = train(args, workers)
+        counts = list(trainer._ngram_model._storage._ngram_mapping.items())
+        if expected is None:
+            expected, serial = counts, seconds
+        assert counts == expected, f"{workers} workers counted differently"
+        print(f"{workers:>7} {seconds:>8.2f} {parent:>9.2f} {serial / seconds:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+import argparse
+import json
+import sys
+from pathlib import Path
+
+parser = argparse.ArgumentParser(
+    description="Compare two benchmarks.run results and flag regressions."
+)
+parser.add_argument("baseline", type=Path, help="Earlier results JSON.")
+parser.add_argument("candidate", type=Path, help="Later results JSON.")
+parser.add_argument(
+    "--threshold",
+    type=float,
+    default=0.1,
+    help="Relative change that counts as a regression.",
+)
+
+HIGHER_IS_BETTER = {"tokens_per_second"}
+INFORMATIONAL = {"tokens", "train_seconds"}
+
+
+def main():
+    args = parser.parse_args()
+    baseline_report = json.loads(args.baseline.read_text())
+    candidate_report = json.loads(args.candidate.read_text())
+    for name, value in baseline_report["arguments"].items():
+        if candidate_report["arguments"].get(name) != value:
+            print(
+                f"note: {name} differs, {value} vs "
+                f"{candidate_report['arguments'].get(name)}"
+            )
+    baseline = baseline_report["results"]
+    candidate = candidate_report["results"]
+
+    regressions = 0
+    print(
+        f"{'case':<32} {'metric':<34} {'baseline':>12} {'candidate':>12} {'change':>8}"
+    )
+    for case in sorted(baseline.keys() & candidate.keys()):
+        for metric in sorted(baseline[case].keys() & candidate[case].keys()):
+            if metric in INFORMATIONAL:
+                continue
+            old, new = baseline[case][metric], candidate[case][metric]
+            change = (new - old) / old if old else 0.0
+            worse = -change if metric in HIGHER_IS_BETTER else change
+            flag = ""
+            if worse > args.threshold:
+                flag = "REGRESSION"
+                regressions += 1
+            elif worse < -args.threshold:
+                flag = "improved"
+            print(
+                f"{case:<32} {metric:<34} {old:>12.4g} {new:>12.4g} "
+                f"{change:>+8.1%} {flag}"
+            )
+    for case in sorted(baseline.keys() ^ candidate.keys()):
+        print(f"{case:<32} only in {'baseline' if case in baseline else 'candidate'}")
+    print(f"{regressions} regressions over {args.threshold:.0%}")
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
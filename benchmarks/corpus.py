@@ -0,0 +1,68 @@
+import argparse
+from pathlib import Path
+from typing import List
+
+import numpy as np
+from numpy.random import Generator
+
+CONSONANTS = "бвгджзйклмнпрстфхцчшщ"
+VOWELS = "аеиоуыэюя"
+TERMINATORS = (". ", ". ", ". ", "! ", "? ", ".\n")
+
+parser = argparse.ArgumentParser(
+    description="Deterministic synthetic Cyrillic corpus for benchmarks."
+)
+parser.add_argument("--size", type=float, default=1, help="Corpus size in MB.")
+parser.add_argument("--seed", type=int, default=0, help="Generator seed.")
+parser.add_argument("--output", type=Path, required=True, help="Output text file.")
+
+
+def make_vocabulary(size: int, random_state: Generator) -> List[str]:
+    syllables = np.array([c + v for c in CONSONANTS for v in VOWELS])
+    vocabulary, seen = [], set()
+    while len(vocabulary) < size:
+        length = int(random_state.integers(1, 5))
+        word = "".join(random_state.choice(syllables, size=length))
+        if word not in seen:
+            seen.add(word)
+            vocabulary.append(word)
+    return vocabulary
+
+
+def make_corpus(size: int, seed: int = 0, vocabulary_size: int = 20000) -> str:
+    """About ``size`` bytes of Zipf distributed words with bigram structure."""
+    random_state = np.random.default_rng(seed)
+    vocabulary = np.array(make_vocabulary(vocabulary_size, random_state))
+    probabilities = 1 / np.arange(1, vocabulary_size + 1) ** 1.1
+    probabilities /= probabilities.sum()
+    followers = random_state.choice(
+        vocabulary_size, size=(vocabulary_size, 4), p=probabilities
+    )
+
+    # a word takes about 12 bytes of utf-8 with its separator
+    word_count = size // 12 + 1
+    words = random_state.choice(vocabulary_size, size=word_count, p=probabilities)
+    follow = random_state.random(word_count) < 0.6
+    choices = random_state.integers(4, size=word_count)
+    for index in np.flatnonzero(follow[1:]) + 1:
+        words[index] = followers[words[index - 1], choices[index]]
+
+    ends = np.cumsum(random_state.integers(3, 20, size=word_count // 3 + 1))
+    ends = ends[ends < word_count]
+    terminators = random_state.choice(len(TERMINATORS), size=len(ends))
+    sentences = []
+    for start, end, terminator in zip(
+        np.concatenate(([0], ends[:-1])), ends, terminators
+    ):
+        sentence = " ".join(vocabulary[words[start:end]])
+        sentences.append(sentence.capitalize() + TERMINATORS[terminator])
+    return "".join(sentences)
+
+
+def main():
+    args = parser.parse_args()
+    args.output.write_text(make_corpus(int(args.size * 2**20), seed=args.seed))
+
+
+if __name__ == "__main__":
+    main()
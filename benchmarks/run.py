@@ -0,0 +1,215 @@
+import argparse
+import json
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from math import inf
+from pathlib import Path
+from typing import Dict, List
+
+import numpy as np
+
+from benchmarks.corpus import make_corpus
+
+parser = argparse.ArgumentParser(
+    description="Measure training and generation performance, results go to JSON."
+)
+parser.add_argument(
+    "--sizes",
+    type=float,
+    nargs="*",
+    default=[1, 4],
+    help="Synthetic corpus sizes in MB.",
+)
+parser.add_argument(
+    "--data",
+    type=Path,
+    nargs="*",
+    default=sorted(Path("data").glob("*.txt")),
+    help="Real corpora, each is benchmarked separately.",
+)
+parser.add_argument("--ngram", type=int, nargs="+", default=[2, 3, 4])
+parser.add_argument("--nsamples", type=int, nargs="+", default=[3, 10])
+parser.add_argument("--bulk", action="store_true", help="Train with bulk counting.")
+parser.add_argument("--storage", default="dict", help="train.py --storage value.")
+parser.add_argument("--model-format", default=".pkl", choices=[".pkl", ".bin"])
+parser.add_argument("--prompts", type=int, default=20, help="Generated texts.")
+parser.add_argument("--length", type=int, default=50, help="Words per text.")
+parser.add_argument(
+    "--repeat", type=int, default=3, help="Best of N for load and generation."
+)
+parser.add_argument("--output", type=Path, default="benchmark.json")
+parser.add_argument("--child", default=None, help=argparse.SUPPRESS)
+
+
+def peak_rss_mb() -> float:
+    # linux reports kilobytes, macos bytes
+    scale = 1 if sys.platform == "darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / 2**20
+
+
+def train_case(case: Dict) -> Dict:
+    from src.dictionary import Dictionary
+    from src.model import NGramModel
+    from src.stream import ChunkReader, iter_files
+    from src.trainer import Trainer
+    from train import STORAGES
+
+    trainer = Trainer(
+        ngram_model=NGramModel(storage=STORAGES[case["storage"]]()),
+        dictionary=Dictionary(),
+        embedder=None,
+        ngram=case["ngram"],
+        bulk=case["bulk"],
+    )
+    texts = ChunkReader(chunk_size=trainer._chunk_size).read_files(
+        list(iter_files(Path(case["input_dir"])))
+    )
+    started = time.perf_counter()
+    # Trainer.fit split in two, tokens/s measures counting alone
+    trainer._run_iterative(trainer._fit_texts(texts))
+    trainer._ngram_model.flush()
+    train_seconds = time.perf_counter() - started
+    started = time.perf_counter()
+    trainer._build_embeddings()
+    embedding_seconds = time.perf_counter() - started
+    trainer.save(Path(case["model"]))
+    tokens = int(trainer._dictionary.counts().sum())
+    return {
+        "tokens": tokens,
+        "train_seconds": train_seconds,
+        "tokens_per_second": tokens / train_seconds,
+        "embedding_seconds": embedding_seconds,
+        "train_peak_rss_mb": peak_rss_mb(),
+        "model_bytes": Path(case["model"]).stat().st_size,
+    }
+
+
+def generate_case(case: Dict) -> Dict:
+    from src.trainer import Trainer
+
+    load_seconds = inf
+    for _ in range(case["repeat"]):
+        started = time.perf_counter()
+        trainer = Trainer.load(Path(case["model"]))
+        load_seconds = min(load_seconds, time.perf_counter() - started)
+    result = {"load_seconds": load_seconds}
+    for nsamples in case["nsamples"]:
+        # nsamples only affects generation, no need to retrain
+        trainer._nsamples = nsamples
+        elapsed = inf
+        for _ in range(case["repeat"]):
+            started = time.perf_counter()
+            for seed in range(case["prompts"]):
+                trainer.continue_(None, word_count=case["length"], seed=seed)
+            elapsed = min(elapsed, time.perf_counter() - started)
+        result[f"token_latency_us/nsamples={nsamples}"] = (
+            elapsed / (case["prompts"] * case["length"]) * 1e6
+        )
+    result["generate_peak_rss_mb"] = peak_rss_mb()
+    return result
+
+
+CHILDREN = {"train": train_case, "generate": generate_case}
+
+
+def run_child(kind: str, case: Dict) -> Dict:
+    # a fresh interpreter per measurement keeps peak RSS and caches separate
+    completed = subprocess.run(
+        [sys.executable, "-m", "benchmarks.run", "--child", kind],
+        input=json.dumps(case),
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return json.loads(completed.stdout.splitlines()[-1])
+
+
+def make_corpora(
+    sizes: List[float], data: List[Path], workdir: Path
+) -> Dict[str, Path]:
+    corpora = {}
+    for size in sizes:
+        directory = workdir / f"synthetic-{size:g}mb"
+        directory.mkdir()
+        text = make_corpus(int(size * 2**20), seed=0)
+        (directory / "corpus.txt").write_text(text)
+        corpora[directory.name] = directory
+    for path in data:
+        directory = workdir / path.stem
+        directory.mkdir()
+        (directory / path.name).write_text(path.read_text())
+        corpora[path.stem] = directory
+    return corpora
+
+
+def describe_environment() -> Dict:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "date": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+    }
+
+
+def main():
+    args = parser.parse_args()
+    if args.child is not None:
+        print(json.dumps(CHILDREN[args.child](json.loads(sys.stdin.read()))))
+        return
+
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        workdir = Path(workdir)
+        for corpus, directory in make_corpora(args.sizes, args.data, workdir).items():
+            for ngram in args.ngram:
+                name = f"{corpus}/ngram={ngram}"
+                model = workdir / f"{corpus}-{ngram}{args.model_format}"
+                result = run_child(
+                    "train",
+                    {
+                        "input_dir": str(directory),
+                        "model": str(model),
+                        "ngram": ngram,
+                        "bulk": args.bulk,
+                        "storage": args.storage,
+                    },
+                )
+                result.update(
+                    run_child(
+                        "generate",
+                        {
+                            "model": str(model),
+                            "nsamples": args.nsamples,
+                            "prompts": args.prompts,
+                            "length": args.length,
+                            "repeat": args.repeat,
+                        },
+                    )
+                )
+                results[name] = result
+                print(name, json.dumps(result), file=sys.stderr)
+
+    arguments = {**vars(args), "data": list(map(str, args.data))}
+    del arguments["output"], arguments["child"]
+    report = {
+        "environment": describe_environment(),
+        "arguments": arguments,
+        "results": results,
+    }
+    args.output.write_text(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+import argparse
+import logging
+import time
+from pathlib import Path
+
+from src.trainer import Trainer
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+parser = argparse.ArgumentParser(
+    description="Utility for converting pickled models to the binary format."
+)
+parser.add_argument("--model", type=Path, required=True, help="Pickled model file.")
+parser.add_argument(
+    "--output", type=Path, default=None, help="Binary model file, .bin by default."
+)
+parser.add_argument(
+    "--shards",
+    type=int,
+    default=1,
+    help="Split the contexts into this many files loaded on demand by generation.",
+)
+
+
+def main():
+    args = parser.parse_args()
+    output_path = args.output or args.model.with_suffix(Trainer.BINARY_SUFFIX)
+
+    trainer = Trainer.load(args.model)
+    trainer.save_binary(output_path, shards=args.shards)
+
+    for path in (args.model, output_path):
+        started = time.perf_counter()
+        Trainer.load(path)
+        logger.info(
+            "%s: %s bytes, loaded in %.3f s",
+            path,
+            path.stat().st_size,
+            time.perf_counter() - started,
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,26 +1,74 @@
-import re
+import argparse
+import asyncio
+import logging
 from pathlib import Path
 
-from tqdm import tqdm
+from src.crawler import Crawler, WikipediaSource
 
-import wikipedia
+parser = argparse.ArgumentParser(
+    description="Utility for gathering training texts from wikipedia."
+)
+parser.add_argument(
+    "--output",
+    type=Path,
+    default=Path("data/downloads"),
+    help="Directory for gzip shards of fetched pages.",
+)
+parser.add_argument("--count", type=int, default=100, help="New pages to fetch.")
+parser.add_argument(
+    "--api-url",
+    default="https://ru.wikipedia.org/w/api.php",
+    help="MediaWiki API endpoint, a local server can stand in for it.",
+)
+parser.add_argument(
+    "--concurrency", type=int, default=8, help="Pages fetched at the same time."
+)
+parser.add_argument(
+    "--retries", type=int, default=3, help="Attempts after a failed request."
+)
+parser.add_argument(
+    "--backoff",
+    type=float,
+    default=1.0,
+    help="Seconds before the first retry, doubled on every next one.",
+)
+parser.add_argument(
+    "--shard-size",
+    type=int,
+    default=64,
+    help="Megabytes of compressed pages per shard file.",
+)
+parser.add_argument(
+    "--state",
+    type=Path,
+    default=None,
+    help="Log of fetched titles, .crawl-state.jsonl in --output by default.",
+)
+parser.add_argument(
+    "--log-level",
+    default="WARNING",
+    choices=logging._nameToLevel.keys(),
+    help="Print debug messages",
+)
 
-wikipedia.set_lang("ru")
 
-data = Path("data/downloads")
-extension = ".txt"
-data.mkdir(exist_ok=True)
-safe_name = re.compile(r"\W")
+def main():
+    args = parser.parse_args()
+    logging.basicConfig(level=logging._nameToLevel[args.log_level])
+    crawler = Crawler(
+        WikipediaSource(args.api_url),
+        args.output,
+        state_path=args.state,
+        concurrency=args.concurrency,
+        retries=args.retries,
+        backoff=args.backoff,
+        shard_size=args.shard_size << 20,
+    )
+    stats = asyncio.run(crawler.crawl(args.count))
+    print(
+        f"Fetched {stats.pages} pages, skipped {stats.skipped}, failed {stats.failed}"
+    )
 
-tasks = tqdm(wikipedia.random(100))
-for name in tasks:
-    tasks.set_description(f"{name:40}")
-    filepath = data / (safe_name.sub("_", name) + extension)
-    if filepath.exists():
-        continue
-    try:
-        page = wikipedia.page(name, auto_suggest=False, redirect=True, preload=False)
-    except wikipedia.DisambiguationError as e:
-        continue
-    with open(filepath, "w") as f:
-        f.write(page.content)
+
+if __name__ == "__main__":
+    main()
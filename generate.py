@@ -1,9 +1,10 @@
 import argparse
 import logging
 import os
+import sys
 from pathlib import Path
 
-from src.trainer import Trainer
+from src.profiling import PROFILER, profile_run
 
 
 def is_dir(path):
@@ -19,13 +20,134 @@ parser.add_argument("--prefix", type=str, nargs="+", help="First words of senten
 parser.add_argument(
     "--model", type=Path, default="model.pkl", help="File for loading model."
 )
+parser.add_argument(
+    "--prefix-file",
+    type=Path,
+    default=None,
+    help="File with one prefix per line, each is continued separately.",
+)
 parser.add_argument("--length", type=int, default=7, help="Word of resulting sentence.")
+parser.add_argument(
+    "--seed",
+    type=int,
+    default=None,
+    help="Random seed, prefix number N of --prefix-file uses seed + N.",
+)
+parser.add_argument(
+    "--ngram",
+    type=int,
+    default=None,
+    help="Ngram order for generation, up to the one the model was trained with.",
+)
+parser.add_argument(
+    "--resident-shards",
+    type=int,
+    default=4,
+    help="Shards of a sharded model kept in memory, the least recently used one "
+    "is dropped to load another.",
+)
+parser.add_argument(
+    "--workers",
+    type=int,
+    default=1,
+    help="Continue prefixes of --prefix-file in this many threads, results for "
+    "a seed do not change.",
+)
+parser.add_argument(
+    "--processes",
+    action="store_true",
+    help="Use --workers processes instead of threads, each loads the model.",
+)
+parser.add_argument(
+    "--stream",
+    action="store_true",
+    help="Print words as they are generated instead of when the text is done.",
+)
+parser.add_argument(
+    "--server",
+    type=str,
+    default=None,
+    help="Ask a running serve.py (http://host:port or unix:/path) instead of "
+    "loading the model.",
+)
 parser.add_argument(
     "--log-level",
     default="ERROR",
     choices=logging._nameToLevel.keys(),
     help="Print debug messages",
 )
+parser.add_argument(
+    "--profile",
+    type=Path,
+    default=None,
+    help="Write time spent per phase to this JSON file.",
+)
+parser.add_argument(
+    "--profile-stats",
+    type=Path,
+    default=None,
+    help="Also dump cProfile stats to this file, see python -m pstats.",
+)
+parser.add_argument(
+    "--profile-memory",
+    action="store_true",
+    help="Add net allocated bytes per phase to --profile, slows the run down.",
+)
+
+
+def generate(args, prefixes, seeds):
+    if args.server is not None:
+        # the client never imports the model code, which keeps startup cheap
+        from src.client import GenerationClient
+
+        client = GenerationClient(args.server)
+        return [
+            client.generate(prefix, length=args.length, seed=seed, ngram=args.ngram)
+            for prefix, seed in zip(prefixes, seeds)
+        ]
+
+    if args.workers > 1:
+        with PROFILER.phase("import"):
+            from src.pool import GenerationPool
+
+        with GenerationPool(
+            args.model,
+            workers=args.workers,
+            processes=args.processes,
+            resident_shards=args.resident_shards,
+        ) as pool:
+            return pool.continue_many(
+                prefixes, word_count=args.length, seeds=seeds, ngram=args.ngram
+            )
+
+    with PROFILER.phase("import"):
+        from src.trainer import Trainer
+
+    trainer = Trainer.load(args.model, resident_shards=args.resident_shards)
+    results = trainer.continue_many(
+        prefixes, word_count=args.length, seeds=seeds, ngram=args.ngram
+    )
+    if (shard_info := trainer.shard_info()) is not None:
+        logging.getLogger(__name__).info(
+            "Loaded %s shard files, evicted %s", shard_info.loads, shard_info.evictions
+        )
+    return results
+
+
+def stream(args, prefixes, seeds):
+    with PROFILER.phase("import"):
+        from src.trainer import Trainer
+
+    trainer = Trainer.load(args.model, resident_shards=args.resident_shards)
+    for number, (prefix, seed) in enumerate(zip(prefixes, seeds)):
+        if number:
+            sys.stdout.write("\n\n")
+        for piece in trainer.stream(
+            prefix, word_count=args.length, seed=seed, ngram=args.ngram
+        ):
+            sys.stdout.write(piece)
+            sys.stdout.flush()
+    sys.stdout.write("\n")
 
 
 def main():
@@ -34,16 +156,31 @@ def main():
     logging.basicConfig(level=level)
     logger = logging.getLogger(__name__)
 
-    model_path = args.model
-    sentence_prefix = args.prefix
-    word_count = args.length
+    if args.prefix_file is not None:
+        prefixes = [
+            line.split() or None for line in args.prefix_file.read_text().splitlines()
+        ]
+        seeds = [
+            None if args.seed is None else args.seed + i for i in range(len(prefixes))
+        ]
+    else:
+        prefixes = [args.prefix]
+        seeds = [args.seed]
+
+    if args.stream and (args.server is not None or args.workers > 1):
+        parser.error("--stream generates with a local model in one thread")
 
-    trainer = Trainer.load(model_path)
+    if args.stream:
+        with profile_run(args.profile, args.profile_stats, args.profile_memory):
+            stream(args, prefixes, seeds)
+        return
 
-    result = trainer.continue_(sentence=sentence_prefix, word_count=word_count)
+    with profile_run(args.profile, args.profile_stats, args.profile_memory):
+        results = generate(args, prefixes, seeds)
 
-    logger.debug("Resulting sentence: %s", result)
-    print(result)
+    for result in results:
+        logger.debug("Resulting sentence: %s", result)
+    print("\n\n".join(results))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,57 @@
+import argparse
+import logging
+from pathlib import Path
+
+from src.corpus_cache import TokenCorpus, build_cache
+from src.stream import iter_files
+
+parser = argparse.ArgumentParser(
+    description="Utility for tokenizing a corpus once for repeated training runs."
+)
+parser.add_argument(
+    "--input-dir",
+    type=Path,
+    required=True,
+    help="Directory for training texts, .gz files are decompressed.",
+)
+parser.add_argument(
+    "--output",
+    type=Path,
+    default="corpus.cache",
+    help="Cache file for train.py --cache.",
+)
+parser.add_argument(
+    "--chunk-size",
+    type=int,
+    default=1 << 20,
+    help="Characters read at once, texts are split only at sentence ends.",
+)
+parser.add_argument(
+    "--force", action="store_true", help="Rebuild even an up to date cache."
+)
+parser.add_argument(
+    "--log-level",
+    default="INFO",
+    choices=logging._nameToLevel.keys(),
+    help="Print debug messages",
+)
+
+
+def main():
+    args = parser.parse_args()
+    logging.basicConfig(level=logging._nameToLevel[args.log_level])
+    logger = logging.getLogger(__name__)
+
+    paths = list(iter_files(args.input_dir))
+    if (
+        not args.force
+        and args.output.exists()
+        and TokenCorpus.load(args.output).is_current(paths)
+    ):
+        logger.info("%s is up to date", args.output)
+        return
+    build_cache(args.output, paths, chunk_size=args.chunk_size)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+import argparse
+import logging
+import time
+from pathlib import Path
+
+from src.storage import ShardedStorage
+from src.trainer import Trainer
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+parser = argparse.ArgumentParser(
+    description="Utility for dropping rare ngrams and unused words from a model."
+)
+parser.add_argument("--model", type=Path, required=True, help="Model to prune.")
+parser.add_argument(
+    "--output",
+    type=Path,
+    required=True,
+    help="File for the pruned model, a .bin suffix writes the binary format.",
+)
+parser.add_argument(
+    "--shards",
+    type=int,
+    default=1,
+    help="Split the contexts of a .bin --output into this many files loaded on "
+    "demand by generation.",
+)
+parser.add_argument(
+    "--min-count",
+    type=int,
+    default=2,
+    help="Drop successors seen fewer times after their context.",
+)
+parser.add_argument(
+    "--min-context-count",
+    type=int,
+    default=1,
+    help="Drop contexts seen fewer times.",
+)
+parser.add_argument(
+    "--entropy-threshold",
+    type=float,
+    default=0.0,
+    help="Also drop contexts whose backoff to a shorter one changes the model by "
+    "less relative entropy, e.g. 1e-7.",
+)
+parser.add_argument(
+    "--length", type=int, default=20, help="Words per sentence for the latency test."
+)
+parser.add_argument(
+    "--samples", type=int, default=50, help="Sentences for the latency test."
+)
+
+
+def model_size(path: Path, trainer: Trainer) -> int:
+    """Bytes of ``path`` and of the shard files of a sharded model."""
+    size = path.stat().st_size
+    info = trainer.shard_info()
+    if info is not None:
+        size += sum(
+            ShardedStorage.shard_path(path, index).stat().st_size
+            for index in range(info.shards)
+        )
+    return size
+
+
+def measure(path: Path, length: int, samples: int) -> dict:
+    started = time.perf_counter()
+    trainer = Trainer.load(path)
+    load_seconds = time.perf_counter() - started
+    started = time.perf_counter()
+    for seed in range(samples):
+        trainer.continue_(None, word_count=length, seed=seed)
+    return {
+        "size": model_size(path, trainer),
+        "load": load_seconds,
+        "latency": (time.perf_counter() - started) / max(samples, 1),
+        "contexts": trainer.context_count(),
+        "words": len(trainer._dictionary),
+    }
+
+
+def main():
+    args = parser.parse_args()
+    if args.shards > 1 and args.output.suffix != Trainer.BINARY_SUFFIX:
+        parser.error(f"--shards needs a {Trainer.BINARY_SUFFIX} --output")
+
+    trainer = Trainer.load(args.model)
+    trainer.prune(
+        min_count=args.min_count,
+        min_context_count=args.min_context_count,
+        entropy_threshold=args.entropy_threshold,
+    )
+    trainer.save(args.output, shards=args.shards)
+
+    before = measure(args.model, args.length, args.samples)
+    after = measure(args.output, args.length, args.samples)
+    rows = (
+        ("size", "{:,} bytes"),
+        ("contexts", "{:,}"),
+        ("words", "{:,}"),
+        ("load", "{:.3f} s"),
+        ("latency", "{:.2f} ms"),
+    )
+    print(f"{'':10}{'before':>18}{'after':>18}{'change':>10}")
+    for name, fmt in rows:
+        scale = 1000 if name == "latency" else 1
+        old, new = before[name] * scale, after[name] * scale
+        change = f"{(new - old) / old:+.1%}" if old else ""
+        print(f"{name:10}{fmt.format(old):>18}{fmt.format(new):>18}{change:>10}")
+
+
+if __name__ == "__main__":
+    main()
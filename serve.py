@@ -0,0 +1,77 @@
+import argparse
+import logging
+from pathlib import Path
+
+from src.server import GenerationServer, make_http_server
+
+parser = argparse.ArgumentParser(
+    description="Local generation server keeping the model loaded between requests."
+)
+parser.add_argument(
+    "--model", type=Path, default="model.pkl", help="File for loading model."
+)
+parser.add_argument("--host", type=str, default="127.0.0.1", help="Address to bind.")
+parser.add_argument("--port", type=int, default=8000, help="Port to bind.")
+parser.add_argument(
+    "--socket",
+    type=Path,
+    default=None,
+    help="Serve on a unix socket instead of --host and --port.",
+)
+parser.add_argument(
+    "--max-batch",
+    type=int,
+    default=32,
+    help="Concurrent requests generated together in one batch.",
+)
+parser.add_argument(
+    "--resident-shards",
+    type=int,
+    default=4,
+    help="Shards of a sharded model kept in memory, the least recently used one "
+    "is dropped to load another.",
+)
+parser.add_argument(
+    "--watch",
+    type=float,
+    default=None,
+    help="Check the model file every N seconds and reload it when it changes.",
+)
+parser.add_argument(
+    "--log-level",
+    default="INFO",
+    choices=logging._nameToLevel.keys(),
+    help="Print debug messages",
+)
+
+
+def main():
+    args = parser.parse_args()
+    level = logging._nameToLevel[args.log_level]
+    logging.basicConfig(level=level)
+    logger = logging.getLogger(__name__)
+
+    generation = GenerationServer(
+        args.model,
+        max_batch=args.max_batch,
+        watch_interval=args.watch,
+        resident_shards=args.resident_shards,
+    )
+    http_server = make_http_server(
+        generation, host=args.host, port=args.port, unix_socket=args.socket
+    )
+    generation.start()
+    logger.info("Serving %s on %s", args.model, args.socket or (args.host, args.port))
+    try:
+        http_server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        http_server.server_close()
+        generation.stop()
+        if args.socket is not None:
+            args.socket.unlink(missing_ok=True)
+
+
+if __name__ == "__main__":
+    main()
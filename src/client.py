@@ -0,0 +1,64 @@
+import http.client
+import json
+import socket
+from typing import Dict, List, Optional
+from urllib.parse import urlsplit
+
+
+class GenerationClientError(Exception):
+    pass
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path: str, timeout: Optional[float] = None):
+        super().__init__("localhost", timeout=timeout)
+        self._path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self._path)
+
+
+class GenerationClient:
+    """Talks to serve.py, ``server`` is ``http://host:port`` or ``unix:/path``."""
+
+    def __init__(self, server: str, timeout: Optional[float] = None):
+        self._server = server
+        self._timeout = timeout
+
+    def generate(
+        self,
+        prefix: Optional[List[str]],
+        length: int,
+        seed: Optional[int] = None,
+        ngram: Optional[int] = None,
+    ) -> str:
+        payload = {"prefix": prefix, "length": length, "seed": seed, "ngram": ngram}
+        return self._request("POST", "/generate", payload)["text"]
+
+    def reload(self, model_path: Optional[str] = None) -> Dict:
+        return self._request("POST", "/reload", {"model": model_path})
+
+    def stats(self) -> Dict:
+        return self._request("GET", "/stats")
+
+    def _connect(self) -> http.client.HTTPConnection:
+        if self._server.startswith("unix:"):
+            return UnixHTTPConnection(self._server[len("unix:") :], self._timeout)
+        url = urlsplit(self._server)
+        return http.client.HTTPConnection(url.hostname, url.port, self._timeout)
+
+    def _request(self, method: str, path: str, payload: Optional[Dict] = None) -> Dict:
+        connection = self._connect()
+        try:
+            body = None if payload is None else json.dumps(payload).encode()
+            headers = {"Content-Type": "application/json"}
+            connection.request(method, path, body=body, headers=headers)
+            response = connection.getresponse()
+            data = json.loads(response.read())
+        finally:
+            connection.close()
+        if response.status != 200:
+            raise GenerationClientError(data.get("error", response.reason))
+        return data
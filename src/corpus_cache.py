@@ -0,0 +1,146 @@
+import logging
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+from numpy import ndarray
+
+from src.dictionary import Dictionary, MappedDictionary
+from src.model_file import read_model_file, write_model_file
+from src.profiling import PROFILER
+from src.stream import ChunkReader, iter_files
+from src.tokenizer import Tokenizer
+
+logger = logging.getLogger(__name__)
+
+CACHE_MAGIC = b"TGUCORPS"
+
+
+class CorpusCacheError(Exception):
+    pass
+
+
+def file_stat(path: Path) -> List[int]:
+    stat = path.stat()
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+class TokenCorpus:
+    """Memory-mapped token codes of a corpus with sentence offsets and vocabulary.
+
+    Sentences of an input file are consecutive, ``files`` maps its resolved path
+    to size, mtime and the range of its sentences.
+    """
+
+    def __init__(self, metadata: Dict, arrays: Dict[str, ndarray]):
+        self.tokenizer: str = metadata["tokenizer"]
+        self.files: Dict[str, List[int]] = metadata["files"]
+        self.tokens = arrays["tokens"]
+        self.sentence_offsets = arrays["sentence_offsets"]
+        self.dictionary = MappedDictionary(
+            vocab_offsets=arrays["vocab_offsets"],
+            vocab_buffer=arrays["vocab_buffer"],
+            vocab_sorted=arrays["vocab_sorted"],
+            vocab_counts=arrays["vocab_counts"],
+        )
+
+    @classmethod
+    def load(cls, path: Path) -> "TokenCorpus":
+        return cls(*read_model_file(path, magic=CACHE_MAGIC))
+
+    def is_current(self, paths: List[Path]) -> bool:
+        if self.tokenizer != Tokenizer(Dictionary()).fingerprint():
+            return False
+        try:
+            stats = {str(path.resolve()): file_stat(path) for path in paths}
+        except FileNotFoundError:
+            return False
+        return stats == {file: entry[:2] for file, entry in self.files.items()}
+
+    def blocks(
+        self, file: str, block_size: int = 1 << 20
+    ) -> Iterator[Tuple[ndarray, ndarray]]:
+        """Tokens and sentence lengths of a file, about ``block_size`` tokens at once."""
+        first, last = self.files[file][2:]
+        offsets = self.sentence_offsets[first : last + 1]
+        while len(offsets) > 1:
+            end = max(int(np.searchsorted(offsets, offsets[0] + block_size)), 2)
+            block = offsets[:end]
+            yield self.tokens[block[0] : block[-1]], np.diff(block)
+            offsets = offsets[end - 1 :]
+
+    def token_counts(self, files: List[str]) -> ndarray:
+        counts = np.zeros(len(self.dictionary) + 1, dtype=np.int64)
+        for file in files:
+            for tokens, _ in self.blocks(file):
+                counts += np.bincount(tokens, minlength=len(counts))
+        return counts
+
+
+def _map_spilled(path: Path, dtype: type) -> ndarray:
+    if path.stat().st_size == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r")
+
+
+def build_cache(path: Path, paths: List[Path], chunk_size: int = 1 << 20) -> None:
+    dictionary = Dictionary()
+    tokenizer = Tokenizer(dictionary)
+    files = {}
+    first = sentence_count = token_count = 0
+    # tokens and sentence offsets go to disk chunk by chunk, not kept in memory
+    tokens_path = path.with_name(f"{path.name}.tokens.tmp")
+    offsets_path = path.with_name(f"{path.name}.offsets.tmp")
+    try:
+        with tokens_path.open("wb") as tokens_fp, offsets_path.open("wb") as offsets_fp:
+            offsets_fp.write(np.zeros(1, dtype=np.int64).tobytes())
+            texts = ChunkReader(chunk_size=chunk_size).read_files(paths)
+            for text, file in PROFILER.iterate("read", texts):
+                text_tokens, text_lengths = tokenizer.encode(text)
+                tokens_fp.write(text_tokens.astype(np.uint32).tobytes())
+                offsets_fp.write((token_count + np.cumsum(text_lengths)).tobytes())
+                token_count += len(text_tokens)
+                sentence_count += len(text_lengths)
+                if file is not None:
+                    stat = file_stat(file)
+                    files[str(file.resolve())] = [*stat, first, sentence_count]
+                    first = sentence_count
+
+        arrays = {
+            **dictionary.to_arrays(),
+            "tokens": _map_spilled(tokens_path, np.uint32),
+            "sentence_offsets": _map_spilled(offsets_path, np.int64),
+        }
+        metadata = {"tokenizer": tokenizer.fingerprint(), "files": files}
+        write_model_file(path, metadata=metadata, arrays=arrays, magic=CACHE_MAGIC)
+    finally:
+        tokens_path.unlink(missing_ok=True)
+        offsets_path.unlink(missing_ok=True)
+    logger.info(
+        "Cached %s tokens in %s sentences of %s files, %s words",
+        token_count,
+        sentence_count,
+        len(files),
+        len(dictionary),
+    )
+
+
+def open_corpus(
+    path: Path, input_dir: Optional[Path] = None, chunk_size: int = 1 << 20
+) -> TokenCorpus:
+    """Memory-maps the cache, rebuilding it first when the inputs or rules changed.
+
+    Without ``input_dir`` the inputs are the files the cache was built from.
+    """
+    paths = None if input_dir is None else list(iter_files(input_dir))
+    if path.exists():
+        corpus = TokenCorpus.load(path)
+        if paths is None:
+            paths = [Path(file) for file in corpus.files if Path(file).exists()]
+        if corpus.is_current(paths):
+            return corpus
+        logger.info("%s is outdated, rebuilding", path)
+    elif paths is None:
+        raise CorpusCacheError(f"{path} does not exist and no input files are given")
+    build_cache(path, paths, chunk_size=chunk_size)
+    return TokenCorpus.load(path)
@@ -0,0 +1,141 @@
+from typing import Iterator, List, Tuple
+
+import numpy as np
+from numpy import ndarray
+from numpy.lib.stride_tricks import sliding_window_view
+
+from src.dictionary import Dictionary
+from src.model import NGramModel
+from src.profiling import profiled
+from src.storage import PackedCounts
+from src.tokenizer import Tokenizer
+
+NGramCount = Tuple[Tuple[int, ...], int, int]
+
+_MAX_PACKED_KEY = 2**63
+
+
+class NGramCounter:
+    def __init__(
+        self,
+        dictionary: Dictionary,
+        ngram: int = 2,
+        min_ngram: int = 1,
+        min_word_length: int = 0,
+        batch_size: int = 1_000_000,
+    ):
+        self._dictionary = dictionary
+        self._ngram = ngram
+        self._min_ngram = min_ngram
+        self._batch_size = batch_size
+        self._tokenizer = Tokenizer(dictionary, min_word_length=min_word_length)
+
+    def encode(self, raw_text: str) -> Tuple[ndarray, ndarray]:
+        return self._tokenizer.encode(raw_text)
+
+    def count(self, tokens: ndarray, lengths: ndarray) -> Iterator[List[NGramCount]]:
+        for batch_tokens, batch_lengths in self._batches(tokens, lengths):
+            yield self._count_batch(batch_tokens, batch_lengths)
+
+    @profiled("count")
+    def count_packed(self, tokens: ndarray, lengths: ndarray) -> PackedCounts:
+        """The counts of ``count`` as arrays, ranked in the order it yields them."""
+        orders = max(self._ngram - self._min_ngram + 1, 0)
+        parts = []
+        rank_offset = 0
+        for batch_tokens, batch_lengths in self._batches(tokens, lengths):
+            packed = self._count_arrays(batch_tokens, batch_lengths)
+            parts.append(packed.remap(rank_offset=rank_offset))
+            rank_offset += len(batch_tokens) * orders
+        return PackedCounts.merge(parts)
+
+    def _batches(
+        self, tokens: ndarray, lengths: ndarray
+    ) -> Iterator[Tuple[ndarray, ndarray]]:
+        starts = np.concatenate(([0], np.cumsum(lengths)[:-1])).astype(np.int64)
+        # sentences shorter than ngram still give the lower orders
+        keep = lengths > self._min_ngram
+        starts, lengths = starts[keep], lengths[keep]
+
+        batch_start = 0
+        while batch_start < len(lengths):
+            batch_end = batch_start + 1
+            budget = lengths[batch_start]
+            while batch_end < len(lengths) and budget < self._batch_size:
+                budget += lengths[batch_end]
+                batch_end += 1
+            batch_starts = starts[batch_start:batch_end]
+            batch_lengths = lengths[batch_start:batch_end]
+            batch_tokens = np.concatenate(
+                [tokens[s : s + n] for s, n in zip(batch_starts, batch_lengths)]
+            )
+            yield batch_tokens, batch_lengths
+            batch_start = batch_end
+
+    def fit(self, model: NGramModel, raw_text: str) -> int:
+        tokens, lengths = self.encode(raw_text)
+        for counts in self.count(tokens, lengths):
+            model.update(counts)
+        return len(tokens)
+
+    @profiled("count")
+    def _count_batch(self, tokens: ndarray, lengths: ndarray) -> List[NGramCount]:
+        ranks, rows = [], []
+        packed = self._count_arrays(tokens, lengths)
+        for ngram_len, (ngrams, counts, ngram_ranks) in packed.orders.items():
+            ranks.append(ngram_ranks)
+            rows.extend(
+                zip(
+                    map(tuple, ngrams[:, :ngram_len].tolist()),
+                    ngrams[:, ngram_len].tolist(),
+                    counts.tolist(),
+                )
+            )
+
+        if not rows:
+            return []
+        order = np.argsort(np.concatenate(ranks), kind="stable")
+        return [rows[i] for i in order.tolist()]
+
+    def _count_arrays(self, tokens: ndarray, lengths: ndarray) -> PackedCounts:
+        orders = self._ngram - self._min_ngram + 1
+        starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+        sentence_starts = np.repeat(starts, lengths)
+        sentence_ends = np.repeat(starts + lengths, lengths)
+        sentence_lengths = np.repeat(lengths, lengths)
+        positions = np.arange(len(tokens))
+        base = int(tokens.max()) + 1
+
+        packed = {}
+        for ngram_len in range(self._min_ngram, self._ngram + 1):
+            if ngram_len >= len(tokens):
+                break
+            windows = sliding_window_view(tokens, ngram_len + 1)
+            window_positions = positions[: len(windows)]
+            valid = window_positions + ngram_len < sentence_ends[: len(windows)]
+            windows = windows[valid]
+            window_positions = window_positions[valid]
+            # position of each window in TokenDataset enumeration order
+            window_ranks = (
+                sentence_starts[window_positions] * orders
+                + (ngram_len - self._min_ngram) * sentence_lengths[window_positions]
+                + window_positions
+                - sentence_starts[window_positions]
+            )
+            if base ** (ngram_len + 1) < _MAX_PACKED_KEY:
+                keys = np.zeros(len(windows), dtype=np.int64)
+                for column in range(ngram_len + 1):
+                    keys = keys * base + windows[:, column]
+                _, first, counts = np.unique(
+                    keys, return_index=True, return_counts=True
+                )
+            else:
+                _, first, counts = np.unique(
+                    windows, axis=0, return_index=True, return_counts=True
+                )
+            packed[ngram_len] = (
+                windows[first].astype(np.int32),
+                counts.astype(np.int64),
+                window_ranks[first].astype(np.int64),
+            )
+        return PackedCounts(packed)
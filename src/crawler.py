@@ -0,0 +1,301 @@
+import asyncio
+import gzip
+import json
+import logging
+import os
+import random
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from itertools import count as counter
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, List, NamedTuple, Optional, Set
+from urllib.error import HTTPError
+from urllib.parse import urlencode
+
+from tqdm import tqdm
+
+logger = logging.getLogger(__name__)
+
+USER_AGENT = "text-gen-util/0.1 (training corpus crawler)"
+
+
+class PageSource:
+    """Titles and plain texts of pages, methods are awaited concurrently."""
+
+    async def random_titles(self, count: int) -> List[str]:
+        raise NotImplementedError
+
+    async def page(self, title: str) -> Optional[str]:
+        """Text of the page, None when the page should be skipped."""
+        raise NotImplementedError
+
+
+class WikipediaSource(PageSource):
+    def __init__(
+        self, api_url: str = "https://ru.wikipedia.org/w/api.php", timeout: float = 30
+    ):
+        self._api_url = api_url
+        self._timeout = timeout
+
+    async def random_titles(self, count: int) -> List[str]:
+        response = await self._query(list="random", rnnamespace=0, rnlimit=count)
+        return [page["title"] for page in response["query"]["random"]]
+
+    async def page(self, title: str) -> Optional[str]:
+        response = await self._query(
+            prop="extracts|pageprops", explaintext=1, redirects=1, titles=title
+        )
+        (page,) = response["query"]["pages"]
+        if page.get("missing") or "disambiguation" in page.get("pageprops", {}):
+            return None
+        return page.get("extract") or None
+
+    async def _query(self, **parameters) -> Dict:
+        query = urlencode(
+            {"action": "query", "format": "json", "formatversion": 2, **parameters}
+        )
+        loop = asyncio.get_running_loop()
+        # urllib blocks, the crawler sizes the default executor to its concurrency
+        return await loop.run_in_executor(None, self._get, f"{self._api_url}?{query}")
+
+    def _get(self, url: str) -> Dict:
+        request = urllib.request.Request(url, headers={"User-Agent": USER_AGENT})
+        with urllib.request.urlopen(request, timeout=self._timeout) as response:
+            return json.load(response)
+
+
+class CrawlState:
+    """Append-only log of shard commits, the fetched titles are derived from it.
+
+    A line is appended only after the shard bytes it covers are synced, so after
+    a crash everything past the last committed size is rewritten.
+    """
+
+    def __init__(self, path: Path):
+        self._path = path
+        self.titles: Set[str] = set()
+        self.shard_sizes: Dict[str, int] = {}
+        if not path.exists():
+            return
+        data = path.read_bytes()
+        complete = data[: data.rfind(b"\n") + 1]
+        if len(complete) < len(data):
+            logger.warning("Dropping a torn last line of %s", path)
+            with path.open("r+b") as fp:
+                fp.truncate(len(complete))
+        for line in complete.decode().splitlines():
+            record = json.loads(line)
+            self.titles.update(record["titles"])
+            self.titles.update(record["skipped"])
+            self.shard_sizes[record["shard"]] = record["size"]
+
+    def commit(self, shard: str, size: int, titles: List[str], skipped: List[str]):
+        record = {"shard": shard, "size": size, "titles": titles, "skipped": skipped}
+        with self._path.open("a") as fp:
+            fp.write(json.dumps(record, ensure_ascii=False) + "\n")
+            fp.flush()
+            os.fsync(fp.fileno())
+        self.titles.update(titles)
+        self.titles.update(skipped)
+        self.shard_sizes[shard] = size
+
+
+class ShardWriter:
+    """Appends pages to gzip shards, every flush adds one complete gzip member.
+
+    Every run starts a new shard, committed ones only grow within their run.
+    """
+
+    def __init__(
+        self,
+        directory: Path,
+        state: CrawlState,
+        shard_size: int = 64 << 20,
+        flush_size: int = 1 << 20,
+        prefix: str = "pages",
+    ):
+        self._directory = directory
+        self._state = state
+        self._shard_size = shard_size
+        self._flush_size = flush_size
+        self._prefix = prefix
+        self._texts: List[str] = []
+        self._titles: List[str] = []
+        self._skipped: List[str] = []
+        self._buffered = 0
+
+        # shards of earlier runs are never appended to, train.py --resume may
+        # have ingested them and skips files it has seen
+        self._index = 1 + max(
+            (
+                int(name[len(prefix) + 1 : -len(".txt.gz")])
+                for name in state.shard_sizes
+            ),
+            default=-1,
+        )
+        directory.mkdir(parents=True, exist_ok=True)
+        for path in directory.glob(f"{prefix}-*.txt.gz"):
+            committed = state.shard_sizes.get(path.name)
+            if committed is None:
+                # the first shard of an interrupted run, nothing of it committed
+                if path != self._path():
+                    raise FileExistsError(
+                        f"{path} is not in the crawl state, crawl with the state "
+                        "it was written with or move it away"
+                    )
+                logger.warning("Dropping uncommitted %s", path)
+                path.unlink()
+            elif path.stat().st_size > committed:
+                logger.warning("Dropping uncommitted tail of %s", path)
+                with path.open("r+b") as fp:
+                    fp.truncate(committed)
+
+    def write(self, title: str, text: str) -> None:
+        self._titles.append(title)
+        self._texts.append(text.strip() + "\n\n")
+        self._buffered += len(self._texts[-1])
+        if self._buffered >= self._flush_size:
+            self.flush()
+
+    def skip(self, title: str) -> None:
+        self._skipped.append(title)
+
+    def flush(self) -> None:
+        if not self._titles and not self._skipped:
+            return
+        path = self._path()
+        with path.open("ab") as fp:
+            if self._texts:
+                fp.write(gzip.compress("".join(self._texts).encode()))
+            fp.flush()
+            os.fsync(fp.fileno())
+            size = fp.tell()
+        self._state.commit(path.name, size, self._titles, self._skipped)
+        self._texts, self._titles, self._skipped = [], [], []
+        self._buffered = 0
+        if size >= self._shard_size:
+            self._index += 1
+
+    def _path(self) -> Path:
+        return self._directory / f"{self._prefix}-{self._index:05d}.txt.gz"
+
+
+class CrawlStats(NamedTuple):
+    pages: int
+    skipped: int
+    failed: int
+
+
+def is_retryable(error: Exception) -> bool:
+    if isinstance(error, HTTPError):
+        return error.code >= 500 or error.code == 429
+    return isinstance(error, (OSError, ValueError, asyncio.TimeoutError))
+
+
+class Crawler:
+    def __init__(
+        self,
+        source: PageSource,
+        output_dir: Path,
+        state_path: Optional[Path] = None,
+        concurrency: int = 8,
+        retries: int = 3,
+        backoff: float = 1.0,
+        shard_size: int = 64 << 20,
+        flush_size: int = 1 << 20,
+        batch_size: int = 100,
+    ):
+        self._source = source
+        self._concurrency = concurrency
+        self._retries = retries
+        self._backoff = backoff
+        self._batch_size = batch_size
+        self._state = CrawlState(
+            output_dir / ".crawl-state.jsonl" if state_path is None else state_path
+        )
+        self._writer = ShardWriter(
+            output_dir, self._state, shard_size=shard_size, flush_size=flush_size
+        )
+
+    async def crawl(self, count: int) -> CrawlStats:
+        """Fetches ``count`` pages not fetched by this or any previous crawl."""
+        loop = asyncio.get_running_loop()
+        loop.set_default_executor(ThreadPoolExecutor(self._concurrency))
+        self._seen = set(self._state.titles)
+        self._pending = 0
+        self._pages = self._skipped = self._failed = 0
+        self._finished = asyncio.Event()
+        queue = asyncio.Queue(maxsize=2 * self._concurrency)
+        with tqdm(total=count, unit="page") as self._progress:
+            workers = [
+                asyncio.create_task(self._work(queue)) for _ in range(self._concurrency)
+            ]
+            try:
+                await self._produce(queue, count)
+                for _ in workers:
+                    await queue.put(None)
+                await asyncio.gather(*workers)
+            finally:
+                for worker in workers:
+                    worker.cancel()
+                self._writer.flush()
+        return CrawlStats(self._pages, self._skipped, self._failed)
+
+    async def _produce(self, queue: asyncio.Queue, count: int) -> None:
+        exhausted = 0
+        while self._pages < count:
+            needed = count - self._pages - self._pending
+            if needed <= 0:
+                # skipped and failed pages are replaced once they finish
+                self._finished.clear()
+                await self._finished.wait()
+                continue
+            titles = await self._retry(self._source.random_titles, self._batch_size)
+            fresh = [
+                title for title in dict.fromkeys(titles) if title not in self._seen
+            ]
+            if not fresh:
+                exhausted += 1
+                if exhausted >= 3:
+                    logger.warning("The source returns only fetched titles, stopping")
+                    return
+                continue
+            exhausted = 0
+            for title in fresh[:needed]:
+                self._seen.add(title)
+                self._pending += 1
+                await queue.put(title)
+
+    async def _work(self, queue: asyncio.Queue) -> None:
+        while (title := await queue.get()) is not None:
+            try:
+                text = await self._retry(self._source.page, title)
+            except Exception as e:
+                # not committed, the next crawl tries it again
+                logger.warning("Cannot fetch %r: %s", title, e)
+                self._failed += 1
+            else:
+                if text is None:
+                    self._writer.skip(title)
+                    self._skipped += 1
+                else:
+                    self._writer.write(title, text)
+                    self._pages += 1
+                    self._progress.update()
+                    self._progress.set_description(f"{title[:40]:40}")
+            finally:
+                self._pending -= 1
+                self._finished.set()
+
+    async def _retry(self, function: Callable[..., Awaitable], *args):
+        for attempt in counter():
+            try:
+                return await function(*args)
+            except Exception as e:
+                if attempt >= self._retries or not is_retryable(e):
+                    raise
+                delay = self._backoff * 2**attempt * random.uniform(0.5, 1.5)
+                logger.debug(
+                    "Retrying %s%r in %.1fs: %s", function.__name__, args, delay, e
+                )
+                await asyncio.sleep(delay)
@@ -1,14 +1,53 @@
-import itertools
 import re
-from typing import List, Tuple, Dict
+from typing import List, Tuple
 
+import numpy as np
 import torch
 from torch.utils.data import Dataset
 
 from src.dictionary import Dictionary
+from src.tokenizer import Tokenizer
+
+
+class SentenceSplitter:
+    """Multi-pass reference for the rules Tokenizer applies in one pass."""
+
+    def __init__(self, min_word_length: int = 0):
+        self._min_word_length = min_word_length
+        self._whitespace = re.compile(r"\s")
+        self._digits = re.compile(r"\d")
+        self._latin = re.compile(r"[a-z]", flags=re.IGNORECASE)
+        self._sentence_terminators = re.compile(r"[^\s\w]|[_]")
+
+    def preprocess(self, raw_text: str) -> str:
+        text = raw_text.lower()
+        text = self._digits.sub(" ", text)
+        text = self._latin.sub(" ", text)
+        return text
+
+    def split(self, text: str) -> List[Tuple[str]]:
+        sentences = self._sentence_terminators.split(text)
+        return [
+            words for sentence in sentences if (words := self.split_words(sentence))
+        ]
+
+    def split_words(self, sentence: str) -> Tuple[str]:
+        words = self._whitespace.split(sentence)
+        # todo lemmatize?
+
+        def filter_(word):
+            return len(word) > self._min_word_length and word != ""
+
+        return tuple(filter(filter_, words))
 
 
 class TokenDataset(Dataset):
+    """Ngram windows over a flat token array, computed from the index.
+
+    Items are ordered by sentence, then by ngram length, then by position, a
+    sentence of n tokens gives windows of ngram lengths up to n - 1.
+    """
+
     def __init__(
         self,
         dictionary: Dictionary,
@@ -18,85 +57,63 @@ class TokenDataset(Dataset):
         min_word_length: int = 0,
     ):
         self._dictionary = dictionary
-        self._whitespace = re.compile(r"\s")
-        self._digits = re.compile(r"\d")
-        self._latin = re.compile(r"[a-z]", flags=re.IGNORECASE)
-        self._sentence_terminators = re.compile(r"[^\s\w]|[_]")
+        self._tokenizer = Tokenizer(dictionary, min_word_length=min_word_length)
 
-        self._clean_text = self._preprocess(raw_text)
         self._ngram = ngram
         self._min_ngram = min_ngram
         self._min_word_length = min_word_length
 
-        self._index_to_sentence_map, self._sentences = self._split_into_sentences(
-            self._clean_text
-        )
-
-        self._sentences_into_dictionary(self._sentences)
-
-    def get_tokens(self) -> List[int]:
-        return [
-            self._dictionary.encode(word) for word in itertools.chain(*self._sentences)
-        ]
-
-    def _preprocess(self, raw_text: str) -> str:
-        text = raw_text.lower()
-        text = self._digits.sub(" ", text)
-        text = self._latin.sub(" ", text)
-        return text
+        self._set_tokens(*self._tokenizer.encode(raw_text))
 
-    def _make_ngrams(
-        self, words: Tuple[str], initial_index: int, index_to_sentence_map
-    ) -> int:
-        processed = 0
+    @classmethod
+    def from_tokens(
+        cls,
+        dictionary: Dictionary,
+        tokens: np.ndarray,
+        lengths: np.ndarray,
+        ngram: int = 2,
+        min_ngram: int = 1,
+    ) -> "TokenDataset":
+        """Dataset over already encoded sentences, e.g. from a corpus cache."""
+        dataset = cls(dictionary, "", ngram=ngram, min_ngram=min_ngram)
+        dataset._set_tokens(tokens, lengths)
+        return dataset
+
+    def _set_tokens(self, tokens: np.ndarray, lengths: np.ndarray) -> None:
+        self._tokens = tokens
+        starts = np.cumsum(lengths) - lengths
+        keep = lengths > self._min_ngram
+        self._starts, self._lengths = starts[keep], lengths[keep]
+        # every ngram length n gives len - n windows, none when len <= n
+        windows = np.zeros(len(self._lengths), dtype=np.int64)
         for ngram_len in range(self._min_ngram, self._ngram + 1):
-            ngram_count = len(words) - ngram_len
-            for index in range(ngram_count):
-                index_to_sentence_map[initial_index + index] = (
-                    words[index : index + ngram_len],
-                    words[index + ngram_len : index + ngram_len + 1],
-                )
-            initial_index += ngram_count
-            processed += ngram_count
-        return processed
-
-    def _split_into_sentences(
-        self, text: str
-    ) -> Tuple[Dict[int, Tuple[Tuple[str], Tuple[str]]], List[List[str]]]:
-        sentences = self._sentence_terminators.split(text)
-        resulting_sentences = []
-        pair_count = 0
-        index_to_sentence_map = {}
-        for sentence in sentences:
-            if not (words := self._split_into_words(sentence)):
-                continue
-            if len(words) < self._ngram:
-                resulting_sentences.append(words)
-                continue
-            processed = self._make_ngrams(words, pair_count, index_to_sentence_map)
-            pair_count += processed
-            resulting_sentences.append(words)
-
-        return index_to_sentence_map, resulting_sentences
-
-    def _split_into_words(self, sentence: str) -> Tuple[str]:
-        words = self._whitespace.split(sentence)
-        # todo lemmatize?
+            windows += np.maximum(self._lengths - ngram_len, 0)
+        self._ends = np.cumsum(windows)
 
-        def filter_(word):
-            return len(word) > self._min_word_length and word != ""
+    def get_tokens(self) -> List[int]:
+        return self._tokens.tolist()
 
-        return tuple(filter(filter_, words))
+    def token_count(self) -> int:
+        return len(self._tokens)
 
-    def _sentences_into_dictionary(self, sentences):
-        self._dictionary.transform(itertools.chain(*sentences))
+    def _window(self, index: int) -> Tuple[int, int]:
+        sentence = int(np.searchsorted(self._ends, index, side="right"))
+        offset = index - int(self._ends[sentence - 1]) if sentence else index
+        length = int(self._lengths[sentence])
+        ngram_len = self._min_ngram
+        while offset >= length - ngram_len:
+            offset -= length - ngram_len
+            ngram_len += 1
+        return int(self._starts[sentence]) + offset, ngram_len
 
     def __len__(self):
-        return len(self._index_to_sentence_map)
+        return int(self._ends[-1]) if len(self._ends) else 0
 
     def __getitem__(self, index):
-        X, Y = self._index_to_sentence_map[index]
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        start, ngram_len = self._window(index)
         return (
-            torch.tensor([self._dictionary.encode(x) for x in X]),
-            torch.tensor([self._dictionary.encode(y) for y in Y]),
+            torch.from_numpy(self._tokens[start : start + ngram_len]),
+            torch.from_numpy(self._tokens[start + ngram_len : start + ngram_len + 1]),
         )
@@ -0,0 +1,282 @@
+import logging
+import re
+from hashlib import blake2b
+from pathlib import Path
+from typing import Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+from numpy import ndarray
+
+from src.dictionary import Dictionary
+from src.profiling import PROFILER
+from src.tokenizer import Tokenizer
+
+logger = logging.getLogger(__name__)
+
+_MIX = np.uint64(0x9E3779B97F4A7C15)
+
+
+def _stable_hashes(texts: Iterable[str]) -> ndarray:
+    # the builtin hash is salted per process, these match across runs and workers
+    digests = b"".join(blake2b(text.encode(), digest_size=8).digest() for text in texts)
+    return np.frombuffer(digests, dtype="<u8").astype(np.uint64)
+
+
+def _odd_multipliers(random_state: np.random.Generator, shape) -> ndarray:
+    values = random_state.integers(0, 1 << 63, size=shape, dtype=np.uint64)
+    return values * np.uint64(2) + np.uint64(1)
+
+
+class HashWindow:
+    """Bounded set of 64-bit hashes in two open-addressing generations.
+
+    When the current table is half full it becomes the previous one and the
+    oldest generation is forgotten, so at least the last ``capacity // 2``
+    distinct hashes are remembered.
+    """
+
+    def __init__(self, capacity: int):
+        bits = max(int(capacity).bit_length() - 1, 4)
+        self._capacity = 1 << bits
+        self._shift = np.uint64(64 - bits)
+        self._current = np.zeros(self._capacity, dtype=np.uint64)
+        self._previous = np.zeros(self._capacity, dtype=np.uint64)
+        self._size = 0
+        self.rotations = 0
+
+    @property
+    def nbytes(self) -> int:
+        return self._current.nbytes + self._previous.nbytes
+
+    def add(self, hashes: ndarray) -> ndarray:
+        """Adds ``hashes``, true for those seen before, earlier ones included."""
+        # zero marks empty slots
+        hashes = np.where(hashes == 0, np.uint64(1), hashes)
+        seen = np.zeros(len(hashes), dtype=bool)
+        step = self._capacity // 4
+        for start in range(0, len(hashes), step):
+            seen[start : start + step] = self._add(hashes[start : start + step])
+        return seen
+
+    def _add(self, hashes: ndarray) -> ndarray:
+        _, first = np.unique(hashes, return_index=True)
+        first.sort()
+        unique = hashes[first]
+        current = self._probe(self._current, unique, insert=False)
+        seen = np.ones(len(hashes), dtype=bool)
+        seen[first] = current | self._probe(self._previous, unique, insert=False)
+        if self._size + len(unique) - int(current.sum()) > self._capacity // 2:
+            self._current, self._previous = self._previous, self._current
+            self._current.fill(0)
+            self._size = 0
+            self.rotations += 1
+        # hashes of the previous generation move to the current one
+        self._probe(self._current, unique, insert=True)
+        return seen
+
+    def _probe(self, table: ndarray, hashes: ndarray, insert: bool) -> ndarray:
+        found = np.zeros(len(hashes), dtype=bool)
+        pending = np.arange(len(hashes))
+        slots = ((hashes * _MIX) >> self._shift).astype(np.int64)
+        mask = self._capacity - 1
+        while len(pending):
+            values = table[slots]
+            wanted = hashes[pending]
+            hit = values == wanted
+            found[pending[hit]] = True
+            done = hit | (values == 0)
+            if insert:
+                empty = values == 0
+                # hashes racing for one empty slot, the last write wins it
+                table[slots[empty]] = wanted[empty]
+                won = empty & (table[slots] == wanted)
+                self._size += int(won.sum())
+                done = hit | won
+            pending = pending[~done]
+            slots = (slots[~done] + 1) & mask
+        return found
+
+
+class DedupStats(NamedTuple):
+    documents: int
+    removed_documents: int
+    sentences: int
+    removed_sentences: int
+    tokens: int
+    removed_tokens: int
+
+
+class Deduplicator:
+    """Drops repeated sentences and near-duplicate documents from text chunks.
+
+    Documents are separated by blank lines. A document is a near-duplicate when
+    one of its LSH bands of MinHash values over word shingles matches an earlier
+    document, ``bands`` of ``permutations // bands`` rows catch documents with
+    Jaccard similarity above about ``(1 / bands) ** (bands / permutations)``.
+    Sentences of at least ``min_sentence_words`` words are dropped when the same
+    words were seen before. Kept sentences are written back as ``words.``, which
+    tokenizes to the same tokens.
+
+    Both hash sets are ``HashWindow``\\ s sharing ``memory_budget`` bytes, so the
+    memory stays flat and only duplicates older than the window are missed.
+    """
+
+    def __init__(
+        self,
+        memory_budget: int = 256 << 20,
+        shingle_size: int = 5,
+        permutations: int = 128,
+        bands: int = 16,
+        min_document_words: int = 32,
+        min_sentence_words: int = 3,
+        max_document_size: int = 4 << 20,
+        seed: int = 0,
+    ):
+        if permutations % bands:
+            raise ValueError(f"{bands} bands do not split {permutations} permutations")
+        # two generations of two sets of 8-byte hashes
+        capacity = memory_budget // 32
+        self._sentences = HashWindow(capacity)
+        self._bands = HashWindow(capacity)
+        self._shingle_size = shingle_size
+        self._bands_count = bands
+        self._min_document_words = max(min_document_words, shingle_size)
+        self._min_sentence_words = min_sentence_words
+        self._max_document_size = max_document_size
+        self._tokenizer = Tokenizer(Dictionary())
+        self._document_end = re.compile(r"\n[^\S\n]*\n")
+
+        random_state = np.random.default_rng(seed)
+        self._shingle_multipliers = _odd_multipliers(random_state, shingle_size)
+        self._permutation_multipliers = _odd_multipliers(
+            random_state, (permutations, 1)
+        )
+        self._permutation_offsets = _odd_multipliers(random_state, (permutations, 1))
+        self._band_multipliers = _odd_multipliers(random_state, permutations // bands)
+        self._band_offsets = _odd_multipliers(random_state, bands)
+
+        self._documents = self._removed_documents = 0
+        self._sentence_count = self._removed_sentences = 0
+        self._tokens = self._removed_tokens = 0
+
+    def stats(self) -> DedupStats:
+        return DedupStats(
+            self._documents,
+            self._removed_documents,
+            self._sentence_count,
+            self._removed_sentences,
+            self._tokens,
+            self._removed_tokens,
+        )
+
+    def filter(
+        self, texts: Iterable[Tuple[str, Optional[Path]]]
+    ) -> Iterator[Tuple[str, Optional[Path]]]:
+        """Deduplicated ``(text, path)`` chunks as read by ``ChunkReader.read_files``.
+
+        A document cut by a chunk boundary is carried over to the next chunk of
+        the same file, the chunk carrying the path ends the file. Documents over
+        ``max_document_size`` characters are split instead.
+        """
+        carry = ""
+        for text, path in texts:
+            text = carry + text
+            carry = ""
+            if path is None:
+                end = 0
+                for end_match in self._document_end.finditer(text):
+                    end = end_match.end()
+                if len(text) - end < self._max_document_size:
+                    carry = text[end:]
+                    text = text[:end]
+            with PROFILER.phase("dedup"):
+                text = self.deduplicate(text)
+            yield text, path
+        if carry:
+            with PROFILER.phase("dedup"):
+                text = self.deduplicate(carry)
+            yield text, None
+
+    def deduplicate(self, text: str) -> str:
+        documents = [
+            sentences
+            for document in self._document_end.split(text)
+            if (sentences := list(self._tokenizer.sentences(document)))
+        ]
+        self._documents += len(documents)
+        kept = self._drop_near_duplicates(documents)
+        sentences = [sentence for document in kept for sentence in document]
+        hashed = [
+            index
+            for index, sentence in enumerate(sentences)
+            if len(sentence) >= self._min_sentence_words
+        ]
+        seen = self._sentences.add(
+            _stable_hashes(" ".join(sentences[index]) for index in hashed)
+        )
+        repeated = {hashed[i] for i in np.flatnonzero(seen).tolist()}
+        lines = []
+        index = 0
+        for document in kept:
+            first = len(lines)
+            for sentence in document:
+                if index in repeated:
+                    self._removed_sentences += 1
+                    self._removed_tokens += len(sentence)
+                else:
+                    lines.append(" ".join(sentence) + ".")
+                index += 1
+            if len(lines) > first:
+                # a blank line keeps documents apart for the next filter
+                lines[-1] += "\n"
+        return "\n".join(lines) + "\n" if lines else ""
+
+    def _drop_near_duplicates(
+        self, documents: List[List[Tuple[str, ...]]]
+    ) -> List[List[Tuple[str, ...]]]:
+        sizes = [sum(map(len, document)) for document in documents]
+        self._sentence_count += sum(map(len, documents))
+        self._tokens += sum(sizes)
+        checked = [
+            index
+            for index, size in enumerate(sizes)
+            if size >= self._min_document_words
+        ]
+        if not checked:
+            return documents
+        keys = np.stack([self._band_keys(documents[index]) for index in checked])
+        seen = self._bands.add(keys.ravel()).reshape(keys.shape).any(axis=1)
+        duplicates = {checked[i] for i in np.flatnonzero(seen).tolist()}
+        kept = []
+        for index, document in enumerate(documents):
+            if index in duplicates:
+                self._removed_documents += 1
+                self._removed_sentences += len(document)
+                self._removed_tokens += sizes[index]
+            else:
+                kept.append(document)
+        return kept
+
+    def _band_keys(self, document: List[Tuple[str, ...]]) -> ndarray:
+        # words repeat, each distinct one is hashed once
+        codes = {}
+        indices = [
+            codes.setdefault(word, len(codes))
+            for sentence in document
+            for word in sentence
+        ]
+        words = _stable_hashes(codes)[indices]
+        count = len(words) - self._shingle_size + 1
+        shingles = np.zeros(count, dtype=np.uint64)
+        for offset, multiplier in enumerate(self._shingle_multipliers):
+            shingles += words[offset : offset + count] * multiplier
+        signature = np.full(
+            len(self._permutation_multipliers), np.iinfo(np.uint64).max, np.uint64
+        )
+        # bounded temporaries on long documents
+        for start in range(0, count, 4096):
+            block = shingles[None, start : start + 4096]
+            permuted = block * self._permutation_multipliers + self._permutation_offsets
+            np.minimum(signature, permuted.min(axis=1), out=signature)
+        bands = signature.reshape(self._bands_count, -1) * self._band_multipliers
+        return bands.sum(axis=1, dtype=np.uint64) * _MIX + self._band_offsets
@@ -1,4 +1,8 @@
-from typing import Iterable, List
+from itertools import repeat
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+from numpy import ndarray
 
 
 class Dictionary:
@@ -6,34 +10,239 @@ class Dictionary:
     UNKNOWN_CODE = -1
 
     def __init__(self):
-        self._word_to_code_map = {}
-        self._code_to_word_map = {}
-        self._current_length = self.UNKNOWN_CODE
-        self.observe(self.UNKNOWN)
+        self._set_words([self.UNKNOWN], [0])
+
+    @classmethod
+    def from_words(
+        cls, words: List[str], counts: Optional[Iterable[int]] = None
+    ) -> "Dictionary":
+        dictionary = cls()
+        counts = [0] * len(words) if counts is None else list(map(int, counts))
+        dictionary._set_words(list(words), counts)
+        return dictionary
+
+    def _set_words(self, words: List[str], counts: List[int]) -> None:
+        # codes index the word list, the strings are shared with the lookup map
+        self._words = words
+        self._counts = counts
+        self._word_to_code_map = dict(zip(words, range(len(words))))
 
     def transform(self, words: Iterable[str]) -> None:
         for word in words:
             self.observe(word)
 
-    def observe(self, word: str) -> int:
-        if not (code := self._word_to_code_map.get(word)):
-            self._current_length += 1
-            self._word_to_code_map[word] = self._current_length
-            self._code_to_word_map[self._current_length] = word
-            code = self._current_length
+    def observe(self, word: str, count: int = 1) -> int:
+        if (code := self._word_to_code_map.get(word)) is None:
+            code = self._word_to_code_map[word] = len(self._words)
+            self._words.append(word)
+            self._counts.append(0)
+        self._counts[code] += count
         return code
 
-    def encode_many(self, words: List[str]) -> List[int]:
-        return [self.encode(word) for word in words]
+    def union(self, other: "Dictionary", counts: Optional[ndarray] = None) -> ndarray:
+        """Adds the words of ``other`` and returns the mapping to own codes.
+
+        With explicit ``counts`` words counted zero times are not added.
+        """
+        mapping = np.zeros(len(other) + 1, dtype=np.int64)
+        skip_unseen = counts is not None
+        counts = (other.counts() if counts is None else counts).tolist()
+        for code, word in enumerate(other.decode_many(range(len(other) + 1))):
+            if word != self.UNKNOWN and (counts[code] or not skip_unseen):
+                mapping[code] = self.observe(word, counts[code])
+        return mapping
+
+    def counts(self) -> ndarray:
+        return np.array(self._counts, dtype=np.int64)
+
+    def prune(
+        self,
+        min_count: int = 1,
+        max_vocab: Optional[int] = None,
+        referenced: Optional[ndarray] = None,
+    ) -> ndarray:
+        """Keeps frequent words and renumbers them, the most frequent first.
+
+        ``referenced`` is a boolean mask over codes, words outside it are pruned
+        whatever their counts. Returns the mapping from old to new codes, pruned
+        words map to UNKNOWN_CODE and their counts go to UNKNOWN.
+        """
+        counts = self.counts()
+        order = np.argsort(-counts[1:], kind="stable") + 1
+        if referenced is not None:
+            order = order[referenced[order]]
+        keep = order[counts[order] >= min_count]
+        if max_vocab is not None:
+            keep = keep[:max_vocab]
+        mapping = np.full(len(counts), self.UNKNOWN_CODE, dtype=np.int64)
+        mapping[0] = 0
+        mapping[keep] = np.arange(1, len(keep) + 1)
+
+        unknown_count = int(counts.sum() - counts[keep].sum())
+        words = self.decode_many(keep)
+        self._set_words([self.UNKNOWN, *words], [unknown_count, *counts[keep].tolist()])
+        return mapping
+
+    def encode_many(self, words: Iterable[str]) -> ndarray:
+        return np.fromiter(
+            map(self._word_to_code_map.get, words, repeat(self.UNKNOWN_CODE)),
+            dtype=np.int64,
+        )
 
     def encode(self, word: str) -> int:
         return self._word_to_code_map.get(word, self.UNKNOWN_CODE)
 
-    def decode_many(self, codes: List[int]) -> List[str]:
-        return [self.decode(code) for code in codes]
+    def decode_many(self, codes: Iterable[int]) -> List[str]:
+        codes = np.array(codes, dtype=np.int64)
+        codes[(codes < 0) | (codes >= len(self._words))] = 0
+        words = self._words
+        return [words[code] for code in codes.tolist()]
 
     def decode(self, code: int) -> str:
-        return self._code_to_word_map.get(code, self.UNKNOWN)
+        if 0 <= code < len(self._words):
+            return self._words[code]
+        return self.UNKNOWN
+
+    def to_arrays(self) -> Dict[str, ndarray]:
+        words = [word.encode() for word in self.decode_many(range(len(self) + 1))]
+        offsets = np.zeros(len(words) + 1, dtype=np.int64)
+        np.cumsum([len(word) for word in words], out=offsets[1:])
+        return {
+            "vocab_offsets": offsets,
+            "vocab_buffer": np.frombuffer(b"".join(words), dtype=np.uint8),
+            "vocab_sorted": np.array(
+                sorted(range(len(words)), key=words.__getitem__), dtype=np.int32
+            ),
+            "vocab_counts": self.counts(),
+        }
+
+    def __getstate__(self):
+        # words never contain a line break, one joined string pickles compactly
+        return {
+            "words": "\n".join(self.decode_many(range(len(self) + 1))),
+            "counts": self.counts(),
+        }
+
+    def __setstate__(self, state):
+        if "_code_to_word_map" in state:
+            code_to_word = state["_code_to_word_map"]
+            words = [code_to_word[code] for code in range(len(code_to_word))]
+            self._set_words(words, [0] * len(words))
+            return
+        self._set_words(state["words"].split("\n"), state["counts"].tolist())
 
     def __len__(self):
-        return self._current_length
+        return len(self._words) - 1
+
+
+class MappedDictionary(Dictionary):
+    def __init__(
+        self,
+        vocab_offsets: ndarray,
+        vocab_buffer: ndarray,
+        vocab_sorted: ndarray,
+        vocab_counts: Optional[ndarray] = None,
+    ):
+        self._offsets = vocab_offsets
+        self._buffer = vocab_buffer
+        self._sorted = vocab_sorted
+        self._base = len(vocab_offsets) - 1
+        if vocab_counts is None:
+            vocab_counts = np.zeros(self._base, dtype=np.int64)
+        self._mapped_counts = vocab_counts
+        self._count_updates = {}
+        # words observed after loading live in the regular structures
+        self._set_words([], [])
+
+    def observe(self, word: str, count: int = 1) -> int:
+        if (code := self._find(word)) is not None:
+            self._count_updates[code] = self._count_updates.get(code, 0) + count
+            return code
+        return self._base + super().observe(word, count)
+
+    def counts(self) -> ndarray:
+        counts = np.concatenate(
+            (self._mapped_counts.astype(np.int64), super().counts())
+        )
+        for code, count in self._count_updates.items():
+            counts[code] += count
+        return counts
+
+    def prune(
+        self,
+        min_count: int = 1,
+        max_vocab: Optional[int] = None,
+        referenced: Optional[ndarray] = None,
+    ) -> ndarray:
+        # pruning renumbers every word, none of them stay in the mapped arrays
+        pruned = Dictionary.from_words(
+            self.decode_many(range(len(self) + 1)), self.counts()
+        )
+        mapping = pruned.prune(
+            min_count=min_count, max_vocab=max_vocab, referenced=referenced
+        )
+        self.__init__(
+            np.zeros(1, dtype=np.int64),
+            np.zeros(0, dtype=np.uint8),
+            np.zeros(0, dtype=np.int32),
+        )
+        self._set_words(pruned._words, pruned._counts)
+        return mapping
+
+    def encode_many(self, words: Iterable[str]) -> ndarray:
+        return np.fromiter(map(self.encode, words), dtype=np.int64)
+
+    def encode(self, word: str) -> int:
+        if (code := self._find(word)) is not None:
+            return code
+        if (code := super().encode(word)) != self.UNKNOWN_CODE:
+            return self._base + code
+        return code
+
+    def decode_many(self, codes: Iterable[int]) -> List[str]:
+        codes = np.array(codes, dtype=np.int64)
+        mapped = (codes >= 0) & (codes < self._base)
+        starts = self._offsets[codes[mapped]]
+        lengths = self._offsets[codes[mapped] + 1] - starts
+        # gather the words separated by line breaks and decode them at once
+        ends = np.cumsum(lengths + 1)
+        joined = np.full(int(ends[-1]) if len(ends) else 0, ord("\n"), np.uint8)
+        within = np.arange(int(lengths.sum())) - np.repeat(
+            np.cumsum(lengths) - lengths, lengths
+        )
+        joined[np.repeat(ends - lengths - 1, lengths) + within] = self._buffer[
+            np.repeat(starts, lengths) + within
+        ]
+        mapped_words = iter(joined.tobytes().decode().split("\n"))
+        return [
+            next(mapped_words) if is_mapped else self.decode(code)
+            for code, is_mapped in zip(codes.tolist(), mapped.tolist())
+        ]
+
+    def decode(self, code: int) -> str:
+        if 0 <= code < self._base:
+            return self._word(code).decode()
+        return super().decode(code - self._base)
+
+    def __reduce__(self):
+        # unpickled as a plain Dictionary holding copies of the mapped words
+        return Dictionary, (), self.__getstate__()
+
+    def __len__(self):
+        return self._base + len(self._words) - 1
+
+    def _word(self, code: int) -> bytes:
+        return self._buffer[self._offsets[code] : self._offsets[code + 1]].tobytes()
+
+    def _find(self, word: str):
+        word = word.encode()
+        low, high = 0, len(self._sorted)
+        while low < high:
+            middle = (low + high) // 2
+            if self._word(self._sorted[middle]) < word:
+                low = middle + 1
+            else:
+                high = middle
+        if low < len(self._sorted) and self._word(self._sorted[low]) == word:
+            return int(self._sorted[low])
+        return None
@@ -1,11 +1,26 @@
-import random
-from typing import List
+import gc
+from itertools import islice
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
 
 import numpy as np
-from numpy.random import choice
+from numpy import ndarray
+from numpy.random import Generator
 from torch.utils.data import DataLoader
 
 from src.dictionary import Dictionary
+from src.profiling import PROFILER, profiled
+from src.sampling import CacheInfo, SamplingCache, SamplingTable
+from src.storage import (
+    ArrayStorage,
+    DictStorage,
+    NGramStorage,
+    PackedCounts,
+    ShardedStorage,
+    ShardInfo,
+    SketchStorage,
+    Successors,
+)
 
 
 class NGramModelError(Exception):
@@ -13,43 +28,312 @@ class NGramModelError(Exception):
 
 
 class NGramModel:
-    def __init__(self, seed: int = 42):
+    # contexts whose backoffs the entropy pruning looks up at once
+    PRUNE_BATCH = 1 << 16
+
+    def __init__(
+        self,
+        seed: int = 42,
+        storage: Optional[NGramStorage] = None,
+        cache_size: int = 65536,
+    ):
         self._seed = seed
-        self._ngram_mapping = {}
-        random.seed(self._seed)
+        self._storage = DictStorage() if storage is None else storage
+        self._sampling_cache = SamplingCache(cache_size)
+        # merged counts not stored yet and the rank following theirs
+        self._pending: List[PackedCounts] = []
+        self._pending_rank = 0
 
     def fit(self, dataloader: DataLoader) -> None:
-        for i, (x, y) in enumerate(dataloader):
-            x = tuple(x.flatten().tolist())
-            y = y.squeeze().tolist()
-            next_tokens_to_count_map = self._ngram_mapping.get(x, dict())
-            count = next_tokens_to_count_map.get(y, 0)
-            count += 1
-            next_tokens_to_count_map[y] = count
-            self._ngram_mapping[x] = next_tokens_to_count_map
+        self.flush()
+        with PROFILER.phase("ngram_update"):
+            for i, (x, y) in enumerate(PROFILER.iterate("dataloader", dataloader)):
+                x = tuple(x.flatten().tolist())
+                y = y.squeeze().tolist()
+                self._storage.add(x, y)
+        self._sampling_cache.clear()
+
+    @profiled("ngram_update")
+    def update(self, counts: Iterable[Tuple[Tuple[int, ...], int, int]]) -> None:
+        self.flush()
+        self._storage.update(counts)
+        self._sampling_cache.clear()
+
+    @profiled("merge")
+    def merge(self, counts: PackedCounts, mapping: Optional[ndarray] = None) -> None:
+        """Adds counts of another dictionary, ``mapping`` renumbers their tokens.
+
+        Merges are combined as arrays, runs of similar size at once, and stored
+        when the model is used next.
+        """
+        counts = counts.remap(mapping, rank_offset=self._pending_rank)
+        self._pending_rank = max(self._pending_rank, counts.rank_end())
+        self._pending.append(counts)
+        while len(self._pending) > 1 and len(self._pending[-2]) <= 2 * len(
+            self._pending[-1]
+        ):
+            last = self._pending.pop()
+            self._pending[-1] = PackedCounts.merge([self._pending[-1], last])
+
+    def remap(self, mapping: ndarray) -> None:
+        """Renumbers tokens, ngrams with a token mapped to UNKNOWN_CODE are dropped."""
+        self.flush()
+        storage = self._storage.empty_like()
+        storage.update(
+            (context, token, count)
+            for context, token, count in self._remapped_counts(mapping)
+            if token != Dictionary.UNKNOWN_CODE
+            and Dictionary.UNKNOWN_CODE not in context
+        )
+        self._storage = storage
+        self._sampling_cache.clear()
+
+    def prune(
+        self,
+        min_count: int = 1,
+        min_context_count: int = 1,
+        entropy_threshold: float = 0.0,
+    ) -> int:
+        """Drops rare ngrams and returns how many successor counts were removed.
+
+        Successors counted fewer than ``min_count`` times and contexts counted
+        fewer than ``min_context_count`` times are dropped. With
+        ``entropy_threshold`` a context is also dropped when backing off to its
+        suffix changes the model little: its probability times the relative
+        entropy between its successors and those of the suffix is below the
+        threshold (Stolcke's criterion, the backoff here is not discounted).
+        Every decision is made on the unpruned counts.
+        """
+        self.flush()
+        totals: Dict[int, int] = {}
+        for context, _, counts in self._storage.items():
+            totals[len(context)] = totals.get(len(context), 0) + int(counts.sum())
+
+        kept = []
+        removed = 0
+        items = self._storage.items()
+        # the suffixes of a batch are looked up together, a sharded storage
+        # loads each of their shards once per batch instead of once per context
+        while batch := list(islice(items, self.PRUNE_BATCH)):
+            backoffs = self._backoffs(batch) if entropy_threshold > 0 else {}
+            for position, (context, tokens, counts) in enumerate(batch):
+                context_count = int(counts.sum())
+                keep = counts >= min_count
+                if context_count < min_context_count or (
+                    entropy_threshold > 0
+                    and self._backoff_entropy(tokens, counts, backoffs.get(position))
+                    * context_count
+                    / totals[len(context)]
+                    < entropy_threshold
+                ):
+                    keep[:] = False
+                removed += len(keep) - int(keep.sum())
+                kept.extend(
+                    zip(
+                        (context,) * int(keep.sum()),
+                        tokens[keep].tolist(),
+                        counts[keep].tolist(),
+                    )
+                )
+        storage = self._storage.empty_like()
+        storage.update(kept)
+        self._storage = storage
+        self._sampling_cache.clear()
+        return removed
+
+    def _backoffs(
+        self, batch: List[Tuple[Tuple[int, ...], ndarray, ndarray]]
+    ) -> Dict[int, Successors]:
+        """Successors of the suffix of every context in ``batch`` that has one."""
+        positions = [
+            position
+            for position, (context, _, _) in enumerate(batch)
+            if len(context) > 1
+        ]
+        backoffs = self._storage.successors_many(
+            [batch[position][0][1:] for position in positions]
+        )
+        return {
+            position: backoff
+            for position, backoff in zip(positions, backoffs)
+            if backoff is not None
+        }
+
+    @staticmethod
+    def _backoff_entropy(
+        tokens: ndarray, counts: ndarray, backoff: Optional[Successors]
+    ) -> float:
+        """Relative entropy of successors to those of the context suffix, ``backoff``.
+
+        Infinite without a suffix or when it lacks a successor of the context.
+        """
+        if backoff is None:
+            return np.inf
+        backoff_tokens, backoff_counts = backoff
+        order = np.argsort(backoff_tokens)
+        index = np.searchsorted(backoff_tokens, tokens, sorter=order)
+        index = order[np.minimum(index, len(order) - 1)]
+        if not (backoff_tokens[index] == tokens).all():
+            return np.inf
+        p = counts / counts.sum()
+        q = backoff_counts[index] / backoff_counts.sum()
+        return float(np.sum(p * np.log(p / q)))
+
+    def referenced_tokens(self, size: int) -> ndarray:
+        """Boolean mask of the ``size`` codes used by stored contexts or successors."""
+        self.flush()
+        referenced = np.zeros(size, dtype=bool)
+        for context, tokens, _ in self._storage.items():
+            referenced[[token for token in context if token >= 0]] = True
+            referenced[tokens[tokens >= 0]] = True
+        return referenced
+
+    def _remapped_counts(
+        self, mapping: Optional[ndarray]
+    ) -> Iterable[Tuple[Tuple[int, ...], int, int]]:
+        codes = None if mapping is None else mapping.tolist()
+
+        def remap(token):
+            return codes[token] if token >= 0 else token
+
+        if codes is None:
+            yield from self._storage.counts()
+            return
+        for context, tokens, counts in self._storage.items():
+            tokens = list(map(remap, tokens.tolist()))
+            context = tuple(map(remap, context))
+            yield from zip((context,) * len(tokens), tokens, counts.tolist())
 
     def predict(self, x):
         return self.samples(x, k=1)
 
-    def samples(self, x, k=1):
-        sub_x = x
-        while len(sub_x) > 0:
-            next_tokens_to_count_map = self._ngram_mapping.get(sub_x)
-            if next_tokens_to_count_map is not None:
-                break
-            sub_x = sub_x[1:]
-        else:
+    def samples(self, x, k=1, random_state: Optional[Generator] = None):
+        """Draws from ``random_state``, a fresh unseeded generator when not given."""
+        self.flush()
+        table = self._sampling_cache.get(tuple(x), lambda: self._sampling_table(x))
+        if table is None:
             raise NGramModelError(f"Model was not trained on data = {x}")
-        outcomes = list(next_tokens_to_count_map.keys())
-        weights = np.array(list(next_tokens_to_count_map.values()), dtype=np.float64)
-        weights /= np.sum(weights)
-        size = min(k, len(outcomes))
-        next_possible_tokens = choice(outcomes, size=size, replace=False, p=weights)
-        return next_possible_tokens
-
-    def random_ngram(self) -> List[int]:
-        try:
-            key = random.choice(list(self._ngram_mapping.keys()))
-        except IndexError:
+        return table.sample_distinct(k, random_state)
+
+    @profiled("sampling")
+    def samples_many(
+        self,
+        xs: List[Tuple[int, ...]],
+        k=1,
+        random_states: Optional[List[Optional[Generator]]] = None,
+    ) -> List[Optional[ndarray]]:
+        self.flush()
+        if random_states is None:
+            random_states = [None] * len(xs)
+        tables = {}
+        next_tokens = []
+        for x, random_state in zip(xs, random_states):
+            if x not in tables:
+                tables[x] = self._sampling_cache.get(x, lambda: self._sampling_table(x))
+            if tables[x] is None:
+                next_tokens.append(None)
+                continue
+            next_tokens.append(tables[x].sample_distinct(k, random_state))
+        return next_tokens
+
+    @profiled("backoff")
+    def _sampling_table(self, x) -> Optional[SamplingTable]:
+        successors = self._storage.longest_suffix(tuple(x))
+        if successors is None:
+            return None
+        return SamplingTable(*successors)
+
+    def random_ngram(self, random_state: Optional[Generator] = None) -> List[int]:
+        self.flush()
+        if not len(self._storage):
             return (Dictionary.UNKNOWN_CODE,)
-        return key
+        if random_state is None:
+            random_state = np.random.default_rng()
+        return self._storage.context_at(int(random_state.integers(len(self._storage))))
+
+    def context_count(self) -> int:
+        self.flush()
+        return len(self._storage)
+
+    def memory_usage(self) -> int:
+        self.flush()
+        return self._storage.memory_usage()
+
+    def error_bound(self) -> Tuple[int, float]:
+        self.flush()
+        return self._storage.error_bound()
+
+    def is_approximate(self) -> bool:
+        """True when a ``SketchStorage`` may overcount within its memory budget."""
+        return isinstance(self._storage, SketchStorage)
+
+    def save_sketch(self, path: Path) -> bool:
+        """Writes the count-min sketch of a ``SketchStorage``, False if there is none."""
+        self.flush()
+        return isinstance(self._storage, SketchStorage) and self._storage.save_sketch(
+            path
+        )
+
+    def load_sketch(self, path: Path) -> None:
+        if isinstance(self._storage, SketchStorage):
+            self._storage.load_sketch(path)
+
+    def to_arrays(self) -> Dict[str, ndarray]:
+        self.flush()
+        return ArrayStorage.from_storage(self._storage).to_arrays()
+
+    @classmethod
+    def from_arrays(cls, arrays: Dict[str, ndarray], seed: int = 42) -> "NGramModel":
+        return cls(seed=seed, storage=ArrayStorage.from_arrays(arrays))
+
+    def to_shards(self, count: int) -> Tuple[ndarray, Iterable[Dict[str, ndarray]]]:
+        self.flush()
+        return ArrayStorage.from_storage(self._storage).partition(count)
+
+    def make_writable(self) -> None:
+        """Loads a read-only storage, such as a sharded one, into a writable one."""
+        self.flush()
+        if not self._storage.writable:
+            self._storage = ArrayStorage.from_storage(self._storage)
+            self._sampling_cache.clear()
+
+    def cache_info(self) -> CacheInfo:
+        return self._sampling_cache.info()
+
+    def shard_info(self) -> Optional[ShardInfo]:
+        if isinstance(self._storage, ShardedStorage):
+            return self._storage.info()
+        return None
+
+    def flush(self) -> None:
+        """Stores the counts of earlier merges."""
+        if not self._pending:
+            return
+        # the storage gets many new containers at once, none of them cyclic, and
+        # the collector would walk all of them again and again
+        collecting = gc.isenabled()
+        gc.disable()
+        try:
+            with PROFILER.phase("ngram_update"):
+                counts = PackedCounts.merge(self._pending)
+                self._pending = []
+                self._pending_rank = 0
+                self._storage.update_successors(counts.items())
+        finally:
+            if collecting:
+                gc.enable()
+        self._sampling_cache.clear()
+
+    def __getstate__(self):
+        self.flush()
+        state = self.__dict__.copy()
+        state["_sampling_cache"] = self._sampling_cache.info().maxsize
+        return state
+
+    def __setstate__(self, state):
+        if "_ngram_mapping" in state:
+            state["_storage"] = DictStorage(state.pop("_ngram_mapping"))
+        state["_sampling_cache"] = SamplingCache(state.get("_sampling_cache", 65536))
+        state.setdefault("_pending", [])
+        state.setdefault("_pending_rank", 0)
+        self.__dict__.update(state)
@@ -0,0 +1,88 @@
+import json
+import os
+import struct
+from pathlib import Path
+from typing import Dict, Tuple
+
+import numpy as np
+from numpy import ndarray
+
+MAGIC = b"TGUMODEL"
+VERSION = 1
+
+_PREAMBLE = struct.Struct("<8sII")
+_ALIGNMENT = 64
+
+
+class ModelFileError(Exception):
+    pass
+
+
+def is_model_file(path: Path, magic: bytes = MAGIC) -> bool:
+    with path.open("rb") as fp:
+        return fp.read(len(magic)) == magic
+
+
+def _align(offset: int) -> int:
+    return -(-offset // _ALIGNMENT) * _ALIGNMENT
+
+
+def write_model_file(
+    path: Path, metadata: Dict, arrays: Dict[str, ndarray], magic: bytes = MAGIC
+) -> None:
+    arrays = {name: np.ascontiguousarray(array) for name, array in arrays.items()}
+    layout = {}
+    header = b""
+    # the header stores array offsets, so its size has to settle first
+    while True:
+        offset = _align(_PREAMBLE.size + len(header))
+        for name, array in arrays.items():
+            layout[name] = {
+                "offset": offset,
+                "dtype": array.dtype.str,
+                "shape": list(array.shape),
+            }
+            offset = _align(offset + array.nbytes)
+        encoded = json.dumps({**metadata, "arrays": layout}).encode()
+        if encoded == header:
+            break
+        header = encoded
+
+    temporary_path = path.with_name(f"{path.name}.tmp")
+    with temporary_path.open("wb") as fp:
+        fp.write(_PREAMBLE.pack(magic, VERSION, len(header)))
+        fp.write(header)
+        for name, array in arrays.items():
+            fp.seek(layout[name]["offset"])
+            # written from the array's own buffer, a memory map is not copied
+            fp.write(array.data)
+    os.replace(temporary_path, path)
+
+
+def read_model_file(
+    path: Path, magic: bytes = MAGIC
+) -> Tuple[Dict, Dict[str, ndarray]]:
+    with path.open("rb") as fp:
+        found, version, header_length = _PREAMBLE.unpack(fp.read(_PREAMBLE.size))
+        if found != magic:
+            raise ModelFileError(f"{path} is not a {magic.decode()} file")
+        if version > VERSION:
+            raise ModelFileError(
+                f"{path} has format version {version}, supported up to {VERSION}"
+            )
+        metadata = json.loads(fp.read(header_length))
+
+    # a single read-only mapping, pages are shared between processes
+    buffer = np.memmap(path, mode="r")
+    arrays = {}
+    for name, layout in metadata.pop("arrays").items():
+        dtype = np.dtype(layout["dtype"])
+        shape = tuple(layout["shape"])
+        count = int(np.prod(shape))
+        if not count:
+            arrays[name] = np.zeros(shape, dtype=dtype)
+            continue
+        arrays[name] = np.frombuffer(
+            buffer, dtype=dtype, count=count, offset=layout["offset"]
+        ).reshape(shape)
+    return metadata, arrays
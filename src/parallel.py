@@ -0,0 +1,44 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, Iterator, NamedTuple
+
+from src.counter import NGramCounter
+from src.dictionary import Dictionary
+from src.storage import PackedCounts
+
+
+class Shard(NamedTuple):
+    dictionary: Dictionary
+    counts: PackedCounts
+    token_count: int
+    byte_count: int
+
+
+def count_shard(raw_text: str, ngram: int, min_ngram: int) -> Shard:
+    # arrays pickle and merge in bulk, a model would be rebuilt ngram by ngram
+    dictionary = Dictionary()
+    counter = NGramCounter(dictionary=dictionary, ngram=ngram, min_ngram=min_ngram)
+    tokens, lengths = counter.encode(raw_text)
+    counts = counter.count_packed(tokens, lengths)
+    return Shard(dictionary, counts, len(tokens), len(raw_text.encode()))
+
+
+class ShardedCounter:
+    def __init__(self, workers: int, ngram: int = 2, min_ngram: int = 1):
+        self._workers = workers
+        self._ngram = ngram
+        self._min_ngram = min_ngram
+
+    def count(self, texts: Iterable[str]) -> Iterator[Shard]:
+        with ProcessPoolExecutor(max_workers=self._workers) as executor:
+            pending = deque()
+            for text in texts:
+                pending.append(
+                    executor.submit(count_shard, text, self._ngram, self._min_ngram)
+                )
+                # shards are yielded in input order, which keeps dictionary codes
+                # identical to a serial run
+                if len(pending) >= 2 * self._workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
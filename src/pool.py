@@ -0,0 +1,98 @@
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+from typing import List, Optional
+
+from src.trainer import Trainer
+
+# the trainer of a pool process, loaded once by the pool initializer
+_trainer: Optional[Trainer] = None
+
+
+def _load_trainer(model_path: Path, resident_shards: int) -> None:
+    global _trainer
+    _trainer = Trainer.load(model_path, resident_shards=resident_shards)
+
+
+def _continue_batch(
+    sentences: List[Optional[List[str]]],
+    word_count: int,
+    seeds: List[Optional[int]],
+    ngram: Optional[int],
+) -> List[str]:
+    return _trainer.continue_many(
+        sentences, word_count=word_count, seeds=seeds, ngram=ngram
+    )
+
+
+class GenerationPool:
+    """Runs continue_many over batches of prompts in a thread or process pool.
+
+    Threads share one loaded trainer, every process loads its own, binary models
+    are memory-mapped so their pages are shared. Each prompt draws only from the
+    generator of its seed, the output for a seed is the same as in a serial run.
+    """
+
+    def __init__(
+        self,
+        model_path: Path,
+        workers: int = 4,
+        processes: bool = False,
+        batch_size: int = 16,
+        resident_shards: int = 4,
+    ):
+        self._batch_size = batch_size
+        self._executor: Executor
+        if processes:
+            self._trainer = None
+            self._executor = ProcessPoolExecutor(
+                max_workers=workers,
+                initializer=_load_trainer,
+                initargs=(model_path, resident_shards),
+            )
+        else:
+            self._trainer = Trainer.load(model_path, resident_shards=resident_shards)
+            self._executor = ThreadPoolExecutor(max_workers=workers)
+
+    def continue_many(
+        self,
+        sentences: List[Optional[List[str]]],
+        word_count: int,
+        seeds: Optional[List[Optional[int]]] = None,
+        ngram: Optional[int] = None,
+    ) -> List[str]:
+        if seeds is None:
+            seeds = [None] * len(sentences)
+        continue_batch = (
+            _continue_batch if self._trainer is None else self._continue_batch
+        )
+        futures = [
+            self._executor.submit(
+                continue_batch,
+                sentences[start : start + self._batch_size],
+                word_count,
+                seeds[start : start + self._batch_size],
+                ngram,
+            )
+            for start in range(0, len(sentences), self._batch_size)
+        ]
+        return [text for future in futures for text in future.result()]
+
+    def close(self) -> None:
+        self._executor.shutdown()
+
+    def __enter__(self) -> "GenerationPool":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def _continue_batch(
+        self,
+        sentences: List[Optional[List[str]]],
+        word_count: int,
+        seeds: List[Optional[int]],
+        ngram: Optional[int],
+    ) -> List[str]:
+        return self._trainer.continue_many(
+            sentences, word_count=word_count, seeds=seeds, ngram=ngram
+        )
@@ -0,0 +1,181 @@
+import cProfile
+import functools
+import json
+import pstats
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+from typing import Callable, ContextManager, Dict, Iterable, Iterator, Optional
+
+_DISABLED = nullcontext()
+
+
+class PhaseStats:
+    __slots__ = ("calls", "seconds", "self_seconds", "net_bytes")
+
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.self_seconds = 0.0
+        self.net_bytes = 0
+
+    def to_dict(self, memory: bool) -> Dict:
+        stats = {
+            "calls": self.calls,
+            "seconds": self.seconds,
+            "self_seconds": self.self_seconds,
+        }
+        if memory:
+            stats["net_bytes"] = self.net_bytes
+        return stats
+
+
+class Profiler:
+    """Wall time, calls and net allocations per named phase.
+
+    Phases nest, self time excludes the nested phases. Nesting is tracked per
+    thread, phases of concurrent threads add up and may exceed the wall time.
+    While disabled a phase is a shared no-op context manager.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._memory = False
+        self._phases: Dict[str, PhaseStats] = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._started = 0.0
+        self._stopped = 0.0
+        self._cprofile: Optional[cProfile.Profile] = None
+        self._cprofile_stats: Optional[pstats.Stats] = None
+
+    def start(self, memory: bool = False, cprofile: bool = False) -> None:
+        self._phases = {}
+        self._local = threading.local()
+        self._memory = memory
+        self._cprofile_stats = None
+        if memory:
+            tracemalloc.start()
+        if cprofile:
+            self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+        self.enabled = True
+        self._started = time.perf_counter()
+
+    def stop(self) -> None:
+        self._stopped = time.perf_counter()
+        self.enabled = False
+        if self._cprofile is not None:
+            self._cprofile.disable()
+            self._cprofile_stats = pstats.Stats(self._cprofile)
+            self._cprofile = None
+        if self._memory:
+            tracemalloc.stop()
+
+    def phase(self, name: str) -> ContextManager:
+        if not self.enabled:
+            return _DISABLED
+        return self._phase(name)
+
+    def iterate(self, name: str, iterable: Iterable) -> Iterable:
+        """Times producing every item of ``iterable`` as a phase."""
+        if not self.enabled:
+            return iterable
+        return self._iterate(name, iterable)
+
+    def report(self) -> Dict:
+        wall = self._stopped - self._started
+        phases = {
+            name: stats.to_dict(self._memory)
+            for name, stats in sorted(
+                self._phases.items(), key=lambda item: -item[1].self_seconds
+            )
+        }
+        accounted = sum(stats.self_seconds for stats in self._phases.values())
+        return {
+            "wall_seconds": wall,
+            "unaccounted_seconds": wall - accounted,
+            "phases": phases,
+        }
+
+    def dump_stats(self, path: Path) -> None:
+        self._cprofile_stats.dump_stats(str(path))
+
+    @contextmanager
+    def _phase(self, name: str) -> Iterator[None]:
+        with self._lock:
+            stats = self._phases.get(name)
+            if stats is None:
+                stats = self._phases[name] = PhaseStats()
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        # traced memory at the end minus at the start, frees make it negative
+        allocated = tracemalloc.get_traced_memory()[0] if self._memory else 0
+        # time spent in nested phases, subtracted from self time
+        stack.append(0.0)
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            nested = stack.pop()
+            if stack:
+                stack[-1] += elapsed
+            if self._memory:
+                allocated = tracemalloc.get_traced_memory()[0] - allocated
+            with self._lock:
+                stats.calls += 1
+                stats.seconds += elapsed
+                stats.self_seconds += elapsed - nested
+                if self._memory:
+                    stats.net_bytes += allocated
+
+    def _iterate(self, name: str, iterable: Iterable) -> Iterator:
+        iterator = iter(iterable)
+        while True:
+            with self._phase(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+
+PROFILER = Profiler()
+
+
+def profiled(name: str) -> Callable:
+    def decorate(function: Callable) -> Callable:
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not PROFILER.enabled:
+                return function(*args, **kwargs)
+            with PROFILER.phase(name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorate
+
+
+@contextmanager
+def profile_run(
+    report_path: Optional[Path],
+    stats_path: Optional[Path] = None,
+    memory: bool = False,
+) -> Iterator[None]:
+    if report_path is None and stats_path is None:
+        yield
+        return
+    PROFILER.start(memory=memory, cprofile=stats_path is not None)
+    try:
+        yield
+    finally:
+        PROFILER.stop()
+        if report_path is not None:
+            report_path.write_text(json.dumps(PROFILER.report(), indent=2))
+        if stats_path is not None:
+            PROFILER.dump_stats(stats_path)
@@ -0,0 +1,102 @@
+import threading
+from collections import OrderedDict, namedtuple
+from typing import Callable, Hashable, Optional
+
+import numpy as np
+from numpy import ndarray
+from numpy.random import Generator
+
+CacheInfo = namedtuple("CacheInfo", ["hits", "misses", "maxsize", "currsize"])
+
+
+class SamplingTable:
+    def __init__(self, tokens: ndarray, counts: ndarray, max_rounds: int = 2):
+        self._tokens = np.asarray(tokens)
+        self._cumulative = np.cumsum(counts, dtype=np.float64)
+        self._total = self._cumulative[-1]
+        self._max_rounds = max_rounds
+
+    def __len__(self) -> int:
+        return len(self._tokens)
+
+    def sample(self, size: int, random_state: Optional[Generator] = None) -> ndarray:
+        if random_state is None:
+            random_state = np.random.default_rng()
+        return self._tokens[self._draw(size, random_state)]
+
+    def sample_distinct(
+        self, k: int, random_state: Optional[Generator] = None
+    ) -> ndarray:
+        if random_state is None:
+            random_state = np.random.default_rng()
+        k = min(k, len(self._tokens))
+        if k <= 0:
+            return self._tokens[:0]
+        chosen = []
+        seen = set()
+        # drawing with replacement and skipping repeats gives the same
+        # distribution as successive draws without replacement
+        for _ in range(self._max_rounds):
+            for index in self._draw(2 * k, random_state).tolist():
+                if index not in seen:
+                    seen.add(index)
+                    chosen.append(index)
+                    if len(chosen) == k:
+                        return self._tokens[chosen]
+        return self._tokens[chosen + self._top_k(k - len(chosen), seen, random_state)]
+
+    def _draw(self, size: int, random_state) -> ndarray:
+        points = random_state.random(size) * self._total
+        indices = np.searchsorted(self._cumulative, points, side="right")
+        return np.minimum(indices, len(self._tokens) - 1)
+
+    def _top_k(self, k: int, exclude: set, random_state) -> list:
+        weights = np.diff(self._cumulative, prepend=0.0)
+        weights[list(exclude)] = 0.0
+        with np.errstate(divide="ignore"):
+            keys = np.log(weights) + random_state.gumbel(size=len(weights))
+        top = np.argpartition(-keys, k - 1)[:k]
+        return top[np.argsort(-keys[top])].tolist()
+
+
+class SamplingCache:
+    """LRU of sampling tables, safe to share between threads.
+
+    Tables are built outside the lock, two threads missing the same key may
+    both build it.
+    """
+
+    def __init__(self, maxsize: int = 65536):
+        self._maxsize = maxsize
+        self._tables = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def get(
+        self, key: Hashable, build: Callable[[], Optional[SamplingTable]]
+    ) -> Optional[SamplingTable]:
+        with self._lock:
+            try:
+                table = self._tables[key]
+            except KeyError:
+                self._misses += 1
+            else:
+                self._hits += 1
+                self._tables.move_to_end(key)
+                return table
+        table = build()
+        if self._maxsize > 0:
+            with self._lock:
+                self._tables[key] = table
+                if len(self._tables) > self._maxsize:
+                    self._tables.popitem(last=False)
+        return table
+
+    def clear(self) -> None:
+        with self._lock:
+            self._tables.clear()
+
+    def info(self) -> CacheInfo:
+        with self._lock:
+            return CacheInfo(self._hits, self._misses, self._maxsize, len(self._tables))
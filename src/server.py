@@ -0,0 +1,270 @@
+import json
+import logging
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import groupby
+from pathlib import Path
+from socketserver import ThreadingMixIn, UnixStreamServer
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+from src.trainer import Trainer
+
+logger = logging.getLogger(__name__)
+
+
+class GenerationRequest(NamedTuple):
+    prefix: Optional[List[str]]
+    length: int
+    seed: Optional[int]
+    ngram: Optional[int]
+    result: Future
+
+
+class GenerationServer:
+    def __init__(
+        self,
+        model_path: Path,
+        max_batch: int = 32,
+        watch_interval: Optional[float] = None,
+        latency_window: int = 10000,
+        resident_shards: int = 4,
+    ):
+        self._model_path = model_path
+        self._resident_shards = resident_shards
+        self._max_batch = max_batch
+        self._watch_interval = watch_interval
+        self._trainer = Trainer.load(model_path, resident_shards=resident_shards)
+        self._model_mtime = model_path.stat().st_mtime_ns
+        self._requests = queue.Queue()
+        self._reload_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._latencies = deque(maxlen=latency_window)
+        self._completed = deque(maxlen=latency_window)
+        self._request_count = 0
+        self._started = time.monotonic()
+        self._stopped = threading.Event()
+        self._threads = [threading.Thread(target=self._generate_batches, daemon=True)]
+        if watch_interval is not None:
+            self._threads.append(threading.Thread(target=self._watch, daemon=True))
+
+    def start(self) -> None:
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self._requests.put(None)
+
+    def generate(
+        self,
+        prefix: Optional[List[str]],
+        length: int,
+        seed: Optional[int] = None,
+        ngram: Optional[int] = None,
+    ) -> str:
+        started = time.perf_counter()
+        request = GenerationRequest(prefix, length, seed, ngram, Future())
+        self._requests.put(request)
+        text = request.result.result()
+        with self._stats_lock:
+            self._latencies.append(time.perf_counter() - started)
+            self._completed.append(time.monotonic())
+            self._request_count += 1
+        return text
+
+    def reload(self, model_path: Optional[Path] = None) -> None:
+        with self._reload_lock:
+            model_path = self._model_path if model_path is None else model_path
+            mtime = model_path.stat().st_mtime_ns
+            trainer = Trainer.load(model_path, resident_shards=self._resident_shards)
+            # requests in flight finish on the previous trainer
+            self._trainer = trainer
+            self._model_path = model_path
+            self._model_mtime = mtime
+        logger.info("Reloaded model from %s", model_path)
+
+    def stats(self) -> Dict:
+        with self._stats_lock:
+            latencies = np.array(self._latencies)
+            completed = np.array(self._completed)
+            request_count = self._request_count
+        now = time.monotonic()
+        recent = completed[completed > now - 60]
+        stats = {
+            "model": str(self._model_path),
+            "requests": request_count,
+            "uptime": now - self._started,
+            "requests_per_second": request_count / (now - self._started),
+            "recent_requests_per_second": len(recent) / min(60, now - self._started),
+        }
+        if len(latencies):
+            for percentile in (50, 90, 99):
+                stats[f"latency_p{percentile}"] = float(
+                    np.percentile(latencies, percentile)
+                )
+        if (shard_info := self._trainer.shard_info()) is not None:
+            stats["shards"] = shard_info._asdict()
+        return stats
+
+    def _next_batch(self) -> List[GenerationRequest]:
+        batch = [self._requests.get()]
+        while len(batch) < self._max_batch:
+            try:
+                batch.append(self._requests.get_nowait())
+            except queue.Empty:
+                break
+        return [request for request in batch if request is not None]
+
+    @staticmethod
+    def _batch_key(request: GenerationRequest) -> Tuple[int, bool, int]:
+        # requests without ngram use the trained order, apart from any number
+        return request.length, request.ngram is None, request.ngram or 0
+
+    def _generate_batches(self) -> None:
+        while not self._stopped.is_set():
+            batch = self._next_batch()
+            trainer = self._trainer
+            batch.sort(key=self._batch_key)
+            for _, requests in groupby(batch, key=self._batch_key):
+                self._complete(trainer, list(requests))
+
+    def _complete(self, trainer: Trainer, requests: List[GenerationRequest]) -> None:
+        try:
+            texts = trainer.continue_many(
+                [request.prefix for request in requests],
+                word_count=requests[0].length,
+                seeds=[request.seed for request in requests],
+                ngram=requests[0].ngram,
+            )
+        except Exception as e:
+            if len(requests) > 1:
+                # a bad request fails the whole batch, the others still get a text
+                for request in requests:
+                    self._complete(trainer, [request])
+                return
+            logger.exception("Generation failed")
+            requests[0].result.set_exception(e)
+            return
+        for request, text in zip(requests, texts):
+            request.result.set_result(text)
+
+    def _watch(self) -> None:
+        while not self._stopped.wait(self._watch_interval):
+            try:
+                changed = self._model_path.stat().st_mtime_ns != self._model_mtime
+                if changed:
+                    self.reload()
+            except Exception:
+                logger.exception("Cannot reload %s", self._model_path)
+
+
+class GenerationHandler(BaseHTTPRequestHandler):
+    server_version = "TextGen/0.1"
+
+    def do_GET(self):
+        if self.path != "/stats":
+            self._respond(404, {"error": f"unknown path {self.path}"})
+            return
+        self._respond(200, self.server.generation.stats())
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            payload = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError as e:
+            self._respond(400, {"error": str(e)})
+            return
+        if self.path == "/generate":
+            self._generate(payload)
+        elif self.path == "/reload":
+            self._reload(payload)
+        else:
+            self._respond(404, {"error": f"unknown path {self.path}"})
+
+    def _generate(self, payload: Dict) -> None:
+        try:
+            text = self.server.generation.generate(**_generation_arguments(payload))
+        except ValueError as e:
+            self._respond(400, {"error": str(e)})
+            return
+        except Exception as e:
+            self._respond(500, {"error": str(e)})
+            return
+        self._respond(200, {"text": text})
+
+    def _reload(self, payload: Dict) -> None:
+        model_path = payload.get("model")
+        try:
+            self.server.generation.reload(
+                None if model_path is None else Path(model_path)
+            )
+        except Exception as e:
+            self._respond(500, {"error": str(e)})
+            return
+        self._respond(200, self.server.generation.stats())
+
+    def _respond(self, status: int, body: Dict) -> None:
+        encoded = json.dumps(body, ensure_ascii=False).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(encoded)))
+        self.end_headers()
+        self.wfile.write(encoded)
+
+    def address_string(self):
+        return str(self.client_address or "unix")
+
+    def log_message(self, format, *args):
+        logger.debug("%s %s", self.address_string(), format % args)
+
+
+def _is_integer(value: Any) -> bool:
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def _generation_arguments(payload: Any) -> Dict:
+    """Arguments of GenerationServer.generate, ValueError for invalid ones."""
+    if not isinstance(payload, dict):
+        raise ValueError(f"request body must be a JSON object: {payload!r}")
+    prefix = payload.get("prefix")
+    if isinstance(prefix, str):
+        prefix = prefix.split() or None
+    elif prefix is not None and not (
+        isinstance(prefix, list) and all(isinstance(word, str) for word in prefix)
+    ):
+        raise ValueError(f"prefix must be a string or a list of strings: {prefix!r}")
+    length = payload.get("length", 7)
+    if not _is_integer(length) or length < 0:
+        raise ValueError(f"length must be a non-negative integer: {length!r}")
+    seed = payload.get("seed")
+    if seed is not None and (not _is_integer(seed) or seed < 0):
+        raise ValueError(f"seed must be a non-negative integer: {seed!r}")
+    ngram = payload.get("ngram")
+    if ngram is not None and not _is_integer(ngram):
+        raise ValueError(f"ngram must be an integer: {ngram!r}")
+    return {"prefix": prefix, "length": length, "seed": seed, "ngram": ngram}
+
+
+class ThreadingUnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+
+def make_http_server(
+    generation: GenerationServer,
+    host: str = "127.0.0.1",
+    port: int = 8000,
+    unix_socket: Optional[Path] = None,
+):
+    if unix_socket is not None:
+        unix_socket.unlink(missing_ok=True)
+        http_server = ThreadingUnixHTTPServer(str(unix_socket), GenerationHandler)
+    else:
+        http_server = ThreadingHTTPServer((host, port), GenerationHandler)
+    http_server.generation = generation
+    return http_server
@@ -0,0 +1,1145 @@
+import math
+import sys
+import threading
+from bisect import bisect_left
+from collections import OrderedDict
+from itertools import islice
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+from numpy import ndarray
+
+from src.model_file import ModelFileError, read_model_file, write_model_file
+
+NGramCount = Tuple[Tuple[int, ...], int, int]
+Successors = Tuple[ndarray, ndarray]
+ContextCounts = Tuple[Tuple[int, ...], List[int], List[int]]
+
+_MASK = 2**64 - 1
+_FNV_OFFSET = 0xCBF29CE484222325
+_FNV_PRIME = 0x100000001B3
+
+
+def hash_context(context: Tuple[int, ...]) -> int:
+    h = _FNV_OFFSET ^ len(context)
+    for token in context:
+        h = ((h ^ (int(token) & _MASK)) * _FNV_PRIME) & _MASK
+    return h
+
+
+def hash_contexts(contexts: ndarray) -> ndarray:
+    with np.errstate(over="ignore"):
+        h = np.full(len(contexts), _FNV_OFFSET ^ contexts.shape[1], dtype=np.uint64)
+        for column in range(contexts.shape[1]):
+            h ^= contexts[:, column].astype(np.int64).view(np.uint64)
+            h *= np.uint64(_FNV_PRIME)
+    return h
+
+
+def _narrow(array: ndarray) -> ndarray:
+    if not len(array):
+        return array
+    dtype = np.result_type(
+        np.min_scalar_type(array.min()), np.min_scalar_type(array.max())
+    )
+    return array.astype(dtype)
+
+
+def _gather(
+    offsets: ndarray, values: ndarray, rows: ndarray
+) -> Tuple[ndarray, ndarray]:
+    """Offsets and values of the given rows of a CSR array."""
+    starts = offsets[rows]
+    lengths = offsets[rows + 1] - starts
+    new_offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=new_offsets[1:])
+    index = np.repeat(starts - new_offsets[:-1], lengths) + np.arange(new_offsets[-1])
+    return new_offsets, values[index]
+
+
+def _unique_rows(rows: ndarray) -> Tuple[ndarray, ndarray]:
+    """Index of the first occurrence of every distinct row and each row's group."""
+    if not len(rows):
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    if not rows.shape[1]:
+        return np.zeros(1, dtype=np.int64), np.zeros(len(rows), dtype=np.int64)
+    # codes from -1 up, shifted to pack the row into one integer
+    base = int(rows.max()) + 2
+    if base ** rows.shape[1] < 2**63:
+        keys = np.zeros(len(rows), dtype=np.int64)
+        for column in range(rows.shape[1]):
+            keys = keys * base + rows[:, column] + 1
+        _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+    else:
+        _, first, inverse = np.unique(
+            rows, axis=0, return_index=True, return_inverse=True
+        )
+    return first, inverse.ravel()
+
+
+class PackedCounts:
+    """Ngram counts as arrays, cheap to pickle and to merge.
+
+    ``orders`` maps a context length to ``(ngrams, counts, ranks)``: rows of the
+    context followed by the next token, their counts and the position of their
+    first occurrence. ``items`` follows the ranks, so storing merged counts adds
+    contexts in the order counting them one by one would.
+    """
+
+    def __init__(
+        self, orders: Optional[Dict[int, Tuple[ndarray, ndarray, ndarray]]] = None
+    ):
+        self.orders = {} if orders is None else orders
+
+    @classmethod
+    def merge(cls, packed: List["PackedCounts"]) -> "PackedCounts":
+        orders = {}
+        for length in sorted({length for counts in packed for length in counts.orders}):
+            parts = [
+                counts.orders[length] for counts in packed if length in counts.orders
+            ]
+            ngrams = np.concatenate([ngrams for ngrams, _, _ in parts])
+            first, inverse = _unique_rows(ngrams)
+            counts = np.zeros(len(first), dtype=np.int64)
+            np.add.at(
+                counts, inverse, np.concatenate([counts for _, counts, _ in parts])
+            )
+            ranks = np.full(len(first), np.iinfo(np.int64).max)
+            np.minimum.at(
+                ranks, inverse, np.concatenate([ranks for _, _, ranks in parts])
+            )
+            orders[length] = ngrams[first], counts, ranks
+        return cls(orders)
+
+    def remap(
+        self, mapping: Optional[ndarray] = None, rank_offset: int = 0
+    ) -> "PackedCounts":
+        """Renumbers tokens by ``mapping`` and moves the ranks after ``rank_offset``."""
+        orders = {}
+        for length, (ngrams, counts, ranks) in self.orders.items():
+            if mapping is not None:
+                ngrams = np.where(ngrams >= 0, mapping[ngrams], ngrams)
+            orders[length] = ngrams, counts, ranks + rank_offset
+        return PackedCounts(orders)
+
+    def rank_end(self) -> int:
+        return max(
+            (
+                int(ranks.max()) + 1
+                for _, _, ranks in self.orders.values()
+                if len(ranks)
+            ),
+            default=0,
+        )
+
+    def items(self) -> Iterator[ContextCounts]:
+        """``(context, tokens, counts)`` by first occurrence, the tokens too."""
+        contexts, context_ranks, sizes = [], [], []
+        row_context_ranks, row_ranks, tokens, counts = [], [], [], []
+        for length, (ngrams, ngram_counts, ranks) in self.orders.items():
+            first, inverse = _unique_rows(ngrams[:, :length])
+            # a context ranks as its earliest ngram, ranks are all distinct
+            first_ranks = np.full(len(first), np.iinfo(np.int64).max)
+            np.minimum.at(first_ranks, inverse, ranks)
+            contexts.extend(map(tuple, ngrams[first, :length].tolist()))
+            context_ranks.append(first_ranks)
+            sizes.append(np.bincount(inverse, minlength=len(first)))
+            row_context_ranks.append(first_ranks[inverse])
+            row_ranks.append(ranks)
+            tokens.append(ngrams[:, length])
+            counts.append(ngram_counts)
+        if not contexts:
+            return iter(())
+        order = np.argsort(np.concatenate(context_ranks))
+        contexts = [contexts[index] for index in order.tolist()]
+        bounds = np.concatenate(([0], np.cumsum(np.concatenate(sizes)[order])))
+        slices = list(map(slice, bounds[:-1].tolist(), bounds[1:].tolist()))
+        # the rows of a context together, both by rank
+        rows = np.lexsort(
+            (np.concatenate(row_ranks), np.concatenate(row_context_ranks))
+        )
+        tokens = np.concatenate(tokens)[rows].tolist()
+        counts = np.concatenate(counts)[rows].tolist()
+        return zip(
+            contexts,
+            map(tokens.__getitem__, slices),
+            map(counts.__getitem__, slices),
+        )
+
+    def __len__(self) -> int:
+        return sum(len(counts) for _, counts, _ in self.orders.values())
+
+
+class NGramStorage:
+    # read-only storages are loaded into a writable one before training
+    writable = True
+
+    def add(self, context: Tuple[int, ...], token: int, count: int = 1) -> None:
+        raise NotImplementedError
+
+    def update(self, counts: Iterable[NGramCount]) -> None:
+        for context, token, count in counts:
+            self.add(context, token, count)
+
+    def update_successors(self, items: Iterable[ContextCounts]) -> None:
+        for context, tokens, counts in items:
+            for token, count in zip(tokens, counts):
+                self.add(context, token, count)
+
+    def counts(self) -> Iterator[NGramCount]:
+        for context, tokens, counts in self.items():
+            yield from zip((context,) * len(tokens), tokens.tolist(), counts.tolist())
+
+    def successors(self, context: Tuple[int, ...]) -> Optional[Successors]:
+        raise NotImplementedError
+
+    def successors_many(
+        self, contexts: List[Tuple[int, ...]]
+    ) -> List[Optional[Successors]]:
+        return [self.successors(context) for context in contexts]
+
+    def longest_suffix(self, context: Tuple[int, ...]) -> Optional[Successors]:
+        while len(context) > 0:
+            successors = self.successors(context)
+            if successors is not None:
+                return successors
+            context = context[1:]
+        return None
+
+    def context_at(self, index: int) -> Tuple[int, ...]:
+        raise NotImplementedError
+
+    def items(self) -> Iterator[Tuple[Tuple[int, ...], ndarray, ndarray]]:
+        raise NotImplementedError
+
+    def memory_usage(self) -> int:
+        raise NotImplementedError
+
+    def error_bound(self) -> Tuple[int, float]:
+        """Largest overcount of any stored count and the probability it holds."""
+        return 0, 1.0
+
+    def empty_like(self) -> "NGramStorage":
+        return type(self)()
+
+    def __len__(self) -> int:
+        raise NotImplementedError
+
+
+class DictStorage(NGramStorage):
+    def __init__(self, ngram_mapping: Optional[Dict] = None):
+        self._ngram_mapping = {} if ngram_mapping is None else ngram_mapping
+
+    def add(self, context: Tuple[int, ...], token: int, count: int = 1) -> None:
+        next_tokens_to_count_map = self._ngram_mapping.get(context, dict())
+        next_tokens_to_count_map[token] = next_tokens_to_count_map.get(token, 0) + count
+        self._ngram_mapping[context] = next_tokens_to_count_map
+
+    def update_successors(self, items: Iterable[ContextCounts]) -> None:
+        ngram_mapping = self._ngram_mapping
+        for context, tokens, counts in items:
+            next_tokens_to_count_map = ngram_mapping.get(context)
+            if next_tokens_to_count_map is None:
+                ngram_mapping[context] = dict(zip(tokens, counts))
+                continue
+            for token, count in zip(tokens, counts):
+                next_tokens_to_count_map[token] = (
+                    next_tokens_to_count_map.get(token, 0) + count
+                )
+
+    def successors(self, context: Tuple[int, ...]) -> Optional[Successors]:
+        next_tokens_to_count_map = self._ngram_mapping.get(context)
+        if next_tokens_to_count_map is None:
+            return None
+        return (
+            np.array(list(next_tokens_to_count_map.keys())),
+            np.array(list(next_tokens_to_count_map.values())),
+        )
+
+    def context_at(self, index: int) -> Tuple[int, ...]:
+        return next(islice(self._ngram_mapping.keys(), index, None))
+
+    def items(self) -> Iterator[Tuple[Tuple[int, ...], ndarray, ndarray]]:
+        for context in self._ngram_mapping:
+            yield (context, *self.successors(context))
+
+    def memory_usage(self) -> int:
+        size = sys.getsizeof(self._ngram_mapping)
+        for context, next_tokens_to_count_map in self._ngram_mapping.items():
+            size += sys.getsizeof(context) + sum(map(sys.getsizeof, context))
+            size += sys.getsizeof(next_tokens_to_count_map)
+            for token, count in next_tokens_to_count_map.items():
+                size += sys.getsizeof(token) + sys.getsizeof(count)
+        return size
+
+    def __len__(self) -> int:
+        return len(self._ngram_mapping)
+
+
+class ArrayStorage(NGramStorage):
+    ARRAYS = (
+        "keys",
+        "context_offsets",
+        "context_tokens",
+        "successor_offsets",
+        "successor_tokens",
+        "successor_counts",
+    )
+
+    def __init__(self, buffer_size: int = 1_000_000):
+        self._buffer_size = buffer_size
+        self._pending = {}
+        self._keys = np.zeros(0, dtype=np.uint64)
+        self._context_offsets = np.zeros(1, dtype=np.int64)
+        self._context_tokens = np.zeros(0, dtype=np.int32)
+        self._successor_offsets = np.zeros(1, dtype=np.int64)
+        self._successor_tokens = np.zeros(0, dtype=np.int32)
+        self._successor_counts = np.zeros(0, dtype=np.uint32)
+
+    @classmethod
+    def from_arrays(cls, arrays: Dict[str, ndarray]) -> "ArrayStorage":
+        storage = cls()
+        for name in cls.ARRAYS:
+            setattr(storage, f"_{name}", arrays[name])
+        return storage
+
+    @classmethod
+    def from_storage(cls, storage: NGramStorage) -> "ArrayStorage":
+        if isinstance(storage, cls):
+            return storage
+        array_storage = cls()
+        array_storage.update(storage.counts())
+        array_storage.compact()
+        return array_storage
+
+    def to_arrays(self) -> Dict[str, ndarray]:
+        self.compact()
+        return {name: getattr(self, f"_{name}") for name in self.ARRAYS}
+
+    def add(self, context: Tuple[int, ...], token: int, count: int = 1) -> None:
+        key = (context, token)
+        self._pending[key] = self._pending.get(key, 0) + count
+        if len(self._pending) >= self._buffer_size:
+            self.compact()
+
+    def successors(self, context: Tuple[int, ...]) -> Optional[Successors]:
+        self.compact()
+        index = self._find(context)
+        if index is None:
+            return None
+        start, end = self._successor_offsets[index : index + 2]
+        return self._successor_tokens[start:end], self._successor_counts[start:end]
+
+    def context_at(self, index: int) -> Tuple[int, ...]:
+        self.compact()
+        start, end = self._context_offsets[index : index + 2]
+        return tuple(self._context_tokens[start:end].tolist())
+
+    def items(self) -> Iterator[Tuple[Tuple[int, ...], ndarray, ndarray]]:
+        self.compact()
+        for index in range(len(self._keys)):
+            start, end = self._successor_offsets[index : index + 2]
+            yield (
+                self.context_at(index),
+                self._successor_tokens[start:end],
+                self._successor_counts[start:end],
+            )
+
+    def memory_usage(self) -> int:
+        arrays = (getattr(self, f"_{name}") for name in self.ARRAYS)
+        return sum(array.nbytes for array in arrays) + sys.getsizeof(self._pending)
+
+    def compact(self) -> None:
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+
+        context_count = len(self._keys)
+        indices, new_contexts = {}, []
+        entry_contexts, entry_tokens, entry_counts = [], [], []
+        for (context, token), count in pending.items():
+            index = indices.get(context)
+            if index is None:
+                index = self._find(context)
+                if index is None:
+                    index = context_count + len(new_contexts)
+                    new_contexts.append(context)
+                indices[context] = index
+            entry_contexts.append(index)
+            entry_tokens.append(token)
+            entry_counts.append(count)
+
+        new_keys = np.fromiter(
+            map(hash_context, new_contexts), dtype=np.uint64, count=len(new_contexts)
+        )
+        new_lengths = np.fromiter(
+            map(len, new_contexts), dtype=np.int64, count=len(new_contexts)
+        )
+        keys = np.concatenate((self._keys, new_keys))
+        context_lengths = np.concatenate((np.diff(self._context_offsets), new_lengths))
+        context_tokens = np.concatenate(
+            (
+                self._context_tokens,
+                np.fromiter(
+                    (token for context in new_contexts for token in context),
+                    dtype=np.int32,
+                    count=int(new_lengths.sum()),
+                ),
+            )
+        )
+        context_starts = np.concatenate(([0], np.cumsum(context_lengths)[:-1]))
+
+        entry_contexts = np.concatenate(
+            (
+                np.repeat(np.arange(context_count), np.diff(self._successor_offsets)),
+                np.array(entry_contexts, dtype=np.int64),
+            )
+        )
+        entry_tokens = np.concatenate(
+            (self._successor_tokens, np.array(entry_tokens, dtype=np.int32))
+        )
+        entry_counts = np.concatenate(
+            (self._successor_counts, np.array(entry_counts, dtype=np.uint32))
+        )
+
+        order = np.argsort(keys, kind="stable")
+        position = np.empty_like(order)
+        position[order] = np.arange(len(order))
+        entry_contexts = position[entry_contexts]
+
+        entries = np.lexsort((entry_tokens, entry_contexts))
+        entry_contexts = entry_contexts[entries]
+        entry_tokens = entry_tokens[entries]
+        first = np.ones(len(entries), dtype=bool)
+        first[1:] = (np.diff(entry_contexts) != 0) | (np.diff(entry_tokens) != 0)
+        first = np.flatnonzero(first)
+        entry_counts = np.add.reduceat(
+            entry_counts[entries].astype(np.int64), first
+        ).astype(np.uint32)
+
+        self._keys = keys[order]
+        self._context_offsets = np.concatenate(
+            ([0], np.cumsum(context_lengths[order]))
+        ).astype(np.int64)
+        self._context_tokens = context_tokens[
+            np.repeat(
+                context_starts[order] - self._context_offsets[:-1],
+                context_lengths[order],
+            )
+            + np.arange(len(context_tokens))
+        ]
+        self._successor_offsets = np.concatenate(
+            ([0], np.cumsum(np.bincount(entry_contexts[first], minlength=len(keys))))
+        ).astype(np.int64)
+        self._successor_tokens = entry_tokens[first]
+        self._successor_counts = entry_counts
+
+    def partition(self, count: int) -> Tuple[ndarray, Iterator[Dict[str, ndarray]]]:
+        """Splits the contexts into ``count`` shards by their hash.
+
+        Returns the location ``row * count + shard`` of every context and the
+        arrays of every shard, its contexts keep their relative order.
+        """
+        self.compact()
+        shards = (self._keys % np.uint64(count)).astype(np.int64)
+        order = np.argsort(shards, kind="stable")
+        sizes = np.bincount(shards, minlength=count)
+        starts = np.cumsum(sizes) - sizes
+        rows = np.empty(len(shards), dtype=np.int64)
+        rows[order] = np.arange(len(shards)) - np.repeat(starts, sizes)
+
+        def shard_arrays() -> Iterator[Dict[str, ndarray]]:
+            for start, size in zip(starts.tolist(), sizes.tolist()):
+                selected = order[start : start + size]
+                context_offsets, context_tokens = _gather(
+                    self._context_offsets, self._context_tokens, selected
+                )
+                successor_offsets, successor_tokens = _gather(
+                    self._successor_offsets, self._successor_tokens, selected
+                )
+                _, successor_counts = _gather(
+                    self._successor_offsets, self._successor_counts, selected
+                )
+                yield {
+                    "keys": self._keys[selected],
+                    "context_offsets": context_offsets,
+                    "context_tokens": context_tokens,
+                    "successor_offsets": successor_offsets,
+                    "successor_tokens": successor_tokens,
+                    "successor_counts": successor_counts,
+                }
+
+        return rows * count + shards, shard_arrays()
+
+    def _find(self, context: Tuple[int, ...]) -> Optional[int]:
+        key = hash_context(context)
+        index = int(np.searchsorted(self._keys, key))
+        context = list(context)
+        while index < len(self._keys) and self._keys[index] == key:
+            start, end = self._context_offsets[index : index + 2]
+            if self._context_tokens[start:end].tolist() == context:
+                return index
+            index += 1
+        return None
+
+    def _hash_all(self) -> ndarray:
+        keys = np.zeros(len(self._context_offsets) - 1, dtype=np.uint64)
+        lengths = np.diff(self._context_offsets)
+        for length in np.unique(lengths).tolist():
+            indices = np.flatnonzero(lengths == length)
+            columns = self._context_offsets[indices][:, None] + np.arange(length)
+            keys[indices] = hash_contexts(self._context_tokens[columns])
+        return keys
+
+    def __getstate__(self):
+        self.compact()
+        state = self.__dict__.copy()
+        state["_keys"] = None
+        state["_context_offsets"] = _narrow(np.diff(self._context_offsets))
+        state["_context_tokens"] = _narrow(self._context_tokens)
+        state["_successor_offsets"] = _narrow(np.diff(self._successor_offsets))
+        state["_successor_tokens"] = _narrow(self._successor_tokens)
+        state["_successor_counts"] = _narrow(self._successor_counts)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        for name in ("_context_offsets", "_successor_offsets"):
+            lengths = getattr(self, name)
+            offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+            np.cumsum(lengths, out=offsets[1:])
+            setattr(self, name, offsets)
+        self._context_tokens = self._context_tokens.astype(np.int32)
+        self._successor_tokens = self._successor_tokens.astype(np.int32)
+        self._successor_counts = self._successor_counts.astype(np.uint32)
+        self._keys = self._hash_all()
+
+    def __len__(self) -> int:
+        self.compact()
+        return len(self._keys)
+
+
+class TrieStorage(NGramStorage):
+    """Trie over reversed contexts, a shared suffix is stored once.
+
+    Node 0 is the root, the children of a node are consecutive and sorted by
+    token, so a node is addressed by its parent and the child offsets alone.
+    """
+
+    ARRAYS = (
+        "node_tokens",
+        "child_offsets",
+        "successor_offsets",
+        "successor_tokens",
+        "successor_counts",
+    )
+    _PAD = np.int64(np.iinfo(np.int64).min)
+
+    def __init__(self, buffer_size: int = 1_000_000):
+        self._buffer_size = buffer_size
+        self._pending = {}
+        self._node_tokens = np.zeros(1, dtype=np.int32)
+        self._child_offsets = np.zeros(2, dtype=np.int64)
+        self._successor_offsets = np.zeros(2, dtype=np.int64)
+        self._successor_tokens = np.zeros(0, dtype=np.int32)
+        self._successor_counts = np.zeros(0, dtype=np.uint32)
+        self._index()
+
+    @classmethod
+    def from_arrays(cls, arrays: Dict[str, ndarray]) -> "TrieStorage":
+        storage = cls()
+        for name in cls.ARRAYS:
+            setattr(storage, f"_{name}", arrays[name])
+        storage._index()
+        return storage
+
+    def to_arrays(self) -> Dict[str, ndarray]:
+        self.compact()
+        return {name: getattr(self, f"_{name}") for name in self.ARRAYS}
+
+    def add(self, context: Tuple[int, ...], token: int, count: int = 1) -> None:
+        key = (context, token)
+        self._pending[key] = self._pending.get(key, 0) + count
+        if len(self._pending) >= self._buffer_size:
+            self.compact()
+
+    def successors(self, context: Tuple[int, ...]) -> Optional[Successors]:
+        self.compact()
+        node = 0
+        for token in reversed(context):
+            node = self._child(node, token)
+            if node is None:
+                return None
+        return self._node_successors(node)
+
+    def longest_suffix(self, context: Tuple[int, ...]) -> Optional[Successors]:
+        self.compact()
+        tokens, children = self._token_view, self._child_view
+        successors = self._successor_view
+        node, found = 0, None
+        # the most recent token first, every node passed is a longer suffix
+        for token in reversed(context):
+            start, end = children[node] + 1, children[node + 1] + 1
+            node = bisect_left(tokens, token, start, end)
+            if node == end or tokens[node] != token:
+                break
+            if successors[node] != successors[node + 1]:
+                found = node
+        return None if found is None else self._node_successors(found)
+
+    def context_at(self, index: int) -> Tuple[int, ...]:
+        self.compact()
+        node = int(self._contexts[index])
+        context = []
+        while node:
+            context.append(self._token_view[node])
+            node = self._parent_view[node]
+        return tuple(context)
+
+    def items(self) -> Iterator[Tuple[Tuple[int, ...], ndarray, ndarray]]:
+        self.compact()
+        for index, node in enumerate(self._contexts.tolist()):
+            yield (self.context_at(index), *self._node_successors(node))
+
+    def memory_usage(self) -> int:
+        arrays = (getattr(self, f"_{name}") for name in self.ARRAYS)
+        return (
+            sum(array.nbytes for array in arrays)
+            + self._parents.nbytes
+            + self._contexts.nbytes
+            + sys.getsizeof(self._pending)
+        )
+
+    def compact(self) -> None:
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+
+        old_contexts = self._reversed_contexts()
+        indices, new_contexts = {}, []
+        entry_contexts, entry_tokens, entry_counts = [], [], []
+        for (context, token), count in pending.items():
+            index = indices.get(context)
+            if index is None:
+                index = indices[context] = len(old_contexts) + len(new_contexts)
+                new_contexts.append(context[::-1])
+            entry_contexts.append(index)
+            entry_tokens.append(token)
+            entry_counts.append(count)
+
+        width = max(old_contexts.shape[1], *map(len, new_contexts))
+        contexts = np.full((len(old_contexts) + len(new_contexts), width), self._PAD)
+        contexts[: len(old_contexts), : old_contexts.shape[1]] = old_contexts
+        for row, context in enumerate(new_contexts, start=len(old_contexts)):
+            contexts[row, : len(context)] = context
+        # sorted rows place every trie level in parent order
+        contexts, inverse = np.unique(contexts, axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+
+        old_count = len(self._contexts)
+        old_lengths = np.diff(self._successor_offsets)[self._contexts]
+        terminals = self._build(contexts)
+        entry_nodes = terminals[
+            inverse[
+                np.concatenate(
+                    (
+                        np.repeat(np.arange(old_count), old_lengths),
+                        np.array(entry_contexts, dtype=np.int64),
+                    )
+                )
+            ]
+        ]
+        entry_tokens = np.concatenate(
+            (self._successor_tokens, np.array(entry_tokens, dtype=np.int32))
+        )
+        entry_counts = np.concatenate(
+            (self._successor_counts, np.array(entry_counts, dtype=np.uint32))
+        )
+
+        entries = np.lexsort((entry_tokens, entry_nodes))
+        entry_nodes = entry_nodes[entries]
+        entry_tokens = entry_tokens[entries]
+        first = np.ones(len(entries), dtype=bool)
+        first[1:] = (np.diff(entry_nodes) != 0) | (np.diff(entry_tokens) != 0)
+        first = np.flatnonzero(first)
+        self._successor_counts = np.add.reduceat(
+            entry_counts[entries].astype(np.int64), first
+        ).astype(np.uint32)
+        self._successor_tokens = entry_tokens[first]
+        self._successor_offsets = np.concatenate(
+            (
+                [0],
+                np.cumsum(
+                    np.bincount(entry_nodes[first], minlength=len(self._node_tokens))
+                ),
+            )
+        ).astype(np.int64)
+        self._index()
+
+    def _build(self, contexts: ndarray) -> ndarray:
+        lengths = (contexts != self._PAD).sum(axis=1)
+        differs = np.ones(contexts.shape, dtype=bool)
+        differs[1:] = np.logical_or.accumulate(contexts[1:] != contexts[:-1], axis=1)
+
+        node_tokens, parents = [np.zeros(1, dtype=np.int32)], []
+        row_nodes = np.zeros(len(contexts), dtype=np.int64)
+        terminals = np.zeros(len(contexts), dtype=np.int64)
+        node_count = 1
+        for depth in range(1, contexts.shape[1] + 1):
+            valid = lengths >= depth
+            starts = valid & differs[:, depth - 1]
+            start_rows = np.flatnonzero(starts)
+            nodes = np.cumsum(starts) - 1 + node_count
+            node_tokens.append(contexts[start_rows, depth - 1].astype(np.int32))
+            parents.append(row_nodes[start_rows])
+            row_nodes = np.where(valid, nodes, row_nodes)
+            terminals[lengths == depth] = nodes[lengths == depth]
+            node_count += len(start_rows)
+
+        self._node_tokens = np.concatenate(node_tokens)
+        self._child_offsets = np.concatenate(
+            ([0], np.cumsum(np.bincount(np.concatenate(parents), minlength=node_count)))
+        ).astype(np.int64)
+        return terminals
+
+    def _reversed_contexts(self) -> ndarray:
+        nodes = self._contexts
+        steps = []
+        while nodes.any():
+            steps.append(np.where(nodes > 0, self._node_tokens[nodes], self._PAD))
+            nodes = self._parents[nodes]
+        if not steps:
+            return np.zeros((len(nodes), 0), dtype=np.int64)
+        forward = np.stack(steps, axis=1)
+        depths = (forward != self._PAD).sum(axis=1)
+        columns = depths[:, None] - 1 - np.arange(forward.shape[1])
+        rows = np.arange(len(forward))[:, None]
+        return np.where(columns >= 0, forward[rows, np.maximum(columns, 0)], self._PAD)
+
+    def _index(self) -> None:
+        self._parents = np.concatenate(
+            (
+                [0],
+                np.repeat(
+                    np.arange(len(self._child_offsets) - 1),
+                    np.diff(self._child_offsets),
+                ),
+            )
+        ).astype(np.int64)
+        self._contexts = np.flatnonzero(np.diff(self._successor_offsets))
+        # longest_suffix bisects and indexes these once per context word, items
+        # of a memoryview are Python ints rather than numpy scalars
+        self._token_view = memoryview(np.ascontiguousarray(self._node_tokens))
+        self._parent_view = memoryview(self._parents)
+        self._child_view = memoryview(np.ascontiguousarray(self._child_offsets))
+        self._successor_view = memoryview(np.ascontiguousarray(self._successor_offsets))
+
+    def _child(self, node: int, token: int) -> Optional[int]:
+        # children of a node are the consecutive nodes after its child offset
+        start, end = self._child_view[node] + 1, self._child_view[node + 1] + 1
+        index = bisect_left(self._token_view, token, start, end)
+        if index < end and self._token_view[index] == token:
+            return index
+        return None
+
+    def _node_successors(self, node: int) -> Optional[Successors]:
+        start, end = self._successor_view[node], self._successor_view[node + 1]
+        if start == end:
+            return None
+        return self._successor_tokens[start:end], self._successor_counts[start:end]
+
+    def __getstate__(self):
+        self.compact()
+        state = self.__dict__.copy()
+        for name in ("_parents", "_contexts", "_token_view", "_parent_view"):
+            del state[name]
+        del state["_child_view"], state["_successor_view"]
+        state["_node_tokens"] = _narrow(self._node_tokens)
+        state["_child_offsets"] = _narrow(np.diff(self._child_offsets))
+        state["_successor_offsets"] = _narrow(np.diff(self._successor_offsets))
+        state["_successor_tokens"] = _narrow(self._successor_tokens)
+        state["_successor_counts"] = _narrow(self._successor_counts)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        for name in ("_child_offsets", "_successor_offsets"):
+            lengths = getattr(self, name)
+            offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+            np.cumsum(lengths, out=offsets[1:])
+            setattr(self, name, offsets)
+        self._node_tokens = self._node_tokens.astype(np.int32)
+        self._successor_tokens = self._successor_tokens.astype(np.int32)
+        self._successor_counts = self._successor_counts.astype(np.uint32)
+        self._index()
+
+    def __len__(self) -> int:
+        self.compact()
+        return len(self._contexts)
+
+
+class SketchStorage(DictStorage):
+    """Approximate counts within a fixed memory budget.
+
+    At most ``capacity`` ngrams are counted in the table, and with
+    ``memory_budget`` only as many as keep ``memory_usage()`` within that many
+    bytes, the sketch included. On overflow the less frequent half is folded
+    into a count-min sketch. An ngram seen again starts from its sketch
+    estimate, so counts are never underestimated and are overestimated by at
+    most ``error_bound()``.
+
+    The sketch is only needed to count on and is pickled without it, training
+    code saves it to ``sketch_path`` with ``save_sketch``.
+    """
+
+    MAGIC = b"TGUSKTCH"
+    _MULTIPLIERS = (
+        0x9E3779B97F4A7C15,
+        0xBF58476D1CE4E5B9,
+        0x94D049BB133111EB,
+        0xD6E8FEB86659FD93,
+        0xA0761D6478BD642F,
+        0xE7037ED1A0B428DB,
+        0x8EBC6AF09C88C6E3,
+        0x589965CC75374CC3,
+    )
+
+    def __init__(
+        self,
+        capacity: Optional[int] = 1_000_000,
+        width: int = 1 << 22,
+        depth: int = 4,
+        memory_budget: Optional[int] = None,
+    ):
+        if not 1 <= depth <= len(self._MULTIPLIERS):
+            raise ValueError(f"depth must be from 1 to {len(self._MULTIPLIERS)}")
+        super().__init__()
+        self._capacity = sys.maxsize if capacity is None else max(capacity, 2)
+        self._memory_budget = memory_budget
+        self._width = 1 << max(width - 1, 1).bit_length()
+        self._depth = depth
+        self._shift = 65 - self._width.bit_length()
+        self._sketch = np.zeros((depth, self._width), dtype=np.uint32)
+        self._offsets = {}
+        self._size = 0
+        # memory_usage of the entries, kept up to date as they are added
+        self._entry_bytes = 0
+        self._folded = 0
+        self._inherited_error = 0
+        self._index()
+
+    @classmethod
+    def for_budget(cls, memory_budget: int, depth: int = 4) -> "SketchStorage":
+        """Spends a quarter of ``memory_budget`` bytes on the sketch."""
+        width = 1 << max((memory_budget // 4 // (4 * depth)).bit_length() - 1, 1)
+        return cls(capacity=None, width=width, depth=depth, memory_budget=memory_budget)
+
+    @staticmethod
+    def sketch_path(path: Path) -> Path:
+        return path.with_name(f"{path.name}.sketch")
+
+    def save_sketch(self, path: Path) -> bool:
+        """Returns False without writing when nothing was folded into the sketch."""
+        if not self._folded:
+            return False
+        write_model_file(
+            path,
+            metadata={
+                "width": self._width,
+                "depth": self._depth,
+                "folded": self._folded,
+            },
+            arrays={"sketch": self._sketch},
+            magic=self.MAGIC,
+        )
+        return True
+
+    def load_sketch(self, path: Path) -> None:
+        if not self._folded:
+            return
+        if not path.exists():
+            raise ModelFileError(f"{path} is missing, counting cannot go on")
+        metadata, arrays = read_model_file(path, magic=self.MAGIC)
+        if (metadata["width"], metadata["depth"], metadata["folded"]) != (
+            self._width,
+            self._depth,
+            self._folded,
+        ):
+            raise ModelFileError(f"{path} is the sketch of another model")
+        self._sketch = np.array(arrays["sketch"])
+        self._index()
+
+    def add(self, context: Tuple[int, ...], token: int, count: int = 1) -> None:
+        if self._rows is None:
+            raise ValueError("the sketch was not loaded, see load_sketch")
+        next_tokens_to_count_map = self._ngram_mapping.get(context)
+        if next_tokens_to_count_map is None:
+            next_tokens_to_count_map = self._ngram_mapping[context] = {}
+            self._entry_bytes += self._context_bytes(context, next_tokens_to_count_map)
+        current = next_tokens_to_count_map.get(token)
+        if current is not None:
+            next_tokens_to_count_map[token] = current + count
+            return
+        current = self._estimate(context, token) if self._folded else 0
+        if current:
+            key = (context, token)
+            self._offsets[key] = current
+            self._entry_bytes += self._offset_bytes(key, current)
+        map_size = sys.getsizeof(next_tokens_to_count_map)
+        next_tokens_to_count_map[token] = current + count
+        self._entry_bytes += (
+            sys.getsizeof(next_tokens_to_count_map)
+            - map_size
+            + sys.getsizeof(token)
+            + sys.getsizeof(current + count)
+        )
+        self._size += 1
+        if self._size > self._capacity:
+            self._evict(self._capacity // 2)
+        elif self._memory_budget is not None:
+            while self._size and self._measured_bytes() > self._memory_budget:
+                self._evict(self._size // 2)
+
+    def update_successors(self, items: Iterable[ContextCounts]) -> None:
+        # every count goes through add, which evicts
+        NGramStorage.update_successors(self, items)
+
+    def memory_usage(self) -> int:
+        size = super().memory_usage()
+        if self._sketch is not None:
+            size += self._sketch.nbytes
+        size += sys.getsizeof(self._offsets)
+        for key, offset in self._offsets.items():
+            size += self._offset_bytes(key, offset)
+        return size
+
+    def error_bound(self) -> Tuple[int, float]:
+        # count-min: every estimate exceeds the folded count by at most
+        # e / width * folded with probability 1 - exp(-depth)
+        bound = math.ceil(math.e / self._width * self._folded)
+        return self._inherited_error + bound, 1 - math.exp(-self._depth)
+
+    def empty_like(self) -> "SketchStorage":
+        storage = type(self)(
+            self._capacity, self._width, self._depth, self._memory_budget
+        )
+        storage._inherited_error = self.error_bound()[0]
+        return storage
+
+    def _index(self) -> None:
+        if self._sketch is None:
+            self._rows = None
+            return
+        # _estimate reads one cell of every row per counted ngram
+        self._rows = [
+            (memoryview(row), multiplier)
+            for row, multiplier in zip(self._sketch, self._MULTIPLIERS)
+        ]
+
+    def _estimate(self, context: Tuple[int, ...], token: int) -> int:
+        # tuples of ints hash the same in every process
+        key = hash((context, token)) & _MASK
+        shift = self._shift
+        return min(
+            [
+                row[((key * multiplier) & _MASK) >> shift]
+                for row, multiplier in self._rows
+            ]
+        )
+
+    @staticmethod
+    def _context_bytes(context: Tuple[int, ...], next_tokens_to_count_map) -> int:
+        size = sys.getsizeof(context) + sys.getsizeof(next_tokens_to_count_map)
+        return size + sum(map(sys.getsizeof, context))
+
+    @staticmethod
+    def _offset_bytes(key: Tuple[Tuple[int, ...], int], offset: int) -> int:
+        return sys.getsizeof(key) + sys.getsizeof(key[1]) + sys.getsizeof(offset)
+
+    def _measured_bytes(self) -> int:
+        # memory_usage without a pass over the entries
+        size = self._entry_bytes + 4 * self._depth * self._width
+        return size + sys.getsizeof(self._ngram_mapping) + sys.getsizeof(self._offsets)
+
+    def _evict(self, kept: int) -> None:
+        entries = [
+            (context, token, count)
+            for context, next_tokens_to_count_map in self._ngram_mapping.items()
+            for token, count in next_tokens_to_count_map.items()
+        ]
+        counts = np.fromiter(
+            (count for _, _, count in entries), dtype=np.int64, count=len(entries)
+        )
+        evicted = self._size - kept
+        indices = np.argpartition(counts, evicted - 1)[:evicted].tolist()
+
+        keys, masses = [], []
+        for index in indices:
+            context, token, count = entries[index]
+            key = (context, token)
+            keys.append(hash(key))
+            # the offset came from the sketch and is already folded in
+            masses.append(count - self._offsets.pop(key, 0))
+            next_tokens_to_count_map = self._ngram_mapping[context]
+            del next_tokens_to_count_map[token]
+            if not next_tokens_to_count_map:
+                del self._ngram_mapping[context]
+
+        keys = np.array(keys, dtype=np.int64).view(np.uint64)
+        masses = np.array(masses, dtype=np.uint32)
+        multipliers = np.array(self._MULTIPLIERS[: self._depth], dtype=np.uint64)
+        with np.errstate(over="ignore"):
+            columns = (keys * multipliers[:, None]) >> np.uint64(self._shift)
+        for row, row_columns in zip(self._sketch, columns.astype(np.int64)):
+            np.add.at(row, row_columns, masses)
+        self._folded += int(masses.sum())
+        self._size -= evicted
+        # maps keep their size when entries are deleted, so measure them again
+        self._entry_bytes = sum(
+            self._context_bytes(context, next_tokens_to_count_map)
+            + sum(map(sys.getsizeof, next_tokens_to_count_map.keys()))
+            + sum(map(sys.getsizeof, next_tokens_to_count_map.values()))
+            for context, next_tokens_to_count_map in self._ngram_mapping.items()
+        )
+        self._entry_bytes += sum(
+            self._offset_bytes(key, offset) for key, offset in self._offsets.items()
+        )
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_rows"]
+        # saved apart by save_sketch, generating from the counts never needs it
+        state["_sketch"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if not self._folded:
+            # an untouched sketch is only zeros
+            self._sketch = np.zeros((self._depth, self._width), dtype=np.uint32)
+        self._index()
+
+
+class ShardInfo(NamedTuple):
+    shards: int
+    resident: int
+    loads: int
+    evictions: int
+    hits: int
+
+
+class ShardedStorage(NGramStorage):
+    """Read-only contexts split into files by context hash, loaded on first use.
+
+    At most ``resident`` shards stay in memory, the least recently used one is
+    dropped to load another. ``locations`` gives the shard and row of every
+    context in the order of the unsharded ``ArrayStorage``, so ``context_at``
+    and ``successors`` return exactly what it would.
+    """
+
+    MAGIC = b"TGUSHARD"
+    writable = False
+
+    def __init__(
+        self, paths: List[Path], locations: ndarray, model_id: str, resident: int = 4
+    ):
+        self._paths = paths
+        self._locations = locations
+        self._model_id = model_id
+        self._resident = max(resident, 1)
+        self._shards: "OrderedDict[int, ArrayStorage]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._loads = self._evictions = self._hits = 0
+
+    @staticmethod
+    def shard_path(path: Path, index: int) -> Path:
+        return path.with_name(f"{path.name}.shard-{index:05d}")
+
+    def successors(self, context: Tuple[int, ...]) -> Optional[Successors]:
+        shard = self._shard(hash_context(context) % len(self._paths))
+        successors = shard.successors(context)
+        if successors is None:
+            return None
+        # views would keep an evicted shard alive in the sampling cache
+        tokens, counts = successors
+        return tokens.copy(), counts.copy()
+
+    def successors_many(
+        self, contexts: List[Tuple[int, ...]]
+    ) -> List[Optional[Successors]]:
+        """Looks the contexts up shard by shard, each shard is loaded at most once."""
+        by_shard: Dict[int, List[int]] = {}
+        for position, context in enumerate(contexts):
+            index = hash_context(context) % len(self._paths)
+            by_shard.setdefault(index, []).append(position)
+        with self._lock:
+            resident = set(self._shards)
+        found: List[Optional[Successors]] = [None] * len(contexts)
+        # the resident shards first, loading the others may evict them
+        for index in sorted(by_shard, key=lambda index: index not in resident):
+            shard = self._shard(index)
+            for position in by_shard[index]:
+                successors = shard.successors(contexts[position])
+                if successors is not None:
+                    tokens, counts = successors
+                    found[position] = tokens.copy(), counts.copy()
+        return found
+
+    def context_at(self, index: int) -> Tuple[int, ...]:
+        row, shard = divmod(int(self._locations[index]), len(self._paths))
+        return self._shard(shard).context_at(row)
+
+    def items(self) -> Iterator[Tuple[Tuple[int, ...], ndarray, ndarray]]:
+        for index in range(len(self._paths)):
+            yield from self._shard(index).items()
+
+    def memory_usage(self) -> int:
+        with self._lock:
+            shards = list(self._shards.values())
+        return self._locations.nbytes + sum(shard.memory_usage() for shard in shards)
+
+    def empty_like(self) -> "ArrayStorage":
+        return ArrayStorage()
+
+    def info(self) -> ShardInfo:
+        with self._lock:
+            return ShardInfo(
+                len(self._paths),
+                len(self._shards),
+                self._loads,
+                self._evictions,
+                self._hits,
+            )
+
+    def _shard(self, index: int) -> "ArrayStorage":
+        with self._lock:
+            shard = self._shards.get(index)
+            if shard is not None:
+                self._hits += 1
+                self._shards.move_to_end(index)
+                return shard
+            shard = self._load(index)
+            self._loads += 1
+            self._shards[index] = shard
+            if len(self._shards) > self._resident:
+                self._shards.popitem(last=False)
+                self._evictions += 1
+            return shard
+
+    def _load(self, index: int) -> "ArrayStorage":
+        path = self._paths[index]
+        metadata, arrays = read_model_file(path, magic=self.MAGIC)
+        if metadata.get("model") != self._model_id:
+            raise ModelFileError(f"{path} belongs to another save of the model")
+        # copied out of the mapping, an evicted shard leaves no pages behind
+        return ArrayStorage.from_arrays(
+            {name: np.array(arrays[name]) for name in ArrayStorage.ARRAYS}
+        )
+
+    def __reduce__(self):
+        # unpickled with every shard loaded, the shard files may be gone by then
+        return ArrayStorage.from_arrays, (ArrayStorage.from_storage(self).to_arrays(),)
+
+    def __len__(self) -> int:
+        return len(self._locations)
@@ -0,0 +1,57 @@
+import gzip
+import re
+from pathlib import Path
+from typing import Iterable, Iterator, List, Optional, TextIO, Tuple
+
+
+def iter_files(input_dir: Path) -> Iterator[Path]:
+    queue = list(input_dir.glob(pattern="*"))
+    for path in queue:
+        if path.name.startswith("."):
+            # hidden files such as the crawler state are not texts
+            continue
+        if not path.is_file():
+            queue.extend(path.glob(pattern="*"))
+            continue
+        yield path
+
+
+def open_text(path: Path) -> TextIO:
+    if path.suffix == ".gz":
+        return gzip.open(path, "rt", encoding="utf-8")
+    return path.open()
+
+
+class ChunkReader:
+    def __init__(self, chunk_size: int = 1 << 20):
+        self._chunk_size = chunk_size
+        self._until_last_terminator = re.compile(r".*(?:[^\s\w]|[_])", re.DOTALL)
+
+    def read_files(self, paths: Iterable[Path]) -> Iterator[Tuple[str, Optional[Path]]]:
+        for path in paths:
+            previous = None
+            with open_text(path) as fp:
+                for text in self.read(fp):
+                    if previous is not None:
+                        yield previous, None
+                    previous = text
+            # the last chunk of a file carries its path
+            yield previous or "", path
+
+    def read(self, fp: TextIO) -> Iterator[str]:
+        carry: List[str] = []
+        while chunk := fp.read(self._chunk_size):
+            boundary = self._last_boundary(chunk)
+            if boundary is None:
+                # a sentence longer than a chunk, keep it whole
+                carry.append(chunk)
+                continue
+            yield "".join((*carry, chunk[:boundary]))
+            carry = [chunk[boundary:]]
+        if tail := "".join(carry):
+            yield tail
+
+    def _last_boundary(self, chunk: str) -> Optional[int]:
+        if match := self._until_last_terminator.match(chunk):
+            return match.end()
+        return None
@@ -0,0 +1,94 @@
+import hashlib
+import re
+from typing import Iterator, List, Tuple
+
+import numpy as np
+from numpy import ndarray
+
+from src.dictionary import Dictionary
+from src.profiling import profiled
+
+# letters without digits, underscore and whatever [a-z] matches ignoring case
+_WORD = r"[^\W\d_A-Za-z\u0130\u0131\u017f\u212a]+"
+_TERMINATORS = r"(?:[^\s\w]|_)+"
+# bump when cleaning outside the regexes changes, corpus caches are rebuilt then
+RULES_VERSION = 1
+
+
+class Tokenizer:
+    """Cleans text, splits sentences and words in a single regex pass.
+
+    Follows the SentenceSplitter rules: digits and latin letters separate
+    words, any other non-word character ends a sentence.
+    """
+
+    def __init__(
+        self,
+        dictionary: Dictionary,
+        min_word_length: int = 0,
+        chunk_size: int = 1 << 16,
+    ):
+        self._dictionary = dictionary
+        self._min_word_length = min_word_length
+        self._chunk_size = chunk_size
+        self._tokens = re.compile(f"({_WORD})|{_TERMINATORS}")
+        self._whitespace = re.compile(r"\s")
+
+    def fingerprint(self) -> str:
+        """Differs between tokenizers that can split the same text differently."""
+        rules = f"{RULES_VERSION}\n{self._tokens.pattern}\n{self._min_word_length}"
+        return hashlib.sha1(rules.encode()).hexdigest()
+
+    def sentences(self, raw_text: str) -> Iterator[Tuple[str, ...]]:
+        words = []
+        for matches in self._matches(raw_text):
+            for word in matches:
+                if not word:
+                    if words:
+                        yield tuple(words)
+                        words = []
+                elif len(word) > self._min_word_length:
+                    words.append(word)
+        if words:
+            yield tuple(words)
+
+    def tokenize(self, raw_text: str) -> Iterator[List[int]]:
+        observe = self._dictionary.observe
+        tokens = []
+        for matches in self._matches(raw_text):
+            for word in matches:
+                if not word:
+                    if tokens:
+                        yield tokens
+                        tokens = []
+                elif len(word) > self._min_word_length:
+                    tokens.append(observe(word))
+        if tokens:
+            yield tokens
+
+    @profiled("tokenize")
+    def encode(self, raw_text: str) -> Tuple[ndarray, ndarray]:
+        tokens, lengths = [], []
+        for sentence in self.tokenize(raw_text):
+            tokens.extend(sentence)
+            lengths.append(len(sentence))
+        return np.array(tokens, dtype=np.int64), np.array(lengths, dtype=np.int64)
+
+    def _matches(self, raw_text: str) -> Iterator[List[str]]:
+        """Words of a chunk, an empty string stands for a sentence terminator."""
+        start = 0
+        while start < len(raw_text):
+            end = start + self._chunk_size
+            if end < len(raw_text):
+                # cutting after whitespace changes neither lower() nor matches
+                cut = max(
+                    raw_text.rfind(" ", start, end), raw_text.rfind("\n", start, end)
+                )
+                if cut > start:
+                    end = cut + 1
+                elif match := self._whitespace.search(raw_text, end):
+                    end = match.end()
+                else:
+                    end = len(raw_text)
+            yield self._tokens.findall(raw_text[start:end].lower())
+            start = end
@@ -1,36 +1,59 @@
 import fileinput
 import logging
+import os
 import pickle
 import sys
+import threading
+import time
+import uuid
+from collections import deque
 from math import inf
 from pathlib import Path
-from typing import Optional, List
+from typing import Dict, Iterable, Iterator, Optional, List, Tuple
 
 import numpy as np
 from numpy import ndarray
+from numpy.random import Generator
 from torch.utils.data import DataLoader
 from tqdm import tqdm
 
+from src.corpus_cache import TokenCorpus
+from src.counter import NGramCounter
 from src.dataset import TokenDataset
-from src.dictionary import Dictionary
+from src.dedup import Deduplicator
+from src.dictionary import Dictionary, MappedDictionary
 from src.model import NGramModel, NGramModelError
+from src.storage import ShardedStorage, ShardInfo, SketchStorage
+from src.model_file import is_model_file, read_model_file, write_model_file
+from src.parallel import Shard, ShardedCounter
+from src.profiling import PROFILER, profiled
+from src.stream import ChunkReader, iter_files
+from src.tokenizer import Tokenizer
 
 from pyfillet import WordEmbedder
 
-from src.utils import angle_between
-
 logger = logging.getLogger(__name__)
 
+# Generation may run in several threads, state built lazily on first use and
+# words of unseen prefixes registered in the dictionary are guarded by it. It
+# is not an attribute since trainers are pickled.
+_generation_lock = threading.RLock()
+
 
 class Trainer:
+    BINARY_SUFFIX = ".bin"
+
     def __init__(
         self,
         ngram_model: NGramModel,
         dictionary: Dictionary,
-        embedder: WordEmbedder,
+        embedder: Optional[WordEmbedder],
         ngram: int = 2,
         min_ngram: int = 1,
         nsamples: int = 10,
+        bulk: bool = False,
+        chunk_size: int = 1 << 20,
+        workers: int = 1,
     ):
         self._ngram_model = ngram_model
         self._dictionary = dictionary
@@ -38,29 +61,183 @@ class Trainer:
         self._ngram = ngram
         self._min_ngram = min_ngram
         self._nsamples = nsamples
+        self._bulk = bulk
+        self._chunk_size = chunk_size
+        self._workers = workers
+        self._manifest: Dict[str, Tuple[int, int]] = {}
+        self._embeddings: Optional[ndarray] = None
+        self._embedding_norms: Optional[ndarray] = None
+
+    def fit(
+        self,
+        input_dir: Optional[str],
+        checkpoint_path: Optional[Path] = None,
+        checkpoint_interval: float = inf,
+        deduplicator: Optional[Deduplicator] = None,
+        checkpoint_shards: int = 1,
+    ):
+        """Trains on texts of ``input_dir`` or stdin.
 
-    def fit(self, input_dir: Optional[str]):
-        texts = []
+        With ``deduplicator`` the texts are deduplicated before counting, it
+        keeps the statistics of what was removed. Checkpoints are saved with
+        ``checkpoint_shards`` shards, as the final model is.
+        """
+        reader = ChunkReader(chunk_size=self._chunk_size)
         if input_dir is not None:
-            input_dir = Path(input_dir)
-            queue = list(input_dir.glob(pattern="*"))
-            for path in queue:
-                if not path.is_file():
-                    queue.extend(path.glob(pattern="*"))
+            paths = []
+            for path in iter_files(Path(input_dir)):
+                if self._is_ingested(path):
+                    logger.debug("Skipping already ingested %s", path)
                     continue
-                raw_text = path.read_text()
-                texts.append(raw_text)
+                paths.append(path)
+            total = sum(path.stat().st_size for path in paths)
+            texts = reader.read_files(paths)
         else:
-            for line in sys.stdin:
-                raw_text = line
-                texts.append(raw_text)
-                break
-        self._run_iterative(texts=texts)
+            total = None
+            texts = ((text, None) for text in reader.read(sys.stdin))
+        if deduplicator is not None:
+            texts = deduplicator.filter(texts)
+        self._run_iterative(
+            self._fit_texts(PROFILER.iterate("read", texts)),
+            total=total,
+            checkpoint_path=checkpoint_path,
+            checkpoint_interval=checkpoint_interval,
+            checkpoint_shards=checkpoint_shards,
+        )
+        self._build_embeddings()
+
+    def fit_corpus(
+        self,
+        corpus: TokenCorpus,
+        checkpoint_path: Optional[Path] = None,
+        checkpoint_interval: float = inf,
+        checkpoint_shards: int = 1,
+    ):
+        """Trains on a pre-tokenized corpus, already ingested files are skipped."""
+        files = []
+        for file in corpus.files:
+            if self._is_ingested(Path(file)):
+                logger.debug("Skipping already ingested %s", file)
+                continue
+            files.append(file)
+        # counts of the new files only, the cached vocabulary covers all of them
+        mapping = self._dictionary.union(
+            corpus.dictionary, counts=corpus.token_counts(files)
+        )
+        self._run_iterative(
+            self._fit_corpus_files(corpus, files, mapping),
+            total=sum(corpus.files[file][0] for file in files),
+            checkpoint_path=checkpoint_path,
+            checkpoint_interval=checkpoint_interval,
+            checkpoint_shards=checkpoint_shards,
+        )
+        self._build_embeddings()
+
+    def _is_ingested(self, path: Path) -> bool:
+        ingested = self._manifest.get(str(path.resolve()))
+        if ingested is None:
+            return False
+        stat = path.stat()
+        if ingested != (stat.st_size, stat.st_mtime_ns):
+            # counting it again would count its old text twice
+            raise ValueError(
+                f"{path} changed since it was ingested, its old counts cannot be "
+                "taken back: retrain without --resume or restore the file"
+            )
+        return True
+
+    def _mark_ingested(self, path: Path) -> None:
+        stat = path.stat()
+        self._manifest[str(path.resolve())] = (stat.st_size, stat.st_mtime_ns)
+
+    def _run_iterative(
+        self,
+        fitted: Iterable[Tuple[int, int, Optional[Path]]],
+        total: Optional[int] = None,
+        checkpoint_path: Optional[Path] = None,
+        checkpoint_interval: float = inf,
+        checkpoint_shards: int = 1,
+    ):
+        token_count = 0
+        last_checkpoint = time.monotonic()
+        with tqdm(total=total, unit="B", unit_scale=True) as progress:
+            for text_bytes, text_tokens, path in fitted:
+                token_count += text_tokens
+                progress.update(text_bytes)
+                progress.set_postfix(tokens=token_count)
+                if path is None:
+                    continue
+                self._mark_ingested(path)
+                if (
+                    checkpoint_path is not None
+                    and time.monotonic() - last_checkpoint >= checkpoint_interval
+                ):
+                    logger.info("Writing checkpoint to %s", checkpoint_path)
+                    self.save(checkpoint_path, shards=checkpoint_shards)
+                    last_checkpoint = time.monotonic()
+        logger.info("Trained on %s tokens", token_count)
+
+    def _fit_texts(
+        self, texts: Iterable[Tuple[str, Optional[Path]]]
+    ) -> Iterator[Tuple[int, int, Optional[Path]]]:
+        if self._workers > 1:
+            counter = ShardedCounter(
+                workers=self._workers, ngram=self._ngram, min_ngram=self._min_ngram
+            )
+            paths = deque()
+
+            def texts_only():
+                for text, path in texts:
+                    paths.append(path)
+                    yield text
 
-    def _run_iterative(self, texts: List[str]):
-        for text in tqdm(texts):
-            dataloader = self._prepare_dataloader(raw_text=text)
-            self._fit_iteration(dataloader)
+            for shard in PROFILER.iterate("shards", counter.count(texts_only())):
+                self._merge_shard(shard)
+                yield shard.byte_count, shard.token_count, paths.popleft()
+            return
+        counter = self._prepare_counter() if self._bulk else None
+        for text, path in texts:
+            if counter is not None:
+                token_count = counter.fit(self._ngram_model, raw_text=text)
+            else:
+                dataloader = self._prepare_dataloader(raw_text=text)
+                self._fit_iteration(dataloader)
+                token_count = dataloader.dataset.token_count()
+            yield len(text.encode()), token_count, path
+
+    def _fit_corpus_files(
+        self, corpus: TokenCorpus, files: List[str], mapping: ndarray
+    ) -> Iterator[Tuple[int, int, Optional[Path]]]:
+        counter = self._prepare_counter() if self._bulk else None
+        for file in files:
+            token_count = 0
+            for tokens, lengths in corpus.blocks(file, self._chunk_size):
+                tokens = mapping[tokens]
+                if counter is not None:
+                    for counts in counter.count(tokens, lengths):
+                        self._ngram_model.update(counts)
+                else:
+                    dataset = TokenDataset.from_tokens(
+                        self._dictionary,
+                        tokens,
+                        lengths,
+                        ngram=self._ngram,
+                        min_ngram=self._min_ngram,
+                    )
+                    self._fit_iteration(DataLoader(dataset, batch_size=1))
+                token_count += len(tokens)
+            yield corpus.files[file][0], token_count, Path(file)
+
+    def _merge_shard(self, shard: Shard) -> None:
+        mapping = self._dictionary.union(shard.dictionary)
+        self._ngram_model.merge(shard.counts, mapping)
+
+    def _prepare_counter(self) -> NGramCounter:
+        return NGramCounter(
+            dictionary=self._dictionary,
+            ngram=self._ngram,
+            min_ngram=self._min_ngram,
+        )
 
     def _prepare_dataloader(self, raw_text: str) -> DataLoader:
         dataset = TokenDataset(
@@ -74,128 +251,499 @@ class Trainer:
     def _fit_iteration(self, dataloader: DataLoader) -> None:
         self._ngram_model.fit(dataloader)
 
-    def _pretty_sentence(self, sentence_tokens: List[int]) -> str:
-        sentence = tuple(self._dictionary.decode(token) for token in sentence_tokens)
-        return f"{' '.join(sentence).capitalize()}."
+    def _pretty_sentence(self, sentence_tokens: List[int], prefix: List[str]) -> str:
+        """``prefix`` words stand for the first tokens, unknown ones included."""
+        words = self._dictionary.decode_many(sentence_tokens[len(prefix) :])
+        return f"{' '.join([*prefix, *words]).capitalize()}."
+
+    def _pretty_text(self, sentences: List[List[int]], prefix: List[str]) -> str:
+        return "\n".join(
+            [
+                self._pretty_sentence(sentence, prefix if index == 0 else [])
+                for index, sentence in enumerate(sentences)
+            ]
+        )
 
-    def _pretty_text(self, sentences: List[List[int]]) -> str:
-        return "\n".join([self._pretty_sentence(sentence) for sentence in sentences])
+    @profiled("prefix")
+    def _get_sentence_tokens(
+        self, sentence: Optional[List[str]], random_state: Optional[Generator] = None
+    ) -> Tuple[List[int], List[str]]:
+        """Tokens and words of ``sentence``, words the model lacks are unknown.
 
-    def _get_sentence_tokens(self, sentence: Optional[List[str]]):
+        The dictionary is only read, requests never add words to it.
+        """
         if sentence is None:
-            sentence_tokens = self._ngram_model.random_ngram()
-            logger.debug(
-                "Random sentence for generation: %s",
-                " ".join(self._dictionary.decode_many(sentence_tokens)),
-            )
+            sentence_tokens = list(self._ngram_model.random_ngram(random_state))
+            words = self._dictionary.decode_many(sentence_tokens)
+            logger.debug("Random sentence for generation: %s", " ".join(words))
         else:
             logger.debug("Input sentence for generation: %s", " ".join(sentence))
-            sentence_tokens = TokenDataset(
-                raw_text=" ".join(sentence), dictionary=self._dictionary
-            ).get_tokens()
-        return sentence_tokens
+            words = [
+                word
+                for words in Tokenizer(self._dictionary).sentences(" ".join(sentence))
+                for word in words
+            ]
+            sentence_tokens = self._dictionary.encode_many(words).tolist()
+        return sentence_tokens, words
+
+    def _get_embedder(self) -> WordEmbedder:
+        with _generation_lock:
+            if self._embedder is None:
+                self._embedder = WordEmbedder()
+            return self._embedder
 
-    def _embed_tokens(self, tokens: List[int]) -> List[ndarray]:
-        words = self._dictionary.decode_many(tokens)
-        return [self._embedder(word=word) for word in words]
+    @profiled("embeddings")
+    def _build_embeddings(self) -> None:
+        embeddings = getattr(self, "_embeddings", None)
+        start = 0 if embeddings is None else len(embeddings)
+        codes = list(range(start, len(self._dictionary) + 1))
+        if not codes:
+            return
+        embedder = self._get_embedder()
+        vectors = np.zeros((len(codes), embedder.dim), dtype=np.float32)
+        for row, word in enumerate(self._dictionary.decode_many(codes)):
+            if (vector := embedder(word=word)) is not None:
+                vectors[row] = vector
+        norms = np.linalg.norm(vectors, axis=1)
+        known = norms > 0
+        vectors[known] /= norms[known, None]
+        if embeddings is not None:
+            vectors = np.concatenate((embeddings, vectors))
+            norms = np.concatenate((self._embedding_norms, norms))
+        logger.info("Embedded %s of %s words", int(known.sum()), len(codes))
+        self._embeddings = vectors
+        self._embedding_norms = norms.astype(np.float32)
+
+    def _get_embeddings(self) -> Tuple[ndarray, ndarray]:
+        with _generation_lock:
+            if getattr(self, "_embeddings", None) is None:
+                self._build_embeddings()
+            return self._embeddings, self._embedding_norms
+
+    def _embed_tokens(self, tokens: List[int]) -> Tuple[ndarray, ndarray]:
+        embeddings, norms = self._get_embeddings()
+        tokens = np.asarray(tokens, dtype=np.int64)
+        # words observed after training have no row in the matrix
+        known = (tokens >= 0) & (tokens < len(embeddings))
+        tokens = np.where(known, tokens, 0)
+        return embeddings[tokens], np.where(known, norms[tokens], 0)
 
     def _get_sentence_embedding(self, sentence: List[int]) -> ndarray:
-        embeddings = self._embed_tokens(tokens=sentence)
-        return np.sum(embeddings, axis=0)
-
-    def _safe_sum(self, a: ndarray, b: Optional[ndarray]) -> ndarray:
-        if b is None:
-            return a
-        return a + b
-
-    def _choose_closest_next_token(
-        self, next_tokens: List[int], current_theme_vector: ndarray
-    ) -> (int, List[float]):
-        embeddings = self._embed_tokens(next_tokens)
-
-        def get_angle(iv):
-            _, v = iv
-            if v is None:
-                return np.inf
-            angle = angle_between(current_theme_vector, v)
-            return angle
-
-        i, closest = min(
-            enumerate(embeddings),
-            key=get_angle,
-        )
-        next_words = self._dictionary.decode_many(next_tokens)
-        logger.debug(
-            "Closest token to current theme out of %s %s is %s",
-            len(embeddings),
-            next_words,
-            next_words[i],
+        units, norms = self._embed_tokens(tokens=sentence)
+        # words without a row, unknown ones included, add nothing
+        return np.sum(units * norms[:, None], axis=0, dtype=np.float64)
+
+    @profiled("scoring")
+    def _choose_closest_next_tokens(
+        self, next_tokens: List[ndarray], current_theme_vectors: ndarray
+    ) -> Tuple[List[int], ndarray]:
+        rows = np.arange(len(next_tokens))
+        candidates = np.full(
+            (len(next_tokens), max(map(len, next_tokens))), -1, dtype=np.int64
         )
-        current_theme_vector = self._safe_sum(current_theme_vector, closest)
-        return next_tokens[i], current_theme_vector
-
-    def _generate_text(
-        self, word_to_continue_left: int, base_sentence: List[int]
-    ) -> List[List[int]]:
-        result_text = []
-        current_sentence = base_sentence
-        current_theme_vector = np.zeros(
-            self._embedder.dim,
+        for row, tokens in enumerate(next_tokens):
+            candidates[row, : len(tokens)] = tokens
+        units, norms = self._embed_tokens(candidates.ravel())
+        units = units.reshape(*candidates.shape, -1)
+        norms = norms.reshape(candidates.shape)
+        # row-wise sums give the same result for a prompt whatever the batch
+        scores = (units * current_theme_vectors[:, None, :]).sum(axis=2)
+        closest = np.where(norms > 0, scores, -np.inf).argmax(axis=1)
+        if logger.isEnabledFor(logging.DEBUG):
+            for tokens, i in zip(next_tokens, closest.tolist()):
+                next_words = self._dictionary.decode_many(tokens)
+                logger.debug(
+                    "Closest token to current theme out of %s %s is %s",
+                    len(tokens),
+                    next_words,
+                    next_words[i],
+                )
+        current_theme_vectors = (
+            current_theme_vectors + units[rows, closest] * norms[rows, closest][:, None]
         )
-        current_theme_vector = self._safe_sum(
-            current_theme_vector, self._get_sentence_embedding(current_sentence)
+        return candidates[rows, closest].tolist(), current_theme_vectors
+
+    def _generate_tokens(
+        self,
+        words_to_continue_left: List[int],
+        base_sentences: List[List[int]],
+        random_states: List[Generator],
+        ngram: int,
+    ) -> Iterator[Tuple[int, List[int], bool]]:
+        """Yields ``(index, tokens, new_sentence)`` as sentence ``index`` grows.
+
+        A new sentence starts with ``tokens`` when the current one cannot be
+        continued. Only the last ``ngram`` tokens of each sentence are kept.
+        """
+        # an order of 0 continues the whole sentence
+        contexts = [
+            deque(sentence, maxlen=ngram or None) for sentence in base_sentences
+        ]
+        current_theme_vectors = np.stack(
+            [self._get_sentence_embedding(sentence) for sentence in base_sentences]
         )
-        for i in range(word_to_continue_left):
-            tokens_to_continue = tuple(current_sentence[-self._ngram :])
-            logger.debug(
-                "Generating token %s for %s (%s)",
-                i + 1,
+        for i in range(max(words_to_continue_left, default=0)):
+            active = [
+                index
+                for index, words_left in enumerate(words_to_continue_left)
+                if i < words_left
+            ]
+            tokens_to_continue = [tuple(contexts[index]) for index in active]
+            if logger.isEnabledFor(logging.DEBUG):
+                for tokens in tokens_to_continue:
+                    logger.debug(
+                        "Generating token %s for %s (%s)",
+                        i + 1,
+                        tokens,
+                        self._dictionary.decode_many(tokens),
+                    )
+            next_tokens = self._ngram_model.samples_many(
                 tokens_to_continue,
-                self._dictionary.decode_many(tokens_to_continue),
+                k=self._nsamples,
+                random_states=[random_states[index] for index in active],
             )
-            try:
-                next_tokens = self._ngram_model.samples(
-                    tokens_to_continue, k=self._nsamples
-                )
-                next_token, current_theme_vector = self._choose_closest_next_token(
-                    next_tokens=next_tokens,
-                    current_theme_vector=current_theme_vector,
-                )
-                current_sentence.append(next_token)
-            except NGramModelError:
-                next_tokens = self._ngram_model.random_ngram()
+            continued = []
+            for index, tokens in zip(active, next_tokens):
+                if tokens is not None:
+                    continued.append(index)
+                    continue
+                tokens = list(self._ngram_model.random_ngram(random_states[index]))
                 logger.debug(
                     "Cannot continue, starting new sentence with %s",
-                    self._dictionary.decode_many(next_tokens),
+                    self._dictionary.decode_many(tokens),
                 )
-                result_text.append(current_sentence)
-                current_sentence = list(next_tokens)
-        result_text.append(current_sentence)
-        return result_text
+                contexts[index] = deque(tokens, maxlen=ngram or None)
+                yield index, tokens, True
+            if not continued:
+                continue
+            next_tokens, theme_vectors = self._choose_closest_next_tokens(
+                next_tokens=[tokens for tokens in next_tokens if tokens is not None],
+                current_theme_vectors=current_theme_vectors[continued],
+            )
+            current_theme_vectors[continued] = theme_vectors
+            for index, token in zip(continued, next_tokens):
+                contexts[index].append(token)
+                yield index, [token], False
+
+    def _generate_texts(
+        self,
+        words_to_continue_left: List[int],
+        base_sentences: List[List[int]],
+        random_states: List[Generator],
+        ngram: int,
+    ) -> List[List[List[int]]]:
+        result_texts = [[list(sentence)] for sentence in base_sentences]
+        for index, tokens, new_sentence in self._generate_tokens(
+            words_to_continue_left, base_sentences, random_states, ngram
+        ):
+            if new_sentence:
+                result_texts[index].append(tokens)
+            else:
+                result_texts[index][-1].extend(tokens)
+        return result_texts
+
+    def _check_ngram(self, ngram: Optional[int]) -> int:
+        ngram = self._ngram if ngram is None else ngram
+        if not self._min_ngram <= ngram <= self._ngram:
+            raise ValueError(
+                f"ngram {ngram} is out of the trained orders "
+                f"{self._min_ngram}..{self._ngram}"
+            )
+        return ngram
+
+    def continue_(
+        self,
+        sentence: Optional[List[str]],
+        word_count: int,
+        seed: Optional[int] = None,
+        ngram: Optional[int] = None,
+    ) -> str:
+        return self.continue_many(
+            [sentence], word_count=word_count, seeds=[seed], ngram=ngram
+        )[0]
+
+    def stream(
+        self,
+        sentence: Optional[List[str]],
+        word_count: int,
+        seed: Optional[int] = None,
+        ngram: Optional[int] = None,
+    ) -> Iterator[str]:
+        """Yields the text of ``continue_`` piece by piece as words are generated.
+
+        The pieces joined are what ``continue_`` returns for the same seed. Only
+        the current context is kept, so memory does not grow with ``word_count``.
+        """
+        ngram = self._check_ngram(ngram)
+        random_state = np.random.default_rng(seed)
+        sentence_tokens, words = self._get_sentence_tokens(sentence, random_state)
+        base_sentence = sentence_tokens[:word_count]
+        logger.debug("Starting with %s", words[:word_count])
+        yield from self._pretty_pieces(words[:word_count], first=True)
+        started = bool(base_sentence)
+        for _, tokens, new_sentence in self._generate_tokens(
+            words_to_continue_left=[word_count - len(sentence_tokens)],
+            base_sentences=[base_sentence],
+            random_states=[random_state],
+            ngram=ngram,
+        ):
+            if new_sentence:
+                yield ".\n"
+            yield from self._pretty_pieces(
+                self._dictionary.decode_many(tokens), first=new_sentence or not started
+            )
+            started = True
+        yield "."
+
+    def _pretty_pieces(self, words: List[str], first: bool) -> Iterator[str]:
+        # the same words as _pretty_sentence, which capitalizes the whole sentence
+        for word in words:
+            yield word.capitalize() if first else f" {word.lower()}"
+            first = False
+
+    def continue_many(
+        self,
+        sentences: List[Optional[List[str]]],
+        word_count: int,
+        seeds: Optional[List[Optional[int]]] = None,
+        ngram: Optional[int] = None,
+    ) -> List[str]:
+        """Continues every sentence by ``word_count`` words.
+
+        ``ngram`` picks the order used for generation, any order the model was
+        trained on works since the counts of all of them are kept.
 
-    def continue_(self, sentence: Optional[List[str]], word_count: int):
-        sentence_tokens = self._get_sentence_tokens(sentence)
+        Every sentence draws from its own generator seeded with its seed, so the
+        result for a seed does not depend on the other sentences of the batch or
+        on calls running in other threads. Sentences without a seed get fresh
+        entropy, the global random state is never used.
+        """
+        ngram = self._check_ngram(ngram)
+        if not sentences:
+            return []
+        if seeds is None:
+            seeds = [None] * len(sentences)
+        random_states = [np.random.default_rng(seed) for seed in seeds]
         logger.debug("Target length: %s", word_count)
         logger.debug("Dictionary len = %s", len(self._dictionary))
 
-        current_sentence = []
-        current_sentence.extend(sentence_tokens[:word_count])
-        word_to_continue_left = word_count - len(sentence_tokens)
-        logger.debug("Starting with %s", self._dictionary.decode_many(current_sentence))
-        logger.debug("Words to generate %s", word_to_continue_left)
-        result_text = self._generate_text(
-            word_to_continue_left=word_to_continue_left, base_sentence=current_sentence
+        base_sentences = []
+        prefixes = []
+        words_to_continue_left = []
+        for sentence, random_state in zip(sentences, random_states):
+            sentence_tokens, words = self._get_sentence_tokens(sentence, random_state)
+            base_sentences.append(sentence_tokens[:word_count])
+            prefixes.append(words[:word_count])
+            words_to_continue_left.append(word_count - len(sentence_tokens))
+            logger.debug("Starting with %s", prefixes[-1])
+            logger.debug("Words to generate %s", words_to_continue_left[-1])
+        result_texts = self._generate_texts(
+            words_to_continue_left=words_to_continue_left,
+            base_sentences=base_sentences,
+            random_states=random_states,
+            ngram=ngram,
         )
-        return self._pretty_text(result_text)
+        logger.debug("Sampling cache: %s", self._ngram_model.cache_info())
+        if (shard_info := self._ngram_model.shard_info()) is not None:
+            logger.debug("Shards: %s", shard_info)
+        with PROFILER.phase("decode"):
+            return [
+                self._pretty_text(result_text, prefix)
+                for result_text, prefix in zip(result_texts, prefixes)
+            ]
+
+    def shard_info(self) -> Optional[ShardInfo]:
+        return self._ngram_model.shard_info()
 
-    def save(self, path: Path) -> None:
+    def context_count(self) -> int:
+        return self._ngram_model.context_count()
+
+    def memory_usage(self) -> int:
+        return self._ngram_model.memory_usage()
+
+    def is_approximate(self) -> bool:
+        return self._ngram_model.is_approximate()
+
+    def error_bound(self) -> Tuple[int, float]:
+        return self._ngram_model.error_bound()
+
+    def prune_vocabulary(
+        self,
+        min_count: int = 1,
+        max_vocab: Optional[int] = None,
+        referenced: Optional[ndarray] = None,
+    ) -> int:
+        dictionary = self._dictionary
+        vocabulary_size = len(dictionary)
+        mapping = dictionary.prune(
+            min_count=min_count, max_vocab=max_vocab, referenced=referenced
+        )
+        self._ngram_model.remap(mapping)
+
+        if getattr(self, "_embeddings", None) is not None:
+            codes = np.arange(min(len(mapping), len(self._embeddings)))
+            codes = codes[mapping[codes] != Dictionary.UNKNOWN_CODE]
+            embeddings = np.zeros(
+                (len(dictionary) + 1, self._embeddings.shape[1]), dtype=np.float32
+            )
+            norms = np.zeros(len(dictionary) + 1, dtype=np.float32)
+            embeddings[mapping[codes]] = self._embeddings[codes]
+            norms[mapping[codes]] = self._embedding_norms[codes]
+            self._embeddings, self._embedding_norms = embeddings, norms
+        pruned = vocabulary_size - len(dictionary)
+        logger.info("Pruned %s of %s words", pruned, vocabulary_size)
+        return pruned
+
+    def prune(
+        self,
+        min_count: int = 1,
+        min_context_count: int = 1,
+        entropy_threshold: float = 0.0,
+    ) -> Tuple[int, int]:
+        """Drops rare ngrams, see NGramModel.prune, then the words no ngram uses.
+
+        Returns the numbers of removed ngrams and words.
+        """
+        ngrams = self._ngram_model.prune(
+            min_count=min_count,
+            min_context_count=min_context_count,
+            entropy_threshold=entropy_threshold,
+        )
+        logger.info("Pruned %s ngrams", ngrams)
+        referenced = self._ngram_model.referenced_tokens(len(self._dictionary) + 1)
+        words = self.prune_vocabulary(min_count=0, referenced=referenced)
+        return ngrams, words
+
+    @profiled("save")
+    def save(self, path: Path, shards: int = 1) -> None:
+        if path.suffix == self.BINARY_SUFFIX:
+            self.save_binary(path, shards=shards)
+            return
+        if shards > 1:
+            raise ValueError(f"only {self.BINARY_SUFFIX} models can be sharded")
+        # only needed to resume training, written first as shards are
+        sketch_path = SketchStorage.sketch_path(path)
+        if not self._ngram_model.save_sketch(sketch_path):
+            sketch_path.unlink(missing_ok=True)
         to_dump = self
-        with path.open("wb") as fp:
+        temporary_path = path.with_name(f"{path.name}.tmp")
+        with temporary_path.open("wb") as fp:
             pickle.dump(to_dump, fp)
+        os.replace(temporary_path, path)
+
+    def save_binary(self, path: Path, shards: int = 1) -> None:
+        """With ``shards`` above one the contexts go to ``path.shard-NNNNN`` files.
+
+        The shards are written before ``path``, which is replaced last and names
+        the save they belong to. Approximate counts are not saved this way, the
+        sketch and its error bound would be lost. The counts are stored in
+        ``ArrayStorage`` order, so a seed generates other text than it does with a
+        pickle of another storage.
+        """
+        if self.is_approximate():
+            raise ValueError(
+                f"approximate counts cannot be saved as {self.BINARY_SUFFIX}, "
+                "save them as a pickle"
+            )
+        metadata = {
+            "ngram": self._ngram,
+            "min_ngram": self._min_ngram,
+            "nsamples": self._nsamples,
+            "seed": self._ngram_model._seed,
+            "manifest": getattr(self, "_manifest", {}),
+        }
+        if shards > 1:
+            metadata["shards"] = shards
+            metadata["model_id"] = uuid.uuid4().hex
+            locations, shard_arrays = self._ngram_model.to_shards(shards)
+            for index, arrays in enumerate(shard_arrays):
+                write_model_file(
+                    ShardedStorage.shard_path(path, index),
+                    metadata={"model": metadata["model_id"], "shard": index},
+                    arrays=arrays,
+                    magic=ShardedStorage.MAGIC,
+                )
+            ngram_arrays = {"context_locations": locations}
+        else:
+            ngram_arrays = self._ngram_model.to_arrays()
+        # shards of an earlier save with more of them
+        index = shards if shards > 1 else 0
+        while (stale := ShardedStorage.shard_path(path, index)).exists():
+            stale.unlink()
+            index += 1
+        arrays = {**self._dictionary.to_arrays(), **ngram_arrays}
+        if getattr(self, "_embeddings", None) is not None:
+            arrays["embeddings"] = self._embeddings
+            arrays["embedding_norms"] = self._embedding_norms
+        write_model_file(path, metadata=metadata, arrays=arrays)
 
     @classmethod
-    def load(cls, path: Path) -> "Trainer":
+    @profiled("load")
+    def load(cls, path: Path, resident_shards: int = 4) -> "Trainer":
+        """``resident_shards`` limits the shards of a sharded model kept in memory."""
+        if is_model_file(path):
+            return cls._load_binary(path, resident_shards)
         with path.open("rb") as fp:
             dumped = pickle.load(fp)
 
         return dumped
+
+    @classmethod
+    def _load_binary(cls, path: Path, resident_shards: int = 4) -> "Trainer":
+        metadata, arrays = read_model_file(path)
+        if "shards" in metadata:
+            storage = ShardedStorage(
+                [
+                    ShardedStorage.shard_path(path, index)
+                    for index in range(metadata["shards"])
+                ],
+                arrays["context_locations"],
+                model_id=metadata["model_id"],
+                resident=resident_shards,
+            )
+            ngram_model = NGramModel(seed=metadata["seed"], storage=storage)
+        else:
+            ngram_model = NGramModel.from_arrays(arrays, seed=metadata["seed"])
+        trainer = cls(
+            ngram_model=ngram_model,
+            dictionary=MappedDictionary(
+                vocab_offsets=arrays["vocab_offsets"],
+                vocab_buffer=arrays["vocab_buffer"],
+                vocab_sorted=arrays["vocab_sorted"],
+                vocab_counts=arrays.get("vocab_counts"),
+            ),
+            embedder=None,
+            ngram=metadata["ngram"],
+            min_ngram=metadata["min_ngram"],
+            nsamples=metadata["nsamples"],
+        )
+        trainer._manifest = {
+            file: tuple(stat) for file, stat in metadata["manifest"].items()
+        }
+        if "embeddings" in arrays:
+            trainer._embeddings = arrays["embeddings"]
+            trainer._embedding_norms = arrays["embedding_norms"]
+        return trainer
+
+    @classmethod
+    def resume(
+        cls,
+        path: Path,
+        bulk: bool = False,
+        chunk_size: int = 1 << 20,
+        workers: int = 1,
+    ) -> "Trainer":
+        trainer = cls.load(path)
+        trainer._ngram_model.make_writable()
+        trainer._ngram_model.load_sketch(SketchStorage.sketch_path(path))
+        trainer._bulk = bulk
+        trainer._chunk_size = chunk_size
+        trainer._workers = workers
+        trainer._manifest = getattr(trainer, "_manifest", {})
+        logger.info(
+            "Resuming training with ngram=%s, min_ngram=%s, %s files already ingested",
+            trainer._ngram,
+            trainer._min_ngram,
+            len(trainer._manifest),
+        )
+        return trainer
@@ -0,0 +1,101 @@
+import gzip
+import sys
+from pathlib import Path
+from unittest.mock import patch
+
+import numpy as np
+import pytest
+
+import src.tokenizer
+from src.corpus_cache import TokenCorpus, open_corpus
+from src.trainer import Trainer
+from tests.conftest import TRAIN_TEXT
+from tests.test_model import TEXTS
+from train import main
+
+
+@pytest.fixture()
+def corpus_dir(tmp_path):
+    directory = tmp_path / 'texts'
+    directory.mkdir()
+    (directory / 'first.txt').write_text(TRAIN_TEXT)
+    with gzip.open(directory / 'second.txt.gz', 'wt') as fp:
+        fp.write('\n'.join(TEXTS[1:]))
+    return directory
+
+
+def train(*args):
+    with patch.object(sys, 'argv', ['train.py', '--ngram', '3', *map(str, args)]):
+        main()
+    return Trainer.load(Path(args[args.index('--model') + 1]))
+
+
+def model_counts(trainer):
+    decode = trainer._dictionary.decode_many
+    return sorted(
+        (tuple(decode(context)), *decode([token]), count)
+        for context, token, count in trainer._ngram_model._storage.counts()
+    )
+
+
+class TestCorpusCache:
+    @pytest.mark.parametrize('bulk', [[], ['--bulk']])
+    def test_matches_text_training(self, corpus_dir, tmp_path, bulk):
+        cache = tmp_path / 'corpus.cache'
+        expected = train('--input-dir', corpus_dir, '--model', tmp_path / 'a.pkl', *bulk)
+        cached = train(
+            '--input-dir', corpus_dir, '--cache', cache, '--model', tmp_path / 'b.pkl',
+            *bulk,
+        )
+        # without --input-dir the cache is used as it is
+        reused = train('--cache', cache, '--model', tmp_path / 'c.pkl', *bulk)
+
+        for trainer in (cached, reused):
+            assert model_counts(trainer) == model_counts(expected)
+            assert dict(zip(trainer._dictionary.decode_many(range(1, 50)),
+                            trainer._dictionary.counts()[1:].tolist())) == dict(
+                zip(expected._dictionary.decode_many(range(1, 50)),
+                    expected._dictionary.counts()[1:].tolist()))
+            assert len(trainer._manifest) == 2
+
+    def test_invalidation(self, corpus_dir, tmp_path):
+        cache = tmp_path / 'corpus.cache'
+        corpus = open_corpus(cache, corpus_dir)
+        assert len(corpus.files) == 2
+        mtime = cache.stat().st_mtime_ns
+
+        assert open_corpus(cache).tokens.sum() == corpus.tokens.sum()
+        assert cache.stat().st_mtime_ns == mtime
+
+        (corpus_dir / 'third.txt').write_text('новый файл')
+        assert len(open_corpus(cache, corpus_dir).files) == 3
+
+        (corpus_dir / 'first.txt').write_text('другой текст')
+        corpus = open_corpus(cache)
+        assert corpus.dictionary.encode('другой') > 0
+        assert corpus.dictionary.encode('руслан') == -1
+
+        mtime = cache.stat().st_mtime_ns
+        with patch.object(src.tokenizer, 'RULES_VERSION', 0):
+            assert not TokenCorpus.load(cache).is_current(
+                [Path(file) for file in corpus.files]
+            )
+            open_corpus(cache)
+        assert cache.stat().st_mtime_ns != mtime
+
+    def test_spilled_arrays(self, corpus_dir, tmp_path):
+        cache = tmp_path / 'corpus.cache'
+        corpus = open_corpus(cache, corpus_dir, chunk_size=64)
+
+        assert sorted(path.name for path in tmp_path.iterdir()) == [
+            'corpus.cache', 'texts',
+        ]
+        assert corpus.sentence_offsets[0] == 0
+        assert corpus.sentence_offsets[-1] == len(corpus.tokens)
+        assert (corpus.dictionary.counts()
+                == np.bincount(corpus.tokens, minlength=len(corpus.dictionary) + 1)).all()
+        empty = tmp_path / 'empty'
+        empty.mkdir()
+        corpus = open_corpus(tmp_path / 'empty.cache', empty)
+        assert len(corpus.tokens) == 0
+        assert corpus.sentence_offsets.tolist() == [0]
@@ -0,0 +1,142 @@
+import asyncio
+import gzip
+import json
+import sys
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import patch
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+from src.crawler import Crawler, WikipediaSource
+from src.stream import ChunkReader, iter_files
+from src.trainer import Trainer
+from train import main as train_main
+
+PAGES = {f'Статья {i}': f'Текст статьи номер {i}. Второе предложение.' for i in range(30)}
+DISAMBIGUATION = 'Многозначная'
+FLAKY = 'Статья 7'
+
+
+class MockWikipedia(BaseHTTPRequestHandler):
+    def do_GET(self):
+        query = {k: v[0] for k, v in parse_qs(urlparse(self.path).query).items()}
+        if query.get('list') == 'random':
+            titles = [*PAGES, DISAMBIGUATION][: int(query['rnlimit'])]
+            self._respond(200, {'query': {'random': [{'title': t} for t in titles]}})
+            return
+        title = query['titles']
+        self.server.requests[title] += 1
+        if title == FLAKY and self.server.requests[title] <= 2:
+            self._respond(503, {'error': 'busy'})
+            return
+        page = {'title': title}
+        if title == DISAMBIGUATION:
+            page['pageprops'] = {'disambiguation': ''}
+        else:
+            page['extract'] = PAGES[title]
+        self._respond(200, {'query': {'pages': [page]}})
+
+    def _respond(self, status, body):
+        encoded = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(encoded)))
+        self.end_headers()
+        self.wfile.write(encoded)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture()
+def api_url():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), MockWikipedia)
+    server.requests = Counter()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.server_port}/w/api.php', server.requests
+    server.shutdown()
+
+
+def crawl(api_url, output_dir, count, **kwargs):
+    crawler = Crawler(
+        WikipediaSource(api_url), output_dir, concurrency=4, backoff=0.01, **kwargs
+    )
+    return asyncio.run(crawler.crawl(count))
+
+
+def read_texts(output_dir):
+    paths = list(iter_files(output_dir))
+    assert all(path.suffix == '.gz' for path in paths)
+    return ''.join(text for text, _ in ChunkReader().read_files(paths))
+
+
+class TestCrawler:
+    def test_crawl(self, api_url, tmp_path):
+        url, requests = api_url
+        stats = crawl(url, tmp_path, 10, flush_size=100, shard_size=300)
+
+        assert stats.pages == 10 and stats.failed == 0
+        assert requests[FLAKY] == 3
+        assert len(list(tmp_path.glob('pages-*.txt.gz'))) > 1
+        texts = read_texts(tmp_path)
+        assert sum(text in texts for text in PAGES.values()) == 10
+
+    def test_resume(self, api_url, tmp_path):
+        url, requests = api_url
+        crawl(url, tmp_path, 12)
+        # a crash after writing a shard tail but before committing it
+        with (tmp_path / 'pages-00000.txt.gz').open('ab') as fp:
+            fp.write(gzip.compress('недописанная статья'.encode())[:10])
+        stats = crawl(url, tmp_path, 100)
+
+        assert stats.pages == len(PAGES) - 12 and stats.skipped == 1
+        assert max(requests.values()) == 3
+        assert set(requests) == {*PAGES, DISAMBIGUATION}
+        texts = read_texts(tmp_path)
+        assert all(texts.count(text) == 1 for text in PAGES.values())
+        assert 'недописанная' not in texts
+
+    def test_unknown_shards_are_kept(self, api_url, tmp_path):
+        url, _ = api_url
+        crawl(url, tmp_path, 12)
+        # the first shard of a run interrupted before its first commit
+        (tmp_path / 'pages-00001.txt.gz').write_bytes(gzip.compress('обрыв'.encode()))
+        crawl(url, tmp_path, 1)
+        assert 'обрыв' not in read_texts(tmp_path)
+        shards = {path: path.read_bytes() for path in tmp_path.glob('pages-*.txt.gz')}
+
+        with pytest.raises(FileExistsError):
+            crawl(url, tmp_path, 1, state_path=tmp_path / 'other-state.jsonl')
+        assert {path: path.read_bytes() for path in tmp_path.glob('pages-*.txt.gz')} == shards
+
+    def test_failed_pages_are_retried_later(self, api_url, tmp_path):
+        url, requests = api_url
+        stats = crawl(url, tmp_path, len(PAGES), retries=1)
+
+        assert stats.failed == 1 and stats.pages == len(PAGES) - 1
+        stats = crawl(url, tmp_path, 1)
+        assert stats.pages == 1
+        assert PAGES[FLAKY] in read_texts(tmp_path)
+
+    def test_resumed_training(self, api_url, tmp_path):
+        url, _ = api_url
+        output_dir, model = tmp_path / 'pages', tmp_path / 'model.pkl'
+        args = ['train.py', '--input-dir', str(output_dir), '--ngram', '2']
+        crawl(url, output_dir, 10)
+        with patch.object(sys, 'argv', [*args, '--model', str(model)]):
+            train_main()
+        crawl(url, output_dir, 10)
+        with patch.object(sys, 'argv', [*args, '--model', str(model), '--resume', str(model)]):
+            train_main()
+        expected = tmp_path / 'expected.pkl'
+        with patch.object(sys, 'argv', [*args, '--model', str(expected)]):
+            train_main()
+
+        resumed = Trainer.load(model)
+        assert len(resumed._manifest) == len(list(output_dir.glob('pages-*.txt.gz'))) == 2
+        assert sorted(resumed._ngram_model._storage.counts()) == sorted(
+            Trainer.load(expected)._ngram_model._storage.counts()
+        )
@@ -0,0 +1,111 @@
+import os
+import random
+import subprocess
+import sys
+from io import StringIO
+
+import numpy as np
+import pytest
+
+from src.dedup import Deduplicator, HashWindow
+from src.stream import ChunkReader
+from src.dictionary import Dictionary
+from src.tokenizer import Tokenizer
+
+WORDS = [
+    ''.join(random.Random(i).choice('абвгдежзиклмнопрстуф') for _ in range(6))
+    for i in range(300)
+]
+
+
+def document(seed, sentences=8):
+    rng = random.Random(seed)
+    return ' '.join(
+        ' '.join(rng.choice(WORDS) for _ in range(8)).capitalize() + '.'
+        for _ in range(sentences)
+    )
+
+
+def tokens(text):
+    return [t for s in Tokenizer(Dictionary()).sentences(text) for t in s]
+
+
+class TestHashWindow:
+    def test_add(self):
+        window = HashWindow(64)
+        hashes = np.array([5, 0, 7, 5, 1 << 63], dtype=np.uint64)
+
+        # zero is stored as one, like a hash equal to one
+        assert window.add(hashes).tolist() == [False, False, False, True, False]
+        assert window.add(np.array([7, 1, 9], dtype=np.uint64)).tolist() == [True, True, False]
+
+    def test_bounded(self):
+        window = HashWindow(1024)
+        nbytes = window.nbytes
+        hashes = np.arange(1, 10_001, dtype=np.uint64)
+
+        assert not window.add(hashes).any()
+        assert window.nbytes == nbytes and window.rotations > 0
+        # the last half of the capacity is remembered
+        assert window.add(hashes[-512:]).all()
+
+
+class TestDeduplicator:
+    def test_repeated_sentences(self):
+        dedup = Deduplicator(memory_budget=1 << 20)
+        text = 'Раз два три. Четыре пять шесть!\n\nРаз два три? Да. Да.'
+
+        result = dedup.deduplicate(text)
+
+        assert tokens(result) == ['раз', 'два', 'три', 'четыре', 'пять', 'шесть', 'да', 'да']
+        stats = dedup.stats()
+        assert (stats.sentences, stats.removed_sentences) == (5, 1)
+        assert (stats.tokens, stats.removed_tokens) == (11, 3)
+
+    def test_near_duplicate_documents(self):
+        dedup = Deduplicator(memory_budget=1 << 20)
+        original = document(1)
+        words = original.split()
+        words[20] = 'изменено'
+        mirrored = ' '.join(words)
+        other = document(2)
+
+        result = dedup.deduplicate('\n\n'.join([original, mirrored, other]))
+
+        assert tokens(result) == tokens(original) + tokens(other)
+        stats = dedup.stats()
+        assert (stats.documents, stats.removed_documents) == (3, 1)
+        assert stats.removed_tokens == len(tokens(mirrored))
+
+    @pytest.mark.parametrize('chunk_size', [16, 200, 1 << 20])
+    def test_streaming(self, chunk_size):
+        texts = [document(i % 5) for i in range(12)]
+        text = '\n\n'.join(texts) + '\n\nХвост без конца'
+        expected = Deduplicator().deduplicate(text)
+
+        dedup = Deduplicator()
+        chunks = ((chunk, None) for chunk in ChunkReader(chunk_size=chunk_size).read(StringIO(text)))
+        result = ''.join(chunk for chunk, _ in dedup.filter(chunks))
+
+        assert tokens(result) == tokens(expected)
+        stats = dedup.stats()
+        assert stats.removed_documents == 7
+        assert stats.tokens - stats.removed_tokens == len(tokens(result))
+
+    def test_hashes_match_across_processes(self):
+        # the builtin hash of str differs with PYTHONHASHSEED
+        script = (
+            'from src.dedup import Deduplicator;'
+            'from tests.test_dedup import document, tokens;'
+            'print(Deduplicator()._band_keys([tokens(document(1))]).tolist())'
+        )
+        keys = [
+            subprocess.run(
+                [sys.executable, '-c', script],
+                env={**os.environ, 'PYTHONHASHSEED': seed},
+                capture_output=True, text=True, check=True,
+            ).stdout
+            for seed in ('1', '2')
+        ]
+
+        assert keys[0] == keys[1]
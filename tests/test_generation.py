@@ -1,8 +1,24 @@
+import http.client
+import json
+import random
 import sys
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from io import StringIO
+from pathlib import Path
 from unittest.mock import patch
 
+import numpy as np
 import pytest
 
+from src.client import GenerationClient
+from src.dictionary import Dictionary
+from src.model import NGramModel
+from src.pool import GenerationPool
+from src.server import GenerationRequest, GenerationServer, make_http_server
+from src.trainer import Trainer
+from src.utils import angle_between
+from tests.conftest import TRAIN_TEXT
 from train import main as train_main
 from generate import main
 
@@ -48,3 +64,313 @@ class TestGeneration:
         assert out.startswith('Один')
         assert out.endswith('.\n')
         assert len(out.split()) == 100
+
+
+class TestBatchGeneration:
+    @pytest.mark.parametrize(
+        'train_arguments',
+        ['--ngram 2 --min-ngram=1'],
+        indirect=True
+    )
+    @pytest.mark.parametrize(
+        'stdin',
+        ["""один два три два. два три три три три три три три три четыре.
+         пять шесть один семь"""],
+        indirect=True
+    )
+    def test_continue_many(self, prepare, assert_model_path):
+        trainer = Trainer.load(Path('model.pkl'))
+        prefixes = [['один'], ['три', 'три'], None, ['неизвестное', 'слово']]
+        seeds = [1, 2, 3, 4]
+
+        results = trainer.continue_many(prefixes, word_count=30, seeds=seeds)
+
+        assert results == [
+            trainer.continue_(prefix, word_count=30, seed=seed)
+            for prefix, seed in zip(prefixes, seeds)
+        ]
+        assert results[0].startswith('Один')
+
+
+class TestClosestToken:
+    def test_matches_smallest_angle(self):
+        random_state = np.random.default_rng(0)
+        vectors = random_state.normal(size=(12, 8))
+        # words without an embedding, an exact copy and a scaled copy for ties
+        vectors[[3, 7]] = 0
+        vectors[5] = vectors[4]
+        vectors[9] = vectors[8] * 2
+        trainer = Trainer(ngram_model=NGramModel(), dictionary=Dictionary(), embedder=None)
+        norms = np.linalg.norm(vectors, axis=1)
+        trainer._embeddings = np.divide(
+            vectors, norms[:, None], out=np.zeros_like(vectors), where=norms[:, None] > 0
+        ).astype(np.float32)
+        trainer._embedding_norms = norms.astype(np.float32)
+        next_tokens = [
+            np.array(tokens)
+            for tokens in ([3, 7], [7, 4, 5], [5, 4], [9, 8, 3], [8, 9], [0, 1, 2, 6, 10, 11])
+        ]
+        themes = random_state.normal(size=(len(next_tokens), 8))
+        themes[1] = vectors[4]
+        themes[3] = vectors[8]
+
+        chosen, theme_vectors = trainer._choose_closest_next_tokens(next_tokens, themes.copy())
+
+        for tokens, theme, token, theme_vector in zip(next_tokens, themes, chosen, theme_vectors):
+            # the per-candidate selection the embedding matrix replaced
+            angles = [
+                angle_between(theme, vectors[t]) if norms[t] > 0 else np.inf
+                for t in tokens.tolist()
+            ]
+            index = min(range(len(tokens)), key=angles.__getitem__)
+            assert token == tokens[index]
+            np.testing.assert_allclose(theme_vector, theme + vectors[token], rtol=1e-6)
+
+
+class TestGenerationOrder:
+    def test_lower_order_matches_trained_order(self, tmp_path):
+        # short sentences give bigrams to the 4-gram model too
+        text = """один два три два пять. два три три три три три три три три четыре.
+        пять шесть один семь два. один два три четыре пять шесть. шесть семь.
+        семь восемь один. восемь пять. пять"""
+        models = {}
+        for ngram in (2, 4):
+            models[ngram] = tmp_path / f'{ngram}.pkl'
+            args = ['train.py', '--ngram', str(ngram), '--model', str(models[ngram])]
+            with patch.object(sys, 'argv', args), patch.object(sys, 'stdin', StringIO(text)):
+                train_main()
+        trainer = Trainer.load(models[4])
+        expected = Trainer.load(models[2])
+        # random restarts draw from all stored contexts, prefixes avoid them
+        prefixes = [['один'], ['три', 'три', 'три'], ['шесть'], ['восемь']]
+
+        results = trainer.continue_many(prefixes, word_count=30, seeds=[1, 2, 3, 4], ngram=2)
+
+        assert results == expected.continue_many(prefixes, word_count=30, seeds=[1, 2, 3, 4])
+        with pytest.raises(ValueError):
+            trainer.continue_(['один'], word_count=5, ngram=5)
+        with pytest.raises(ValueError):
+            expected.continue_(['один'], word_count=5, ngram=3)
+
+
+class TestPrefix:
+    def test_unknown_words_are_not_observed(self, tmp_path):
+        model = tmp_path / 'model.bin'
+        with patch.object(sys, 'argv', ['train.py', '--ngram', '2', '--model', str(model)]), \
+                patch.object(sys, 'stdin', StringIO(TRAIN_TEXT)):
+            train_main()
+        trainer = Trainer.load(model)
+        words = len(trainer._dictionary)
+
+        text = trainer.continue_(['Незнакомое', 'привет'], word_count=6, seed=1)
+        streamed = ''.join(trainer.stream(['Незнакомое', 'привет'], word_count=6, seed=1))
+
+        assert text.startswith('Незнакомое привет ')
+        assert streamed == text
+        assert len(trainer._dictionary) == words
+        assert trainer._embedder is None
+
+
+class TestGenerationPool:
+    @pytest.mark.parametrize('processes', [False, True])
+    def test_pool_matches_serial(self, tmp_path, processes):
+        text = """один два три два пять. два три три три три три три три три четыре.
+        пять шесть один семь два. один два три четыре пять шесть"""
+        model = tmp_path / 'model.pkl'
+        with patch.object(sys, 'argv', ['train.py', '--ngram', '3', '--model', str(model)]), \
+                patch.object(sys, 'stdin', StringIO(text)):
+            train_main()
+        prefixes = [['один'], ['два', 'три'], None, ['шесть'], ['незнакомое', 'слово']] * 4
+        seeds = list(range(len(prefixes)))
+        alone = [
+            Trainer.load(model).continue_(prefix, word_count=20, seed=seed)
+            for prefix, seed in zip(prefixes, seeds)
+        ]
+
+        with GenerationPool(model, workers=3, processes=processes, batch_size=3) as pool:
+            results = pool.continue_many(prefixes, word_count=20, seeds=seeds)
+
+        assert results == alone
+
+    def test_global_random_state_is_not_used(self, tmp_path):
+        with patch.object(sys, 'argv', ['train.py', '--model', str(tmp_path / 'model.pkl')]), \
+                patch.object(sys, 'stdin', StringIO('один два три. два три четыре. три один два.')):
+            train_main()
+        trainer = Trainer.load(tmp_path / 'model.pkl')
+        random.seed(0)
+        np.random.seed(0)
+        state = random.getstate(), np.random.get_state()[1].copy()
+
+        first = trainer.continue_(None, word_count=10, seed=7)
+        assert trainer.continue_(None, word_count=10, seed=7) == first
+        assert random.getstate() == state[0]
+        assert (np.random.get_state()[1] == state[1]).all()
+
+
+class TestShardedModel:
+    def test_matches_unsharded(self, tmp_path, capsys):
+        text = """один два три два пять. два три три три три три три три три четыре.
+        пять шесть один семь два. один два три четыре пять шесть. семь восемь девять"""
+        for name, shards in (('model.bin', '1'), ('sharded.bin', '4')):
+            args = ['train.py', '--ngram', '3', '--model', str(tmp_path / name), '--shards', shards]
+            with patch.object(sys, 'argv', args), patch.object(sys, 'stdin', StringIO(text)):
+                train_main()
+        expected = Trainer.load(tmp_path / 'model.bin')
+        trainer = Trainer.load(tmp_path / 'sharded.bin', resident_shards=1)
+        prefixes = [None, ['один'], ['два', 'три'], None, ['семь']] * 3
+        seeds = list(range(len(prefixes)))
+
+        results = trainer.continue_many(prefixes, word_count=20, seeds=seeds)
+
+        assert results == expected.continue_many(prefixes, word_count=20, seeds=seeds)
+        assert len(list(tmp_path.glob('sharded.bin.shard-*'))) == 4
+        info = trainer.shard_info()
+        assert info.resident == 1 and info.loads > 1 and info.evictions == info.loads - 1
+        assert expected.shard_info() is None
+
+
+class TestBinaryModel:
+    @pytest.mark.parametrize('storage', ['array', 'dict'])
+    def test_converted_output(self, tmp_path, storage):
+        text = """один два три два пять. два три три три три три три три три четыре.
+        пять шесть один семь два. один два три четыре пять шесть. семь восемь девять"""
+        args = ['train.py', '--ngram', '3', '--model', str(tmp_path / 'model.pkl'),
+                '--storage', storage]
+        with patch.object(sys, 'argv', args), patch.object(sys, 'stdin', StringIO(text)):
+            train_main()
+        pickled = Trainer.load(tmp_path / 'model.pkl')
+        pickled.save_binary(tmp_path / 'model.bin')
+        binary = Trainer.load(tmp_path / 'model.bin')
+        prefixes = [None, ['один'], ['два', 'три'], ['семь']] * 5
+        seeds = list(range(len(prefixes)))
+
+        results = binary.continue_many(prefixes, word_count=20, seeds=seeds)
+
+        # the binary format keeps the order of an array storage only
+        expected = pickled.continue_many(prefixes, word_count=20, seeds=seeds)
+        assert (results == expected) == (storage == 'array')
+
+
+class TestStream:
+    def test_matches_continue(self, tmp_path, capsys):
+        text = """один два три два пять. два три три три три три три три три четыре.
+        пять шесть один семь два. один два три четыре пять шесть"""
+        model = tmp_path / 'model.pkl'
+        with patch.object(sys, 'argv', ['train.py', '--ngram', '3', '--model', str(model)]), \
+                patch.object(sys, 'stdin', StringIO(text)):
+            train_main()
+        trainer = Trainer.load(model)
+        prefixes = [['один'], ['два', 'три'], None, ['Незнакомое', 'СЛОВО'], ['один', 'два', 'три']]
+
+        for seed, prefix in enumerate(prefixes):
+            for word_count in (0, 2, 50):
+                pieces = list(trainer.stream(prefix, word_count=word_count, seed=seed))
+                assert ''.join(pieces) == trainer.continue_(prefix, word_count=word_count, seed=seed)
+        # pieces come before the whole text is generated
+        first = next(trainer.stream(['один'], word_count=10 ** 12, seed=0))
+        assert first == 'Один'
+        with pytest.raises(ValueError):
+            next(trainer.stream(['один'], word_count=5, ngram=4))
+
+        capsys.readouterr()
+        args = ['generate.py', '--model', str(model), '--prefix', 'два', '--length', '40', '--seed', '3']
+        with patch.object(sys, 'argv', args):
+            main()
+        expected = capsys.readouterr().out
+        with patch.object(sys, 'argv', [*args, '--stream']):
+            main()
+        assert capsys.readouterr().out == expected
+
+
+class TestServer:
+    @pytest.mark.parametrize(
+        'train_arguments',
+        ['--ngram 2 --min-ngram=1'],
+        indirect=True
+    )
+    @pytest.mark.parametrize(
+        'stdin',
+        ["""один два три два. два три три три три три три три три четыре.
+         пять шесть один семь"""],
+        indirect=True
+    )
+    def test_serve(self, prepare, assert_model_path):
+        trainer = Trainer.load(Path('model.pkl'))
+        generation = GenerationServer(Path('model.pkl'), max_batch=4)
+        http_server = make_http_server(generation, port=0)
+        generation.start()
+        threading.Thread(target=http_server.serve_forever, daemon=True).start()
+        try:
+            host, port = http_server.server_address[:2]
+            client = GenerationClient(f'http://{host}:{port}')
+            prefixes = [['один'], ['три', 'три'], None, ['неизвестное']] * 4
+            with ThreadPoolExecutor(8) as executor:
+                results = list(executor.map(
+                    lambda i: client.generate(prefixes[i], length=20, seed=i),
+                    range(len(prefixes)),
+                ))
+
+            assert results == [
+                trainer.continue_(prefix, word_count=20, seed=seed)
+                for seed, prefix in enumerate(prefixes)
+            ]
+            client.reload()
+            assert client.generate(['один'], length=20, seed=0) == results[0]
+            stats = client.stats()
+            assert stats['requests'] == len(prefixes) + 1
+            assert stats['latency_p50'] <= stats['latency_p99']
+        finally:
+            http_server.shutdown()
+            http_server.server_close()
+            generation.stop()
+
+    @pytest.mark.parametrize(
+        'train_arguments',
+        ['--ngram 2 --min-ngram=1'],
+        indirect=True
+    )
+    @pytest.mark.parametrize(
+        'stdin',
+        ["""один два три два. два три три три три три три три три четыре."""],
+        indirect=True
+    )
+    def test_invalid_requests(self, prepare, assert_model_path):
+        trainer = Trainer.load(Path('model.pkl'))
+        generation = GenerationServer(Path('model.pkl'), max_batch=8)
+        # queued before the generation thread starts, so they share one batch
+        requests = [
+            GenerationRequest(['один'], 10, seed, ngram, Future())
+            for seed, ngram in ((1, None), ('x', None), (2, None), (3, 0), (4, 0))
+        ]
+        for request in requests:
+            generation._requests.put(request)
+        generation.start()
+        http_server = make_http_server(generation, port=0)
+        threading.Thread(target=http_server.serve_forever, daemon=True).start()
+        try:
+            assert requests[0].result.result() == trainer.continue_(['один'], 10, seed=1)
+            assert requests[2].result.result() == trainer.continue_(['один'], 10, seed=2)
+            for request in (requests[1], *requests[3:]):
+                with pytest.raises((TypeError, ValueError)):
+                    request.result.result()
+
+            host, port = http_server.server_address[:2]
+            for payload in (
+                {'prefix': 'один', 'seed': 'x'},
+                {'prefix': 'один', 'length': '10'},
+                {'prefix': 'один', 'seed': -1},
+                {'prefix': 5},
+                {'prefix': 'один', 'ngram': 3},
+                [],
+                'один',
+            ):
+                connection = http.client.HTTPConnection(host, port)
+                connection.request('POST', '/generate', body=json.dumps(payload))
+                response = connection.getresponse()
+                assert response.status == 400, payload
+                assert json.loads(response.read())['error']
+                connection.close()
+        finally:
+            http_server.shutdown()
+            http_server.server_close()
+            generation.stop()
@@ -0,0 +1,461 @@
+import pickle
+from collections import Counter
+from unittest.mock import patch
+
+import numpy as np
+import pytest
+from torch.utils.data import DataLoader
+
+from src.counter import NGramCounter
+from src.dataset import SentenceSplitter, TokenDataset
+from src.dictionary import Dictionary, MappedDictionary
+from src.model import NGramModel, NGramModelError
+from src.parallel import ShardedCounter
+from src.sampling import SamplingTable
+from src.model_file import ModelFileError, write_model_file
+from src.storage import ArrayStorage, ShardedStorage, SketchStorage, TrieStorage
+from tests.conftest import TRAIN_TEXT
+
+TEXTS = [
+    TRAIN_TEXT,
+    """один два три два
+два три три три три три три три три четыре""",
+    'раз. два три. четыре пять шесть семь восемь, девять',
+    '',
+]
+
+
+def fit_dataloader(texts, ngram, min_ngram):
+    dictionary = Dictionary()
+    model = NGramModel()
+    for text in texts:
+        dataset = TokenDataset(
+            dictionary=dictionary, raw_text=text, ngram=ngram, min_ngram=min_ngram
+        )
+        model.fit(DataLoader(dataset, batch_size=1))
+    return dictionary, model
+
+
+def fit_bulk(texts, ngram, min_ngram, batch_size, storage=None):
+    dictionary = Dictionary()
+    model = NGramModel(storage=storage)
+    counter = NGramCounter(
+        dictionary=dictionary, ngram=ngram, min_ngram=min_ngram, batch_size=batch_size
+    )
+    for text in texts:
+        counter.fit(model, raw_text=text)
+    return dictionary, model
+
+
+class TestTokenDataset:
+    @pytest.mark.parametrize('ngram, min_ngram', [(1, 1), (3, 1), (4, 3), (2, 0)])
+    def test_windows(self, ngram, min_ngram):
+        dictionary = Dictionary()
+        text = '\n'.join(TEXTS)
+        dataset = TokenDataset(
+            dictionary=dictionary, raw_text=text, ngram=ngram, min_ngram=min_ngram
+        )
+        expected = []
+        splitter = SentenceSplitter()
+        for words in splitter.split(splitter.preprocess(text)):
+            codes = dictionary.encode_many(words).tolist()
+            for ngram_len in range(min_ngram, ngram + 1):
+                for index in range(len(codes) - ngram_len):
+                    expected.append(
+                        (codes[index : index + ngram_len], [codes[index + ngram_len]])
+                    )
+
+        assert len(dataset) == len(expected)
+        assert [(x.tolist(), y.tolist()) for x, y in dataset] == expected
+        with pytest.raises(IndexError):
+            dataset[len(dataset)]
+
+
+class TestBulkCounting:
+    @pytest.mark.parametrize('ngram, min_ngram', [(1, 1), (2, 1), (4, 1), (4, 3)])
+    @pytest.mark.parametrize('batch_size', [1, 7, 1_000_000])
+    def test_matches_dataloader(self, ngram, min_ngram, batch_size):
+        expected_dictionary, expected = fit_dataloader(TEXTS, ngram, min_ngram)
+        dictionary, model = fit_bulk(TEXTS, ngram, min_ngram, batch_size)
+
+        assert dictionary._word_to_code_map == expected_dictionary._word_to_code_map
+        mapping = model._storage._ngram_mapping
+        expected_mapping = expected._storage._ngram_mapping
+        assert list(mapping.items()) == list(expected_mapping.items())
+        for key, value in mapping.items():
+            assert list(value.items()) == list(expected_mapping[key].items())
+
+    def test_unpacked_keys(self):
+        texts = [' '.join(f'слово{chr(0x430 + i % 32)}{chr(0x430 + i // 32)}' for i in range(1024)) * 3]
+        _, expected = fit_dataloader(texts, 6, 1)
+        _, model = fit_bulk(texts, 6, 1, 1_000_000)
+
+        assert model._storage._ngram_mapping == expected._storage._ngram_mapping
+
+
+class TestMerge:
+    @pytest.mark.parametrize('storage', [None, ArrayStorage(), TrieStorage()])
+    def test_sharded_matches_serial(self, storage):
+        expected_dictionary, expected = fit_bulk(TEXTS * 3, 4, 1, 1_000_000)
+        dictionary = Dictionary()
+        model = NGramModel(storage=storage)
+        for shard in ShardedCounter(workers=2, ngram=4, min_ngram=1).count(TEXTS * 3):
+            model.merge(shard.counts, dictionary.union(shard.dictionary))
+        model.flush()
+
+        assert dictionary._word_to_code_map == expected_dictionary._word_to_code_map
+        if storage is None:
+            mapping = model._storage._ngram_mapping
+            assert list(mapping.items()) == list(expected._storage._ngram_mapping.items())
+        else:
+            assert len(model._storage) == len(expected._storage)
+            for context, tokens, counts in expected._storage.items():
+                merged_tokens, merged_counts = model._storage.successors(context)
+                assert dict(zip(merged_tokens.tolist(), merged_counts.tolist())) == dict(
+                    zip(tokens.tolist(), counts.tolist())
+                )
+
+    def test_merged_counts_are_pickled(self):
+        _, expected = fit_bulk(TEXTS, 3, 1, 1_000_000)
+        dictionary = Dictionary()
+        model = NGramModel()
+        for shard in ShardedCounter(workers=2, ngram=3, min_ngram=1).count(TEXTS):
+            model.merge(shard.counts, dictionary.union(shard.dictionary))
+
+        # a checkpoint taken before the model is used
+        restored = pickle.loads(pickle.dumps(model))
+
+        assert restored._storage._ngram_mapping == expected._storage._ngram_mapping
+
+
+class TestArrayStorage:
+    @pytest.mark.parametrize('buffer_size', [1, 10, 1_000_000])
+    def test_matches_dict_storage(self, buffer_size):
+        _, expected = fit_dataloader(TEXTS, 4, 1)
+        _, model = fit_bulk(TEXTS, 4, 1, 1_000_000, ArrayStorage(buffer_size))
+
+        assert len(model._storage) == len(expected._storage)
+        contexts = set()
+        for context, tokens, counts in model._storage.items():
+            contexts.add(context)
+            expected_tokens, expected_counts = expected._storage.successors(context)
+            assert dict(zip(tokens.tolist(), counts.tolist())) == dict(
+                zip(expected_tokens.tolist(), expected_counts.tolist())
+            )
+        assert contexts == set(expected._storage._ngram_mapping)
+        assert model.memory_usage() < expected.memory_usage()
+
+    def test_samples(self):
+        _, model = fit_bulk(TEXTS, 2, 1, 1_000_000, ArrayStorage())
+        context = model.random_ngram()
+
+        assert len(model.samples(context, k=3)) <= 3
+        assert len(model.samples((-5, *context), k=1)) == 1
+        with pytest.raises(NGramModelError):
+            model.samples((-5,))
+
+
+class TestTrieStorage:
+    @pytest.mark.parametrize('buffer_size', [1, 10, 1_000_000])
+    def test_matches_dict_storage(self, buffer_size):
+        _, expected = fit_dataloader(TEXTS, 4, 1)
+        _, model = fit_bulk(TEXTS, 4, 1, 1_000_000, TrieStorage(buffer_size))
+        model._storage = pickle.loads(pickle.dumps(model._storage))
+
+        assert len(model._storage) == len(expected._storage)
+        assert sorted(model._storage.counts()) == sorted(expected._storage.counts())
+        assert model.memory_usage() < expected.memory_usage()
+
+    def test_longest_suffix(self):
+        _, expected = fit_dataloader(TEXTS, 4, 2)
+        _, model = fit_bulk(TEXTS, 4, 2, 1_000_000, TrieStorage())
+
+        for index in range(len(expected._storage)):
+            context = expected._storage.context_at(index)
+            for query in (context, (-5, *context), (*context[:-1], -5)):
+                expected_successors = expected._storage.longest_suffix(query)
+                successors = model._storage.longest_suffix(query)
+                if expected_successors is None:
+                    assert successors is None
+                    continue
+                assert dict(zip(*map(np.ndarray.tolist, successors))) == dict(
+                    zip(*map(np.ndarray.tolist, expected_successors))
+                )
+
+
+class TestSketchStorage:
+    def test_exact_within_capacity(self):
+        _, expected = fit_dataloader(TEXTS, 4, 1)
+        _, model = fit_bulk(TEXTS, 4, 1, 1_000_000, SketchStorage())
+
+        assert sorted(model._storage.counts()) == sorted(expected._storage.counts())
+        assert model.error_bound() == (0, pytest.approx(1 - np.exp(-4)))
+
+    def test_bounded_counts(self):
+        _, expected = fit_dataloader(TEXTS, 3, 1)
+        expected_counts = {
+            (context, token): count
+            for context, token, count in expected._storage.counts()
+        }
+        storage = SketchStorage(capacity=20, width=64, depth=4)
+        _, model = fit_bulk(TEXTS, 3, 1, 1_000_000, storage)
+        model._storage = pickle.loads(pickle.dumps(model._storage))
+
+        counts = list(model._storage.counts())
+        error, _ = model.error_bound()
+        assert 0 < len(counts) <= 20
+        assert error > 0
+        for context, token, count in counts:
+            assert expected_counts[context, token] <= count
+            assert count <= expected_counts[context, token] + error
+        top = max(expected_counts, key=expected_counts.get)
+        assert top in {(context, token) for context, token, _ in counts}
+
+        random_state = np.random.default_rng(0)
+        context = model.random_ngram(random_state)
+        assert len(model.samples(context, k=2, random_state=random_state))
+
+    @pytest.mark.parametrize('order', [1, 2, 4])
+    def test_memory_budget(self, order):
+        budget = 1 << 18
+        storage = SketchStorage.for_budget(budget)
+        random_state = np.random.default_rng(order)
+        for _ in range(20_000):
+            context = tuple(random_state.integers(0, 1000, order).tolist())
+            storage.add(context, int(random_state.integers(0, 1000)))
+
+        assert storage.error_bound()[0] > 0
+        assert storage.memory_usage() <= budget
+
+    def test_sketch_saved_apart(self, tmp_path):
+        storage = SketchStorage(capacity=20, width=64, depth=4)
+        _, model = fit_bulk(TEXTS, 3, 1, 1_000_000, storage)
+        path = SketchStorage.sketch_path(tmp_path / 'model.pkl')
+        assert model.save_sketch(path)
+        assert not NGramModel().save_sketch(tmp_path / 'other.sketch')
+
+        loaded = pickle.loads(pickle.dumps(model))
+        assert loaded._storage._sketch is None
+        with pytest.raises(ValueError):
+            loaded._storage.add((1, 2), 1000)
+        with pytest.raises(ModelFileError):
+            loaded.load_sketch(tmp_path / 'missing.sketch')
+
+        loaded.load_sketch(path)
+        storage.add((1, 2), 1000)
+        loaded._storage.add((1, 2), 1000)
+        assert sorted(loaded._storage.counts()) == sorted(storage.counts())
+        assert loaded.error_bound() == model.error_bound()
+
+
+class TestShardedStorage:
+    def sharded(self, tmp_path, storage, count, resident):
+        locations, shards = storage.partition(count)
+        paths = [ShardedStorage.shard_path(tmp_path / 'model.bin', i) for i in range(count)]
+        for path, arrays in zip(paths, shards):
+            write_model_file(path, {'model': 'id'}, arrays, magic=ShardedStorage.MAGIC)
+        return ShardedStorage(paths, locations, model_id='id', resident=resident)
+
+    @pytest.mark.parametrize('count', [1, 3, 8])
+    def test_matches_array_storage(self, tmp_path, count):
+        _, model = fit_bulk(TEXTS, 4, 1, 1_000_000, storage=ArrayStorage())
+        storage = model._storage
+        sharded = self.sharded(tmp_path, storage, count, resident=2)
+
+        assert len(sharded) == len(storage)
+        for index in range(len(storage)):
+            context = storage.context_at(index)
+            assert sharded.context_at(index) == context
+            tokens, counts = storage.successors(context)
+            sharded_tokens, sharded_counts = sharded.successors(context)
+            assert sharded_tokens.tolist() == tokens.tolist()
+            assert sharded_counts.tolist() == counts.tolist()
+        assert sharded.successors((10 ** 6,)) is None
+        assert sorted(sharded.counts()) == sorted(storage.counts())
+        restored = pickle.loads(pickle.dumps(sharded))
+        assert type(restored) is ArrayStorage
+        assert sorted(restored.counts()) == sorted(storage.counts())
+
+    def test_lru(self, tmp_path):
+        _, model = fit_bulk(TEXTS, 3, 1, 1_000_000, storage=ArrayStorage())
+        sharded = self.sharded(tmp_path, model._storage, 4, resident=2)
+        shards = [
+            next(i for i in range(len(sharded)) if sharded._locations[i] % 4 == shard)
+            for shard in range(4)
+        ]
+
+        for index in [shards[0], shards[1], shards[0], shards[2], shards[1]]:
+            sharded.context_at(index)
+
+        info = sharded.info()
+        assert (info.shards, info.resident) == (4, 2)
+        assert (info.loads, info.evictions, info.hits) == (4, 2, 1)
+
+    def test_entropy_prune(self, tmp_path):
+        _, model = fit_bulk(TEXTS, 4, 1, 1_000_000, storage=ArrayStorage())
+        storage = self.sharded(tmp_path, model._storage, 8, resident=1)
+        sharded = NGramModel(storage=storage)
+        batches = -(-len(storage) // 16)
+
+        with patch.object(NGramModel, 'PRUNE_BATCH', 16):
+            removed = sharded.prune(entropy_threshold=1e-3)
+        assert removed == model.prune(entropy_threshold=1e-3) > 0
+        assert sorted(sharded._storage.counts()) == sorted(model._storage.counts())
+        assert sharded.context_count() == model.context_count()
+        # two passes over the shards and the suffix shards of every batch
+        assert storage.info().loads <= 8 * (2 + batches)
+
+    def test_shards_of_another_save(self, tmp_path):
+        _, model = fit_bulk(TEXTS, 2, 1, 1_000_000, storage=ArrayStorage())
+        sharded = self.sharded(tmp_path, model._storage, 2, resident=2)
+        sharded._model_id = 'other'
+
+        with pytest.raises(ModelFileError):
+            sharded.context_at(0)
+
+
+class TestDictionary:
+    def test_unknown_registered_once(self):
+        dictionary = Dictionary()
+
+        assert dictionary.observe(Dictionary.UNKNOWN) == 0
+        assert len(dictionary) == 0
+
+    def test_prune(self):
+        dictionary, model = fit_bulk(TEXTS, 3, 1, 1_000_000)
+        counts = dict(zip(dictionary.decode_many(range(len(dictionary) + 1)),
+                          dictionary.counts().tolist()))
+        expected_counts = sorted(model._storage.counts())
+
+        mapping = dictionary.prune(min_count=2, max_vocab=5)
+        model.remap(mapping)
+
+        words = dictionary.decode_many(range(1, len(dictionary) + 1))
+        assert len(words) == 5
+        assert all(counts[word] >= 2 for word in words)
+        assert [counts[word] for word in words] == sorted(
+            (counts[word] for word in words), reverse=True
+        )
+        assert dictionary.encode_many(words).tolist() == list(range(1, 6))
+        assert (dictionary.encode_many(['три', 'пять']) == [1, -1]).all()
+        assert sorted(model._storage.counts()) == sorted(
+            (tuple(mapping[list(context)].tolist()), int(mapping[token]), count)
+            for context, token, count in expected_counts
+            if (mapping[[*context, token]] >= 0).all()
+        )
+
+    def test_prune_mapped(self):
+        dictionary, _ = fit_bulk(TEXTS, 2, 1, 1_000_000)
+        arrays = dictionary.to_arrays()
+        mapped = MappedDictionary(
+            arrays['vocab_offsets'], arrays['vocab_buffer'], arrays['vocab_sorted'],
+            arrays['vocab_counts'],
+        )
+        mapped.observe('новое', count=5)
+        dictionary.observe('новое', count=5)
+
+        mapping = mapped.prune(min_count=2, max_vocab=5)
+
+        assert (mapping == dictionary.prune(min_count=2, max_vocab=5)).all()
+        codes = range(-1, len(dictionary) + 2)
+        assert mapped.decode_many(codes) == dictionary.decode_many(codes)
+        assert (mapped.counts() == dictionary.counts()).all()
+        assert mapped.observe('новое') == dictionary.observe('новое')
+        assert mapped.encode('пять') == dictionary.encode('пять')
+
+    def test_compact_forms(self):
+        dictionary, _ = fit_bulk(TEXTS, 2, 1, 1_000_000)
+        codes = [3, -1, 0, len(dictionary), len(dictionary) + 5, 1]
+        arrays = dictionary.to_arrays()
+        mapped = MappedDictionary(
+            arrays['vocab_offsets'], arrays['vocab_buffer'], arrays['vocab_sorted'],
+            arrays['vocab_counts'],
+        )
+        restored = pickle.loads(pickle.dumps(mapped))
+
+        for copy in (mapped, restored, pickle.loads(pickle.dumps(dictionary))):
+            assert copy.decode_many(codes) == dictionary.decode_many(codes)
+            assert (copy.counts() == dictionary.counts()).all()
+        assert type(restored) is Dictionary
+
+
+class TestPrune:
+    def model(self):
+        model = NGramModel()
+        model.update([
+            ((1,), 2, 6), ((1,), 3, 3), ((1,), 4, 1),
+            ((5, 1), 2, 2), ((5, 1), 3, 1),
+            ((6, 1), 4, 1),
+            ((2,), 1, 5),
+        ])
+        return model
+
+    def test_counts(self):
+        model = self.model()
+
+        assert model.prune(min_count=2) == 3
+        assert sorted(model._storage.counts()) == [
+            ((1,), 2, 6), ((1,), 3, 3), ((2,), 1, 5), ((5, 1), 2, 2),
+        ]
+        model = self.model()
+        assert model.prune(min_context_count=4) == 3
+        assert len(model._storage) == 2
+
+    def test_relative_entropy(self):
+        model = self.model()
+
+        # (5, 1) is close to its backoff (1,), (6, 1) is not
+        assert model.prune(entropy_threshold=0.1) == 2
+        assert sorted(model._storage.counts()) == [
+            ((1,), 2, 6), ((1,), 3, 3), ((1,), 4, 1), ((2,), 1, 5), ((6, 1), 4, 1),
+        ]
+
+    def test_unreferenced_words(self):
+        dictionary, model = fit_bulk(TEXTS, 3, 1, 1_000_000)
+        model.prune(min_count=3)
+        referenced = model.referenced_tokens(len(dictionary) + 1)
+        kept = dictionary.decode_many(np.flatnonzero(referenced))
+        expected = sorted(
+            (tuple(dictionary.decode_many(context)), dictionary.decode(token), count)
+            for context, token, count in model._storage.counts()
+        )
+
+        mapping = dictionary.prune(min_count=0, referenced=referenced)
+        model.remap(mapping)
+
+        assert len(dictionary) == len(kept) < referenced.size - 1
+        assert sorted(
+            (tuple(dictionary.decode_many(context)), dictionary.decode(token), count)
+            for context, token, count in model._storage.counts()
+        ) == expected
+
+
+class TestSamplingTable:
+    @pytest.mark.parametrize('max_rounds', [0, 2])
+    def test_sample_distinct_distribution(self, max_rounds):
+        table = SamplingTable(np.array([10, 20, 30]), np.array([1, 2, 7]), max_rounds)
+        random_state = np.random.RandomState(0)
+        draws = Counter(
+            tuple(table.sample_distinct(2, random_state).tolist()) for _ in range(20000)
+        )
+        weights = {10: 0.1, 20: 0.2, 30: 0.7}
+        for (first, second), count in draws.items():
+            expected = weights[first] * weights[second] / (1 - weights[first])
+            assert count / 20000 == pytest.approx(expected, abs=0.015)
+
+    def test_sample_distinct_all(self):
+        table = SamplingTable(np.array([1, 2, 3]), np.array([5, 1, 1]))
+
+        assert sorted(table.sample_distinct(10).tolist()) == [1, 2, 3]
+        assert len(table.sample_distinct(0)) == 0
+
+    def test_cache(self):
+        _, model = fit_bulk(TEXTS, 2, 1, 1_000_000)
+        context = model.random_ngram()
+        for _ in range(3):
+            model.samples(context, k=2)
+        with pytest.raises(NGramModelError):
+            model.samples((-5,))
+
+        assert model.cache_info().hits == 2
+        assert model.cache_info().misses == 2
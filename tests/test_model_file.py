@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+
+from src.dictionary import MappedDictionary
+from src.model import NGramModel
+from src.model_file import ModelFileError, read_model_file, write_model_file
+from tests.test_model import TEXTS, fit_bulk
+
+
+class TestModelFile:
+    def test_round_trip(self, tmp_path):
+        dictionary, model = fit_bulk(TEXTS, 3, 1, 1_000_000)
+        path = tmp_path / 'model.bin'
+        write_model_file(
+            path, {'ngram': 3}, {**dictionary.to_arrays(), **model.to_arrays()}
+        )
+
+        metadata, arrays = read_model_file(path)
+        mapped_dictionary = MappedDictionary(
+            arrays['vocab_offsets'], arrays['vocab_buffer'], arrays['vocab_sorted']
+        )
+        mapped_model = NGramModel.from_arrays(arrays)
+
+        assert metadata == {'ngram': 3}
+        assert len(mapped_dictionary) == len(dictionary)
+        for word, code in dictionary._word_to_code_map.items():
+            assert mapped_dictionary.encode(word) == code
+            assert mapped_dictionary.decode(code) == word
+        assert mapped_dictionary.encode('несуществующее') == dictionary.UNKNOWN_CODE
+        assert mapped_dictionary.observe('несуществующее') == len(dictionary) + 1
+        assert len(mapped_model._storage) == len(model._storage)
+        for context, tokens, counts in model._storage.items():
+            mapped_tokens, mapped_counts = mapped_model._storage.successors(context)
+            assert sorted(zip(mapped_tokens.tolist(), mapped_counts.tolist())) == sorted(
+                zip(tokens.tolist(), counts.tolist())
+            )
+
+    @pytest.mark.parametrize('padding', range(64))
+    def test_header_offsets(self, tmp_path, padding):
+        # headers whose length settles while the offsets still move
+        path = tmp_path / 'model.bin'
+        array = np.arange(256, dtype=np.uint32).reshape(4, 64)
+        write_model_file(path, {'padding': 'x' * padding}, {'array': array})
+
+        _, arrays = read_model_file(path)
+
+        assert np.array_equal(arrays['array'], array)
+
+    def test_not_a_model(self, tmp_path):
+        path = tmp_path / 'model.bin'
+        path.write_bytes(b'0' * 64)
+
+        with pytest.raises(ModelFileError):
+            read_model_file(path)
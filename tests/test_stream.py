@@ -0,0 +1,23 @@
+from io import StringIO
+
+import pytest
+
+from src.stream import ChunkReader
+from tests.conftest import TRAIN_TEXT
+from tests.test_model import TEXTS, fit_bulk
+
+
+class TestChunkReader:
+    @pytest.mark.parametrize('chunk_size', [1, 5, 64, 1 << 20])
+    def test_chunks_keep_sentences(self, chunk_size):
+        chunks = list(ChunkReader(chunk_size=chunk_size).read(StringIO(TRAIN_TEXT)))
+
+        assert ''.join(chunks) == TRAIN_TEXT
+        _, expected = fit_bulk(TEXTS, 4, 1, 1_000_000)
+        _, model = fit_bulk([*chunks, *TEXTS[1:]], 4, 1, 1_000_000)
+        assert model._storage._ngram_mapping == expected._storage._ngram_mapping
+
+    def test_long_sentence(self):
+        text = 'один два три ' * 100
+
+        assert list(ChunkReader(chunk_size=7).read(StringIO(text))) == [text]
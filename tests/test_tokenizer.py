@@ -0,0 +1,55 @@
+import random
+import sys
+
+import pytest
+
+from src.dataset import SentenceSplitter
+from src.dictionary import Dictionary
+from src.tokenizer import Tokenizer
+from tests.conftest import TRAIN_TEXT
+
+ALPHABET = (
+    'абвгдеёжзийклмнопрстуфхцчшщъыьэюяАБВЯЁ abcxyzXYZ 0123 ٣²½ _-.,!?…«»\n\t'
+    'İıſKǅẞßﬁ́ΣΑσ\''
+)
+
+
+def split(text, min_word_length=0):
+    splitter = SentenceSplitter(min_word_length=min_word_length)
+    return splitter.split(splitter.preprocess(text))
+
+
+class TestTokenizer:
+    @pytest.mark.parametrize('min_word_length', [0, 2])
+    @pytest.mark.parametrize('chunk_size', [1, 7, 1 << 16])
+    def test_matches_splitter(self, min_word_length, chunk_size):
+        tokenizer = Tokenizer(Dictionary(), min_word_length, chunk_size)
+        random_state = random.Random(0)
+        texts = [TRAIN_TEXT] + [
+            ''.join(random_state.choices(ALPHABET, k=random_state.randint(0, 60)))
+            for _ in range(2000)
+        ]
+
+        for text in texts:
+            assert list(tokenizer.sentences(text)) == split(text, min_word_length)
+
+    def test_every_character(self):
+        characters = [
+            chr(code) for code in range(sys.maxunicode + 1)
+            if not 0xD800 <= code < 0xE000
+        ]
+        text = ' '.join(f'я{character}я {character}' for character in characters)
+
+        assert list(Tokenizer(Dictionary()).sentences(text)) == split(text)
+
+    def test_encode(self):
+        expected_dictionary = Dictionary()
+        sentences = split(TRAIN_TEXT)
+        expected = [expected_dictionary.observe(word) for words in sentences for word in words]
+        dictionary = Dictionary()
+
+        tokens, lengths = Tokenizer(dictionary).encode(TRAIN_TEXT)
+
+        assert tokens.tolist() == expected
+        assert lengths.tolist() == list(map(len, sentences))
+        assert dictionary._word_to_code_map == expected_dictionary._word_to_code_map
@@ -1,18 +1,46 @@
+import json
+import sys
+from pathlib import Path
+from unittest.mock import patch
+
 import pytest
 
+from src.profiling import PROFILER
+from src.trainer import Trainer
 from tests.conftest import TRAIN_TEXT
+from prune import main as prune_main
 from train import main
 
 
 class TestTrain:
     @pytest.mark.parametrize(
         'train_arguments',
-        ['--input-dir test_data --ngram 4 --min-ngram=1',],
+        ['--input-dir test_data --ngram 4 --min-ngram=1',
+         '--input-dir test_data --ngram 4 --storage sketch --memory-budget 1'],
         indirect=True
     )
     def test_train(self, train_arguments, assert_model_path):
         main()
 
+    def test_sketch_is_not_saved_binary(self, temp_dir, tmp_path):
+        args = ['train.py', '--input-dir', str(temp_dir), '--storage', 'sketch']
+        with patch.object(sys, 'argv', [*args, '--model', str(tmp_path / 'model.bin')]):
+            with pytest.raises(SystemExit):
+                main()
+        model = tmp_path / 'model.pkl'
+        with patch.object(sys, 'argv', [*args, '--model', str(model)]):
+            main()
+        trainer = Trainer.load(model)
+
+        assert trainer.is_approximate()
+        with pytest.raises(ValueError):
+            trainer.save(tmp_path / 'model.bin')
+        resume_args = ['train.py', '--resume', str(model), '--model', str(tmp_path / 'model.bin')]
+        with patch.object(sys, 'argv', resume_args):
+            with pytest.raises(SystemExit):
+                main()
+        assert not (tmp_path / 'model.bin').exists()
+
     @pytest.mark.parametrize(
         'train_arguments',
         ['--ngram 4 --min-ngram=1',],
@@ -29,3 +57,141 @@ class TestTrain:
     )
     def test_train_stdin(self, train_arguments, stdin, assert_model_path):
         main()
+
+
+class TestResume:
+    def test_resume(self, temp_dir, assert_model_path):
+        args = ['train.py', '--input-dir', str(temp_dir), '--ngram', '2']
+        with patch.object(sys, 'argv', args):
+            main()
+        trainer = Trainer.load(Path('model.pkl'))
+        counts = sum(c.sum() for _, _, c in trainer._ngram_model._storage.items())
+
+        temp_dir.join('newfile').write('совсем новый текст')
+        with patch.object(sys, 'argv', [*args, '--resume', 'model.pkl', '--bulk']):
+            main()
+        resumed = Trainer.load(Path('model.pkl'))
+        resumed_counts = sum(c.sum() for _, _, c in resumed._ngram_model._storage.items())
+
+        assert len(resumed._manifest) == 2
+        assert resumed_counts == counts + 3
+
+    def test_changed_file_stops_resume(self, temp_dir, tmp_path):
+        model = tmp_path / 'model.pkl'
+        args = ['train.py', '--input-dir', str(temp_dir), '--ngram', '2', '--model', str(model)]
+        with patch.object(sys, 'argv', args):
+            main()
+        saved = model.read_bytes()
+
+        temp_dir.join('myfile').write('дописанный текст', mode='a')
+        with patch.object(sys, 'argv', [*args, '--resume', str(model)]):
+            with pytest.raises(ValueError, match='changed since it was ingested'):
+                main()
+        assert model.read_bytes() == saved
+
+    def test_resume_sharded(self, temp_dir, tmp_path):
+        model = tmp_path / 'model.bin'
+        args = ['train.py', '--input-dir', str(temp_dir), '--ngram', '2', '--model', str(model)]
+        with patch.object(sys, 'argv', [*args, '--shards', '3']):
+            main()
+        counts = sorted(Trainer.load(model)._ngram_model._storage.counts())
+
+        temp_dir.join('newfile').write('совсем новый текст')
+        with patch.object(sys, 'argv', [*args, '--resume', str(model)]):
+            main()
+        resumed = Trainer.load(model)
+
+        assert resumed.shard_info() is None
+        assert not list(tmp_path.glob('model.bin.shard-*'))
+        assert len(sorted(resumed._ngram_model._storage.counts())) == len(counts) + 3
+
+    def test_sharded_checkpoints(self, temp_dir, tmp_path):
+        temp_dir.join('newfile').write('совсем новый текст')
+        model = tmp_path / 'model.bin'
+        args = [
+            'train.py', '--input-dir', str(temp_dir), '--model', str(model),
+            '--shards', '3', '--checkpoint-every', '0',
+        ]
+        save = Trainer.save
+        with patch.object(sys, 'argv', args), \
+                patch.object(Trainer, 'save', autospec=True, side_effect=save) as saved:
+            main()
+
+        assert saved.call_count == 3
+        assert all(call.kwargs['shards'] == 3 for call in saved.call_args_list)
+        assert len(list(tmp_path.glob('model.bin.shard-*'))) == 3
+
+
+class TestProfile:
+    def test_profile(self, temp_dir, assert_model_path, tmp_path):
+        report_path = tmp_path / 'profile.json'
+        stats_path = tmp_path / 'profile.pstats'
+        args = [
+            'train.py', '--input-dir', str(temp_dir), '--ngram', '2',
+            '--profile', str(report_path), '--profile-stats', str(stats_path),
+            '--profile-memory',
+        ]
+        with patch.object(sys, 'argv', args):
+            main()
+
+        report = json.loads(report_path.read_text())
+        phases = report['phases']
+        assert {'read', 'tokenize', 'ngram_update', 'save'} <= set(phases)
+        assert phases['tokenize']['calls'] >= 1
+        assert all(p['self_seconds'] <= p['seconds'] for p in phases.values())
+        assert report['unaccounted_seconds'] < report['wall_seconds']
+        assert all('net_bytes' in p for p in phases.values())
+        assert stats_path.stat().st_size > 0
+        assert PROFILER._cprofile is None
+
+
+class TestDedup:
+    def test_dedup(self, tmp_path, assert_model_path, caplog):
+        page = ' '.join(TRAIN_TEXT.split()[:40]) + '.'
+        (tmp_path / 'page').write_text(f'{page}\n\nОдин два три. Один два три.\n')
+        (tmp_path / 'mirror').write_text(page.replace('Руслан', 'Иван', 1))
+        args = ['train.py', '--input-dir', str(tmp_path), '--ngram', '2', '--dedup']
+        with patch.object(sys, 'argv', args), caplog.at_level('INFO'):
+            main()
+
+        trainer = Trainer.load(Path('model.pkl'))
+        counts = sum(c.sum() for _, _, c in trainer._ngram_model._storage.items())
+        assert 'Dedup removed 43 of 86 tokens: 1 of 3 documents, 6 of 12 sentences' in caplog.text
+        with patch.object(sys, 'argv', args[:-1]):
+            main()
+        trainer = Trainer.load(Path('model.pkl'))
+        assert counts < sum(c.sum() for _, _, c in trainer._ngram_model._storage.items())
+
+
+class TestPrune:
+    def test_prune_command(self, temp_dir, assert_model_path, tmp_path, capsys):
+        with patch.object(sys, 'argv', ['train.py', '--input-dir', str(temp_dir), '--ngram', '3']):
+            main()
+        output = tmp_path / 'pruned.bin'
+        args = ['prune.py', '--model', 'model.pkl', '--output', str(output), '--samples', '3']
+        with patch.object(sys, 'argv', args):
+            prune_main()
+
+        report = capsys.readouterr().out
+        assert 'latency' in report and 'load' in report
+        trainer = Trainer.load(Path('model.pkl'))
+        pruned = Trainer.load(output)
+        assert len(pruned._ngram_model._storage) < len(trainer._ngram_model._storage)
+        assert len(pruned._dictionary) < len(trainer._dictionary)
+        assert pruned.continue_(['привет'], word_count=5, seed=1)
+
+    def test_prune_sharded(self, temp_dir, tmp_path, capsys):
+        model, output = tmp_path / 'model.bin', tmp_path / 'pruned.bin'
+        args = ['train.py', '--input-dir', str(temp_dir), '--ngram', '3', '--model', str(model)]
+        with patch.object(sys, 'argv', [*args, '--shards', '3']):
+            main()
+        args = ['prune.py', '--model', str(model), '--output', str(output), '--samples', '3']
+        with patch.object(sys, 'argv', [*args, '--shards', '2']):
+            prune_main()
+
+        size_row = next(line for line in capsys.readouterr().out.splitlines() if line.startswith('size'))
+        before, after = (int(size.replace(',', '')) for size in size_row.split()[1:5:2])
+        assert before == sum(path.stat().st_size for path in tmp_path.glob('model.bin*'))
+        assert after == sum(path.stat().st_size for path in tmp_path.glob('pruned.bin*'))
+        assert len(list(tmp_path.glob('pruned.bin.shard-*'))) == 2
+        assert Trainer.load(output).shard_info().shards == 2
@@ -1,18 +1,29 @@
 import argparse
 import logging
 import os
+from math import inf
 from pathlib import Path
 
 from pyfillet import WordEmbedder
 
+from src.corpus_cache import open_corpus
+from src.dedup import Deduplicator
 from src.dictionary import Dictionary
 from src.model import NGramModel
+from src.profiling import profile_run
+from src.storage import ArrayStorage, DictStorage, SketchStorage, TrieStorage
 from src.trainer import Trainer
 
 FORMAT = "%(message)s"
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+STORAGES = {
+    "dict": DictStorage,
+    "array": ArrayStorage,
+    "trie": TrieStorage,
+    "sketch": SketchStorage,
+}
 
 parser = argparse.ArgumentParser(
     description="Utility for text generation model training."
@@ -25,32 +36,208 @@ parser.add_argument(
 parser.add_argument(
     "--model", type=Path, default="model.pkl", help="File for saving model."
 )
+parser.add_argument(
+    "--cache",
+    type=Path,
+    default=None,
+    help="Pre-tokenized corpus from pretokenize.py to train on, it is rebuilt first "
+    "when --input-dir files or tokenizer rules changed.",
+)
 parser.add_argument("--ngram", type=int, default=2, help="Ngram count.")
 parser.add_argument("--min-ngram", type=int, default=1, help="Minimum ngram length.")
 parser.add_argument(
     "--nsamples", type=int, default=3, help="Max next word samples to choose from."
 )
+parser.add_argument(
+    "--bulk",
+    action="store_true",
+    help="Count ngrams with vectorized bulk engine instead of DataLoader.",
+)
+parser.add_argument(
+    "--chunk-size",
+    type=int,
+    default=1 << 20,
+    help="Characters read at once, texts are split only at sentence ends.",
+)
+parser.add_argument(
+    "--workers",
+    type=int,
+    default=1,
+    help="Processes counting chunks in parallel.",
+)
+parser.add_argument(
+    "--resume",
+    type=Path,
+    default=None,
+    help="Model to continue training, already ingested files are skipped and "
+    "changed ones stop it, their old counts cannot be taken back.",
+)
+parser.add_argument(
+    "--checkpoint-every",
+    type=float,
+    default=inf,
+    help="Seconds between checkpoints written to --model.",
+)
+parser.add_argument(
+    "--storage",
+    default="dict",
+    choices=STORAGES.keys(),
+    help="Backend for ngram counts, sketch counts approximately within "
+    "--memory-budget.",
+)
+parser.add_argument(
+    "--memory-budget",
+    type=int,
+    default=1024,
+    help="Megabytes for ngram counts of --storage sketch, rare ngrams are "
+    "overcounted instead of stored.",
+)
+parser.add_argument(
+    "--dedup",
+    action="store_true",
+    help="Skip repeated sentences and near-duplicate documents (separated by blank "
+    "lines) of the input texts.",
+)
+parser.add_argument(
+    "--dedup-memory",
+    type=int,
+    default=256,
+    help="Megabytes of hashes --dedup remembers, older duplicates are kept.",
+)
+parser.add_argument(
+    "--shards",
+    type=int,
+    default=1,
+    help="Split the contexts of a .bin --model into this many files loaded on "
+    "demand by generation.",
+)
+parser.add_argument(
+    "--min-count",
+    type=int,
+    default=1,
+    help="Drop words seen fewer times, the rest are renumbered by frequency.",
+)
+parser.add_argument(
+    "--max-vocab",
+    type=int,
+    default=None,
+    help="Keep only this many most frequent words.",
+)
+parser.add_argument(
+    "--profile",
+    type=Path,
+    default=None,
+    help="Write time spent per phase to this JSON file.",
+)
+parser.add_argument(
+    "--profile-stats",
+    type=Path,
+    default=None,
+    help="Also dump cProfile stats to this file, see python -m pstats.",
+)
+parser.add_argument(
+    "--profile-memory",
+    action="store_true",
+    help="Add net allocated bytes per phase to --profile, slows the run down.",
+)
 
 
 def main():
     args = parser.parse_args()
+    if args.shards > 1 and args.model.suffix != Trainer.BINARY_SUFFIX:
+        parser.error(f"--shards needs a {Trainer.BINARY_SUFFIX} --model")
+    if args.storage == "sketch" and args.model.suffix == Trainer.BINARY_SUFFIX:
+        parser.error(
+            f"--storage sketch cannot be saved as a {Trainer.BINARY_SUFFIX} --model"
+        )
+    if args.dedup and args.cache is not None:
+        parser.error("--dedup filters texts, it cannot be combined with --cache")
+    with profile_run(args.profile, args.profile_stats, args.profile_memory):
+        run(args)
+
+
+def run(args):
     model_path = args.model
 
-    ngram_model = NGramModel()
-    dictionary = Dictionary()
-    embedder = WordEmbedder()
-    trainer = Trainer(
-        ngram_model=ngram_model,
-        dictionary=dictionary,
-        embedder=embedder,
-        ngram=args.ngram,
-        min_ngram=args.min_ngram,
-        nsamples=args.nsamples,
-    )
-
-    trainer.fit(input_dir=args.input_dir)
-
-    trainer.save(model_path)
+    if args.resume is not None:
+        trainer = Trainer.resume(
+            args.resume,
+            bulk=args.bulk,
+            chunk_size=args.chunk_size,
+            workers=args.workers,
+        )
+        if trainer.is_approximate() and model_path.suffix == Trainer.BINARY_SUFFIX:
+            parser.error(
+                f"{args.resume} counts approximately, it cannot be saved as a "
+                f"{Trainer.BINARY_SUFFIX} --model"
+            )
+    else:
+        if args.storage == "sketch":
+            storage = SketchStorage.for_budget(args.memory_budget << 20)
+        else:
+            storage = STORAGES[args.storage]()
+        ngram_model = NGramModel(storage=storage)
+        dictionary = Dictionary()
+        embedder = WordEmbedder()
+        trainer = Trainer(
+            ngram_model=ngram_model,
+            dictionary=dictionary,
+            embedder=embedder,
+            ngram=args.ngram,
+            min_ngram=args.min_ngram,
+            nsamples=args.nsamples,
+            bulk=args.bulk,
+            chunk_size=args.chunk_size,
+            workers=args.workers,
+        )
+
+    if args.cache is not None:
+        corpus = open_corpus(
+            args.cache,
+            None if args.input_dir is None else Path(args.input_dir),
+            chunk_size=args.chunk_size,
+        )
+        trainer.fit_corpus(
+            corpus,
+            checkpoint_path=model_path,
+            checkpoint_interval=args.checkpoint_every,
+            checkpoint_shards=args.shards,
+        )
+    else:
+        deduplicator = (
+            Deduplicator(memory_budget=args.dedup_memory << 20) if args.dedup else None
+        )
+        trainer.fit(
+            input_dir=args.input_dir,
+            checkpoint_path=model_path,
+            checkpoint_interval=args.checkpoint_every,
+            checkpoint_shards=args.shards,
+            deduplicator=deduplicator,
+        )
+        if deduplicator is not None:
+            stats = deduplicator.stats()
+            logger.info(
+                "Dedup removed %s of %s tokens: %s of %s documents, "
+                "%s of %s sentences",
+                stats.removed_tokens,
+                stats.tokens,
+                stats.removed_documents,
+                stats.documents,
+                stats.removed_sentences,
+                stats.sentences,
+            )
+    if args.min_count > 1 or args.max_vocab is not None:
+        trainer.prune_vocabulary(min_count=args.min_count, max_vocab=args.max_vocab)
+    logger.info("Model memory usage: %s bytes", trainer.memory_usage())
+    error, probability = trainer.error_bound()
+    if error:
+        logger.info(
+            "Ngram counts are overestimated by at most %s with probability %.3f",
+            error,
+            probability,
+        )
+
+    trainer.save(model_path, shards=args.shards)
 
 
 if __name__ == "__main__":